@@ -0,0 +1,123 @@
+#! python3.9
+
+import argparse as arg
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+import pysam
+import yaml
+
+from clinpy.utils.snp_functions import compare_fields, coerce, csq_decoder, decode_csq, parse_vcf_chunks
+
+
+def read_consequences(file, field_name, field_split, num_variants):
+    """
+    read the consequences of the first variants of a vcf into memory so only the decoding is timed
+    :param file: path of the vcf
+    :param field_name: name of the consequence info field
+    :param field_split: separator of the consequence fields
+    :param num_variants: number of variants to read
+    :return: lower case field names from the header and a list of lists of split consequences, one per variant
+    """
+    vcf = pysam.VariantFile(file)
+    split_fields = [field.lower() for field in vcf.header.info[field_name].description.split(field_split)[1:]]
+    variants = []
+    for var in vcf:
+        if field_name in var.info:
+            variants.append([cons.split(field_split) for cons in var.info[field_name]])
+        if len(variants) >= num_variants:
+            break
+    vcf.close()
+    return split_fields, variants
+
+
+def dict_decode(variants, split_fields, fields, type_dict, columns):
+    """
+    one dict per consequence passed through coerce, this is how the consequences were decoded before csq_decoder
+    """
+    rows = []
+    for consqs in variants:
+        for impact in consqs:
+            consequence = {}
+            for i in range(len(split_fields)):
+                if split_fields[i] in fields:
+                    consequence[split_fields[i]] = impact[i + 1]
+            rows.append(coerce(consequence, type_dict))
+    return pd.DataFrame(rows, columns=columns)
+
+
+def compiled_decode(variants, split_fields, fields, type_dict, columns):
+    """
+    csq_decoder once and then decode_csq on all the consequences at once like a chunk of parse_vcf_chunks
+    """
+    decoder, missing = csq_decoder(split_fields, fields, type_dict)
+    consqs = [impact for variant in variants for impact in variant]
+    results = decode_csq(consqs, decoder)
+    for column in columns:
+        if column not in results:
+            results[column] = [None] * len(consqs)
+    return pd.DataFrame(results, columns=columns)
+
+
+def best_time(function, repeats, *args):
+    """
+    :return: the fastest of repeats runs in seconds and the result of the last one
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    parser = arg.ArgumentParser(description='time decoding the VEP consequences of a vcf with one dict per '
+                                            'consequence against the compiled decoder parse_vcf_chunks uses')
+    parser.add_argument('-i', '--input', help="VEP annotated vcf", type=str, action="store")
+    parser.add_argument('-y', '--yaml', help="vcf.yaml with the impact fields and their types", type=str,
+                        action="store", default=os.path.join(os.path.dirname(__file__), "..", "clinpy", "vcf.yaml"))
+    parser.add_argument('-n', '--num_variants', help="number of variants to decode", type=int, action="store",
+                        default=50000)
+    parser.add_argument('-r', '--repeats', help="number of times to run each, the fastest one is reported", type=int,
+                        action="store", default=3)
+    parser.add_argument('-f', '--full', help="also time parse_vcf_chunks on the whole file", action="store_true")
+    args = parser.parse_args()
+
+    if args.input is None or not os.path.isfile(args.input):
+        raise FileNotFoundError("could not find {}".format(args.input))
+    with open(args.yaml) as yml:
+        vcf_params = yaml.safe_load(yml)
+    field_name, field_split = vcf_params["info"]["name"], vcf_params["info"]["sep"]
+    type_dict = vcf_params["variant_impacts"]
+
+    fields, formats = compare_fields([args.input], field_name, "error", field_split)
+    split_fields, variants = read_consequences(args.input, field_name, field_split, args.num_variants)
+    columns = [field for field in fields if field in type_dict.keys()]
+    num_consequences = sum(len(consqs) for consqs in variants)
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "{} variants, {} consequences, {} fields, {} "
+          "in vcf.yaml".format(len(variants), num_consequences, len(split_fields), len(columns)))
+
+    dict_time, dict_results = best_time(dict_decode, args.repeats, variants, split_fields, fields, type_dict,
+                                        columns)
+    compiled_time, compiled_results = best_time(compiled_decode, args.repeats, variants, split_fields, fields,
+                                                type_dict, columns)
+    if not dict_results.equals(compiled_results):
+        raise ValueError("the decoders do not return the same consequences")
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "dict + coerce: {:.3f}s ({:.0f} "
+          "consequences/s)".format(dict_time, num_consequences / dict_time))
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "compiled: {:.3f}s ({:.0f} "
+          "consequences/s)".format(compiled_time, num_consequences / compiled_time))
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "speedup: {:.1f}x".format(
+        dict_time / compiled_time))
+
+    if args.full:
+        vcf = pysam.VariantFile(args.input)
+        start = time.perf_counter()
+        num_rows = sum(chunk.shape[0] for chunk in parse_vcf_chunks(vcf, fields, formats, type_dict, field_name,
+                                                                    field_split, vcf_params["missing_impact"]))
+        full_time = time.perf_counter() - start
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "parse_vcf_chunks: {} rows in {:.3f}s "
+              "({:.0f} rows/s)".format(num_rows, full_time, num_rows / full_time))
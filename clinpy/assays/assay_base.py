@@ -1,5 +1,64 @@
-from sqlalchemy import MetaData, Table
-from sqlalchemy.orm import Session
+import pandas as pd
+from sqlalchemy import tuple_
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from clinpy.utils.query_cache import QueryCache, cache_key, current_generation
+from clinpy.utils.schema import project_metadata, reflected_table
+
+
+def fetch_df(bind, query):
+    """
+    execute a statement once and make a dataframe of the results, the column names come from the same result instead
+    of executing the statement again for the keys
+    :param bind: session or connection, temp tables are only visible to the connection that created them
+    :param query: sqlalchemy statement
+    :return: a dataframe, it has the columns even if there are no rows
+    """
+    results = bind.execute(query)
+    return pd.DataFrame(results.fetchall(), columns=list(results.keys()))
+
+
+def iter_chunks(bind, query, size=100000):
+    """
+    stream the results of a statement size rows at a time, only one chunk of rows is in memory at a time (as long as
+    the driver supports server side cursors, sqlite cursors are lazy anyway)
+    :param bind: session or connection
+    :param query: sqlalchemy statement
+    :param size: number of rows per chunk
+    :return: a generator of dataframes
+    """
+    results = bind.execute(query.execution_options(stream_results=True)).yield_per(size)
+    columns = list(results.keys())
+    for rows in results.partitions():
+        yield pd.DataFrame(rows, columns=columns)
+
+
+def iter_pages(bind, query, keys, size=100000):
+    """
+    keyset pagination, the statement is run once per page with a WHERE keys > last keys of the previous page and a
+    LIMIT so each page is an index seek instead of an OFFSET that reads all the previous pages again. Unlike
+    iter_chunks nothing is kept open between pages
+    :param bind: session or connection
+    :param query: sqlalchemy select without an order by or limit
+    :param keys: list of columns that are unique together (like a primary key) and are in the selected columns
+    :param size: number of rows per page
+    :return: a generator of dataframes
+    """
+    names = [key.name for key in keys]
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.where(tuple_(*keys) > tuple_(*last) if len(keys) > 1 else keys[0] > last[0])
+        page = fetch_df(bind, page.order_by(*keys).limit(size))
+        if page.shape[0] == 0:
+            return
+        yield page
+        if page.shape[0] < size:
+            return
+        # numpy scalars cannot be bound as parameters by sqlite3
+        last = [page[name].iloc[-1] for name in names]
+        last = [value.item() if hasattr(value, "item") else value for value in last]
 
 
 class Assay:
@@ -9,10 +68,93 @@ class Assay:
 
     def __init__(self, db, genome=None):
         self.db = db
-        self.session = Session(self.project)
-        self.metadata = MetaData(self.project)
-        self.metadata.reflect(bind=self.project)
+        # one session per thread so an assay can be used from a thread pool, see close_session
+        self.session = scoped_session(sessionmaker(bind=self.db))
+        # shared with the other assays of the same project, tables are reflected the first time they are used
+        self.metadata = project_metadata(self.db)
 
-        self.sample_table = Table("samples", self.metadata, autoload=True, autoload_with=self.db)
+        self.sample_table = self.table("samples")
         if genome is not None:
             self.genome = genome
+        self.cache = None
+
+    def table(self, name, required=True):
+        """
+        get a table of the project, see utils.schema.reflected_table
+        :param name: table name
+        :param required: raise an error if the table does not exist otherwise return None
+        :return: sqlalchemy Table
+        """
+        return reflected_table(name, self.metadata, self.db, required)
+
+    def close_session(self):
+        """
+        close the session of the calling thread and return its connection to the pool, threads that are done with
+        the assay should call this. The next query from the same thread starts a new session
+        :return: nothing
+        """
+        self.session.remove()
+
+    def enable_cache(self, max_bytes=256 * 1024 ** 2):
+        """
+        cache the results of the search methods in memory, see utils.query_cache. The project generation is checked
+        on every lookup so results are never served after data is added to the project. Projects created before
+        the project_info table was added are not cached until they are loaded into again
+        :param max_bytes: size limit of the cache
+        :return: nothing
+        """
+        self.cache = QueryCache(max_bytes)
+
+    def cache_lookup(self, *parts):
+        """
+        look up a result in the cache
+        :param parts: everything the result depends on, see utils.query_cache.cache_key
+        :return: the key for cache_store (None if there is no cache) and the cached result (None if not cached)
+        """
+        if self.cache is None or self.table("project_info", required=False) is None:
+            return None, None
+        generation = current_generation(self.session)
+        key = cache_key(type(self).__name__, *parts)
+        return (generation, key), self.cache.get(key, generation)
+
+    def cache_store(self, key, results):
+        """
+        store a result with the key from cache_lookup, the generation is the one from before the query ran so a load
+        that happened in the meantime makes it stale right away
+        :param key: from cache_lookup
+        :param results: a dataframe
+        :return: nothing
+        """
+        if key is not None and results is not None:
+            generation, key = key
+            self.cache.put(key, results, generation)
+
+    def fetch_df(self, query, conn=None):
+        """
+        see fetch_df
+        :param query: sqlalchemy statement
+        :param conn: connection to use instead of the session (for queries on temp tables)
+        :return: a dataframe
+        """
+        return fetch_df(self.session if conn is None else conn, query)
+
+    def iter_chunks(self, query, size=100000, conn=None):
+        """
+        see iter_chunks
+        :param query: sqlalchemy statement
+        :param size: number of rows per chunk
+        :param conn: connection to use instead of the session
+        :return: a generator of dataframes
+        """
+        return iter_chunks(self.session if conn is None else conn, query, size)
+
+    def iter_pages(self, query, keys, size=100000, conn=None):
+        """
+        see iter_pages
+        :param query: sqlalchemy select without an order by or limit
+        :param keys: list of columns that are unique together
+        :param size: number of rows per page
+        :param conn: connection to use instead of the session
+        :return: a generator of dataframes
+        """
+        return iter_pages(self.session if conn is None else conn, query, keys, size)
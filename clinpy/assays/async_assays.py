@@ -0,0 +1,237 @@
+import os
+from urllib.request import pathname2url
+
+import pandas as pd
+from greenlet import getcurrent
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from clinpy.assays.expression import Expression
+from clinpy.assays.junction import Junctions
+from clinpy.assays.variants import Variants
+
+
+def async_engine(path, read_only=True, immutable=False, pool_size=5, max_overflow=10, busy_timeout=30):
+    """
+    asyncio engine for a sqlite project using the aiosqlite driver (pip install clinpy[async]), same options as
+    utils.read_engine
+    :param path: path of the sqlite database
+    :param read_only: open with mode=ro
+    :param immutable: open with immutable=1, only for databases that are not going to change
+    :param pool_size: number of connections kept open
+    :param max_overflow: number of connections that can be opened on top of pool_size when all of them are in use
+    :param busy_timeout: seconds to wait for a lock
+    :return: a sqlalchemy AsyncEngine
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError("could not find {}".format(path))
+    if immutable:
+        dbstring = "sqlite+aiosqlite:///file:{}?immutable=1&uri=true".format(pathname2url(os.path.abspath(path)))
+    elif read_only:
+        dbstring = "sqlite+aiosqlite:///file:{}?mode=ro&uri=true".format(pathname2url(os.path.abspath(path)))
+    else:
+        dbstring = "sqlite+aiosqlite:///{}".format(path)
+    engine = create_async_engine(dbstring, poolclass=AsyncAdaptedQueuePool, pool_size=pool_size,
+                                 max_overflow=max_overflow, connect_args={"timeout": busy_timeout})
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def read_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return engine
+
+
+class AsyncAssay:
+    """
+    asyncio version of an assay. The queries are run by the methods of the regular assay class (assay_class) inside
+    AsyncSession.run_sync, every database call they make goes through the async driver and gives control back to the
+    event loop while it waits, so many calls can run at the same time in one event loop. Everything else the methods
+    do runs on the event loop thread and blocks it: the pivots, statistics and p-value adjustments of
+    cohort_stats/zscores/outliers/fold_change and building the sparse matrix of genotype_matrix can take seconds on a
+    large project. For those, a regular assay made with utils.read_engine called through loop.run_in_executor keeps
+    the loop free. Each call gets its own session and connection. Create instances with the create coroutine, the
+    constructor of the assay reads the database
+    """
+    assay_class = None
+
+    def __init__(self, db, assay):
+        """
+        :param db: AsyncEngine
+        :param assay: instance of assay_class made with db.sync_engine, see create
+        """
+        self.db = db
+        self.assay = assay
+        # run_sync runs every call in its own greenlet, this is the session of that call
+        self.assay.session = scoped_session(sessionmaker(bind=db.sync_engine), scopefunc=getcurrent)
+
+    @classmethod
+    async def create(cls, db, *args, **kwargs):
+        """
+        :param db: AsyncEngine (see async_engine)
+        :param args: the rest of the arguments of assay_class
+        :param kwargs: same as args
+        :return: an instance of the class
+        """
+        async with AsyncSession(db) as session:
+            assay = await session.run_sync(lambda sync_session: cls.assay_class(db.sync_engine, *args, **kwargs))
+        return cls(db, assay)
+
+    async def run(self, method, *args, **kwargs):
+        """
+        call a method of the assay, the event loop runs other tasks while it waits for the database but not while the
+        method processes the results, see the class docstring
+        :param method: name of the method
+        :param args: arguments of the method
+        :param kwargs: keyword arguments of the method
+        :return: whatever the method returns
+        """
+        def call(sync_session):
+            self.assay.session.registry.set(sync_session)
+            try:
+                return getattr(self.assay, method)(*args, **kwargs)
+            finally:
+                self.assay.session.registry.clear()
+
+        async with AsyncSession(self.db) as session:
+            return await session.run_sync(call)
+
+    def table(self, name, required=True):
+        """
+        see Assay.table, the table needs to be reflected already (all of them are if there is a schema snapshot)
+        """
+        return self.assay.table(name, required)
+
+    def enable_cache(self, max_bytes=256 * 1024 ** 2):
+        """
+        see Assay.enable_cache, the cache is shared by all the calls
+        """
+        self.assay.enable_cache(max_bytes)
+
+    async def fetch_df(self, query):
+        """
+        see assay_base.fetch_df
+        :param query: sqlalchemy statement
+        :return: a dataframe
+        """
+        async with self.db.connect() as conn:
+            results = await conn.execute(query)
+            return pd.DataFrame(results.fetchall(), columns=list(results.keys()))
+
+    async def iter_chunks(self, query, size=100000):
+        """
+        see assay_base.iter_chunks, use with async for
+        :param query: sqlalchemy statement
+        :param size: number of rows per chunk
+        :return: an async generator of dataframes
+        """
+        async with self.db.connect() as conn:
+            results = await conn.stream(query)
+            columns = list(results.keys())
+            async for rows in results.partitions(size):
+                yield pd.DataFrame(rows, columns=columns)
+
+
+class AsyncExpression(AsyncAssay):
+    assay_class = Expression
+
+    async def get_expression(self, *args, **kwargs):
+        """
+        see Expression.get_expression
+        """
+        return await self.run("get_expression", *args, **kwargs)
+
+    async def cohort_stats(self, *args, **kwargs):
+        """
+        see Expression.cohort_stats
+        """
+        return await self.run("cohort_stats", *args, **kwargs)
+
+    async def zscores(self, *args, **kwargs):
+        """
+        see Expression.zscores
+        """
+        return await self.run("zscores", *args, **kwargs)
+
+    async def outliers(self, *args, **kwargs):
+        """
+        see Expression.outliers
+        """
+        return await self.run("outliers", *args, **kwargs)
+
+    async def fold_change(self, *args, **kwargs):
+        """
+        see Expression.fold_change
+        """
+        return await self.run("fold_change", *args, **kwargs)
+
+
+class AsyncJunctions(AsyncAssay):
+    assay_class = Junctions
+
+    async def select(self, *args, **kwargs):
+        """
+        see Junctions.select
+        """
+        return await self.run("select", *args, **kwargs)
+
+    async def search(self, *args, **kwargs):
+        """
+        see Junctions.search
+        """
+        return await self.run("search", *args, **kwargs)
+
+    async def recurrence(self, *args, **kwargs):
+        """
+        see Junctions.recurrence
+        """
+        return await self.run("recurrence", *args, **kwargs)
+
+    async def recurrence_counts(self, *args, **kwargs):
+        """
+        see Junctions.recurrence_counts
+        """
+        return await self.run("recurrence_counts", *args, **kwargs)
+
+
+class AsyncVariants(AsyncAssay):
+    assay_class = Variants
+
+    async def list_impacts(self):
+        """
+        see Variants.list_impacts
+        """
+        return await self.run("list_impacts")
+
+    async def list_variant_quals(self):
+        """
+        see Variants.list_variant_quals
+        """
+        return await self.run("list_variant_quals")
+
+    async def filter(self, *args, **kwargs):
+        """
+        see Variants.filter
+        """
+        return await self.run("filter", *args, **kwargs)
+
+    async def search_region(self, *args, **kwargs):
+        """
+        see Variants.search_region
+        """
+        return await self.run("search_region", *args, **kwargs)
+
+    async def variant_samples(self, *args, **kwargs):
+        """
+        see Variants.variant_samples
+        """
+        return await self.run("variant_samples", *args, **kwargs)
+
+    async def genotype_matrix(self, *args, **kwargs):
+        """
+        see Variants.genotype_matrix
+        """
+        return await self.run("genotype_matrix", *args, **kwargs)
@@ -1,5 +1,11 @@
 from clinpy.assays.assay_base import Assay
-from sqlalchemy import Table, select
+from clinpy.utils.expression_store import ExpressionStore, expression_generation
+from clinpy.utils.expression_stats import transform, block_statistics, block_outliers, adjust_pvalues, zscores
+from clinpy.database.rna_tables import ExpressionStats
+from clinpy.utils.utils import is_read_only
+from clinpy.utils.query_cache import current_generation
+from sqlalchemy import select, inspect, and_
+import numpy as np
 import pandas as pd
 
 
@@ -8,11 +14,66 @@ class Expression(Assay):
     This is the expression class it is used to query expression tables and return either wide
     or long format expression table
     """
-    def __init__(self, db, genome):
-        super.__init__(db, genome)
-        gene_table=Table("gene_expression", self.metadata, autoload=True, autoload_with=self.db)
-        transcript_table=Table("transcript_expression", self.metadata, autoload=True, autoload_with=self.db)
+    def __init__(self, db, genome, store=None):
+        """
+        :param db: project database engine
+        :param genome: Genome class from pytxdb
+        :param store: path to the expression store (see utils.expression_store) if there is one wide format
+        requests are served from it instead of the database
+        """
+        super().__init__(db, genome)
+        self.gene_table=self.table("gene_expression")
+        self.transcript_table=self.table("transcript_expression")
+        # None in projects created before the genes/transcripts tables, see rna_functions.add_expression_ids
+        self.genes_table = self.table("genes", required=False)
+        self.transcripts_table = self.table("transcripts", required=False)
+        self.store = store
+        self.stores = {}
 
+    def get_store(self, gene=True):
+        """
+        open the expression store for genes or transcripts, a store that was built before expression was last added is
+        out of date and is not used, see ExpressionStore.is_current. The expression generation of the project is
+        checked every time so a load while this is open is noticed
+        :param gene: is this gene or isoform
+        :return: an ExpressionStore or None if there is no store or it is out of date
+        """
+        if self.store is None or not ExpressionStore.exists(self.store, gene):
+            return None
+        if self.table("project_info", required=False) is None:  # the store has a generation, the project does not
+            return None
+        generation = current_generation(self.session, expression_generation(gene))
+        if gene not in self.stores.keys() or self.stores[gene][0] != generation:
+            # re-opened when the generation changes, the store may have been re-built by the load
+            store = ExpressionStore(self.store, gene)
+            self.stores[gene] = (generation, store if store.is_current(generation) else None)
+        return self.stores[gene][1]
+
+    def named_expression(self, gene=True):
+        """
+        the expression table with the gene/transcript names, they are in the genes/transcripts tables or in the
+        expression table itself in projects that were not loaded into since the genes/transcripts tables were added
+        :param gene: is this gene or isoform
+        :return: the expression table, the name column and the from clause of the queries
+        """
+        table = self.gene_table if gene else self.transcript_table
+        dictionary = self.genes_table if gene else self.transcripts_table
+        level = "gene" if gene else "transcript"
+        if dictionary is None or level in table.c:
+            return table, table.c[level], table
+        return table, dictionary.c.name, table.join(dictionary, table.c[level + "_id"] == dictionary.c.id)
+
+    @staticmethod
+    def metric(what):
+        """
+        column name of a metric
+        :param what: "TPM"/"FPKM/"counts" or "isopct"
+        :return: the column in the expression tables
+        """
+        what = what.lower()
+        if what == "counts":
+            what = "expected_count"
+        return what
 
     def get_expression(self, cohort=None, samples=None, gene=True, names=None, long=True, what=None):
         """
@@ -25,38 +86,260 @@ class Expression(Assay):
        :param what: "TPM"/"FPKM/"counts" or "isopct" for transcripts optional if long=True
        :return: a dataframe of expression
        """
+        if not long and what is None:
+            raise ValueError(
+                "for wide format you need to specify either TPM, FPKM, expected count or isopct (transcripts only)")
+
+        # the expression tables only have integer ids, see named_expression for where the names are
+        table, name_col, source = self.named_expression(gene)
         if gene:
-            table=self.gene_table
-            query = select(table.c.samplename, table.c.gene, table.c.expected_count,
-                               table.c.FPKM, table.c.tpm)
+            query = select(table.c.samplename, name_col.label("gene"), table.c.expected_count,
+                           table.c.fpkm, table.c.tpm).select_from(source)
         else:
-            table=self.transcript_table
-            query = select(table.c.samplename, table.c.gene, table.c.expected_count,
-                           table.c.fpkm, table.c.tpm, table.c.isopct)
+            query = select(table.c.samplename, name_col.label("transcript"), table.c.expected_count,
+                           table.c.fpkm, table.c.tpm, table.c.isopct).select_from(source)
 
         if cohort is not None:
-
-            samples = select(self.sample_table.c.study_id).where(self.sample_table.c.cohort).in_(cohort). \
-                scalar_subquery()
-            query = query.where(table.samplename.in_(samples))
+            cohort_samples = select(self.sample_table.c.sample_id).where(self.sample_table.c.cohort.in_(cohort))
+            query = query.where(table.c.samplename.in_(cohort_samples))
 
         if samples is not None:
             query = query.where(table.c.samplename.in_(samples))
 
         if names is not None:
-            query = query.where(table.c.gene.in_(names))
+            query = query.where(name_col.in_(names))
+
+        if not long:
+            what = self.metric(what)
+            store = self.get_store(gene)
+            if store is not None:
+                if cohort is not None:
+                    cohort_samples = self.session.execute(cohort_samples).scalars().all()
+                    if samples is not None:
+                        samples = [sample for sample in samples if sample in cohort_samples]
+                    else:
+                        samples = cohort_samples
+                return store.get(what, names=names, samples=samples)
 
-        results = self.session.execute(query)
-        results = pd.DataFrame(results)
-        results.columns = list(self.session.execute(query).keys())
+        key, results = self.cache_lookup(query)
+        if results is None:
+            results = self.fetch_df(query)
+            self.cache_store(key, results)
 
         if long:
             return results
         else:
-            if what is not None:
-                return results.pivot(index="gene", columns="samplename", values=what)
-            else:
-                raise ValueError(
-                    "for wide format you need to specify either TPM, FPKM, expected count or isopct (transcripts only)")
+            return results.pivot(index="gene" if gene else "transcript", columns="samplename", values=what)
 
+    def expression_samples(self, cohort=None, samples=None, gene=True):
+        """
+        samples that have expression data
+        :param cohort: samples from a cohort
+        :param samples: specific samples
+        :param gene: is this gene or isoform
+        :return: sorted list of sample names
+        """
+        table = self.gene_table if gene else self.transcript_table
+        query = select(table.c.samplename).distinct().order_by(table.c.samplename)
+        if cohort is not None:
+            query = query.where(table.c.samplename.in_(
+                select(self.sample_table.c.sample_id).where(self.sample_table.c.cohort.in_(cohort))))
+        if samples is not None:
+            query = query.where(table.c.samplename.in_(samples))
+        return self.session.execute(query).scalars().all()
 
+    def iter_blocks(self, what, samples, gene=True, block_size=5000):
+        """
+        go over the gene x sample matrix of a metric a block of genes at a time, blocks are sliced from the expression
+        store if there is one otherwise they are queried by gene id range
+        :param what: "TPM"/"FPKM/"counts" or "isopct" for transcripts
+        :param samples: list of samples, these are the columns of every block
+        :param gene: is this gene or isoform
+        :param block_size: number of genes per block
+        :return: a generator of wide dataframes with genes as the index and samples as the columns
+        """
+        what = self.metric(what)
+        level = "gene" if gene else "transcript"
+        store = self.get_store(gene)
+        if store is not None:
+            for i in range(0, len(store.names), block_size):
+                block = store.get(what, names=store.names[i:i + block_size], samples=samples)
+                yield block.reindex(columns=samples)
+            return
+
+        table, name_col, source = self.named_expression(gene)
+        if source is table:  # no ids, the names are the keys of the ranges
+            id_col = name_col
+            genes = select(name_col, name_col.label("name")).distinct().order_by(name_col)
+        else:
+            dictionary = self.genes_table if gene else self.transcripts_table
+            id_col = table.c[level + "_id"]
+            genes = select(dictionary.c.id, dictionary.c.name).order_by(dictionary.c.id)
+        genes = pd.DataFrame(self.session.execute(genes).fetchall(), columns=["id", level])
+        for i in range(0, genes.shape[0], block_size):
+            ids = genes.iloc[i:i + block_size]
+            first, last = ids["id"].iloc[[0, -1]].tolist()
+            query = select(id_col, table.c.samplename, table.c[what]). \
+                where(and_(id_col >= first, id_col <= last)). \
+                where(table.c.samplename.in_(samples))
+            rows = pd.DataFrame(self.session.execute(query).fetchall(), columns=["id", "samplename", what])
+            block = rows.pivot(index="id", columns="samplename", values=what). \
+                reindex(index=ids["id"], columns=samples)
+            block.index = pd.Index(ids[level].to_numpy(), name=level)
+            block.columns.name = "samplename"
+            yield block
+
+    def cohort_stats(self, cohort=None, samples=None, gene=True, what="tpm", log=True, block_size=5000, cache=True):
+        """
+        per gene mean, sd, median, mad and quantiles (see utils.expression_stats.QUANTILES) of a cohort, calculated a
+        block of genes at a time
+        :param cohort: samples from a cohort, if None all the samples
+        :param samples: specific samples, results for a sample subset are not cached
+        :param gene: is this gene or isoform
+        :param what: "TPM"/"FPKM/"counts" or "isopct" for transcripts
+        :param log: calculate the statistics on log2(x+1) values
+        :param block_size: number of genes per block
+        :param cache: read and write the results to the expression_stats table, with a read only engine (see
+        utils.read_engine) they are only read
+        :return: a dataframe with genes/transcripts as the index
+        """
+        what = self.metric(what)
+        level = "gene" if gene else "transcript"
+        cache = cache and samples is None
+        key = "all" if cohort is None else ",".join(sorted(cohort))
+        stats_table = ExpressionStats.__table__
+        if cache and inspect(self.db).has_table(stats_table.name):
+            query = select(stats_table).where(and_(stats_table.c.cohort == key, stats_table.c.level == level,
+                                                   stats_table.c.metric == what, stats_table.c.log == log)). \
+                order_by(stats_table.c.id)
+            results = self.fetch_df(query)
+            if results.shape[0] > 0:
+                results = results.drop(columns=["id", "cohort", "level", "metric", "log"]). \
+                    rename(columns={"name": level}).set_index(level)
+                return results
+
+        samples = self.expression_samples(cohort, samples, gene)
+        stats = []
+        for block in self.iter_blocks(what, samples, gene, block_size):
+            block_stats = block_statistics(transform(block.to_numpy(), log))
+            block_stats.index = block.index
+            stats.append(block_stats)
+        stats = pd.concat(stats)
+
+        if cache and not is_read_only(self.db):
+            # same connection as the lookup, duckdb sessions would not see rows written by another connection
+            conn = self.session.connection()
+            stats_table.create(conn, checkfirst=True)
+            cached = stats.reset_index().rename(columns={level: "name"})
+            cached.insert(0, "cohort", key)
+            cached.insert(1, "level", level)
+            cached.insert(2, "metric", what)
+            cached.insert(3, "log", log)
+            cached.to_sql(stats_table.name, conn, if_exists="append", index=False)
+            self.session.commit()
+        return stats
+
+    def zscores(self, cohort=None, samples=None, gene=True, names=None, what="tpm", log=True, robust=True,
+                block_size=5000):
+        """
+        wide format z-scores of samples relative to a cohort, calculated a block of genes at a time (see iter_blocks)
+        so the long format expression of all the samples is never in memory
+        :param cohort: the reference cohort, if None all the samples
+        :param samples: samples to score, if None the samples of the cohort
+        :param gene: is this gene or isoform
+        :param names: names of the genes/transcripts if none will return everything might take a while
+        :param what: "TPM"/"FPKM/"counts" or "isopct" for transcripts
+        :param log: log2(x+1) values before scoring
+        :param robust: use median and mad instead of mean and sd
+        :param block_size: number of genes per block
+        :return: a dataframe with genes/transcripts as the index and samples as columns
+        """
+        stats = self.cohort_stats(cohort, gene=gene, what=what, log=log, block_size=block_size)
+        if samples is None:
+            samples = self.expression_samples(cohort, gene=gene)
+        else:
+            samples = self.expression_samples(samples=samples, gene=gene)
+        center, scale = ("median", "mad") if robust else ("mean", "sd")
+
+        if names is not None:  # only a few genes, one query is enough
+            blocks = [self.get_expression(samples=samples, gene=gene, names=names, long=False, what=what)]
+        else:
+            blocks = self.iter_blocks(what, samples, gene, block_size)
+        scores = []
+        for block in blocks:
+            block = block.dropna(how="all")  # genes that are not in these samples
+            block_stats = stats.reindex(block.index)
+            scores.append(pd.DataFrame(zscores(transform(block.to_numpy(), log), block_stats[center].to_numpy(),
+                                               block_stats[scale].to_numpy()),
+                                       index=block.index, columns=block.columns))
+        if len(scores) == 0:
+            return pd.DataFrame(columns=samples)
+        return pd.concat(scores).sort_index()
+
+    def outliers(self, cohort=None, samples=None, gene=True, what="tpm", log=True, robust=True, padj=0.05,
+                 min_zscore=None, block_size=5000):
+        """
+        expression outliers, each sample is compared to the distribution of the cohort and z-scores are turned into
+        two sided p-values that are adjusted per sample across all genes (Benjamini-Hochberg) similar to what OUTRIDER
+        reports. This is a z-score test, there is no autoencoder or negative binomial fit.
+        :param cohort: the reference cohort, if None all the samples
+        :param samples: samples to look for outliers in, if None the samples of the cohort
+        :param gene: is this gene or isoform
+        :param what: "TPM"/"FPKM/"counts" or "isopct" for transcripts
+        :param log: log2(x+1) values before scoring
+        :param robust: use median and mad instead of mean and sd
+        :param padj: adjusted p-value cutoff
+        :param min_zscore: optional absolute z-score cutoff
+        :param block_size: number of genes per block
+        :return: a long dataframe of samplename, gene/transcript, value, zscore, pvalue and padj
+        """
+        level = "gene" if gene else "transcript"
+        stats = self.cohort_stats(cohort, gene=gene, what=what, log=log, block_size=block_size)
+        if samples is None:
+            samples = self.expression_samples(cohort, gene=gene)
+        else:
+            samples = self.expression_samples(samples=samples, gene=gene)
+
+        # adjusted p-values are never smaller than the nominal ones so only tests below the cutoff are kept
+        candidates = []
+        tests = pd.Series(0, index=samples)
+        for block in self.iter_blocks(what, samples, gene, block_size):
+            values = pd.DataFrame(transform(block.to_numpy(), log), index=block.index, columns=block.columns)
+            block_candidates, block_tests = block_outliers(values, stats.reindex(block.index), robust, padj)
+            candidates.append(block_candidates)
+            tests = tests.add(block_tests, fill_value=0)
+
+        columns = ["samplename", level, "value", "zscore", "pvalue", "padj"]
+        if len(candidates) == 0:
+            return pd.DataFrame(columns=columns)
+        candidates = pd.concat(candidates, ignore_index=True)
+        candidates["padj"] = np.nan
+        for samplename, rows in candidates.groupby("samplename").groups.items():
+            candidates.loc[rows, "padj"] = adjust_pvalues(candidates.loc[rows, "pvalue"].to_numpy(),
+                                                          tests[samplename])
+        candidates = candidates[candidates["padj"] < padj]
+        if min_zscore is not None:
+            candidates = candidates[candidates["zscore"].abs() >= min_zscore]
+        return candidates[columns].sort_values(["samplename", "padj"]).reset_index(drop=True)
+
+    def fold_change(self, cohort1, cohort2, gene=True, what="tpm", log=True, block_size=5000):
+        """
+        cohort vs cohort fold change, uses (and caches) the cohort statistics of both cohorts
+        :param cohort1: list of cohorts for the numerator
+        :param cohort2: list of cohorts for the denominator
+        :param gene: is this gene or isoform
+        :param what: "TPM"/"FPKM/"counts" or "isopct" for transcripts
+        :param log: if True the fold change is the difference of the mean log2(x+1) values otherwise it is the log2 of
+        the ratio of the means
+        :param block_size: number of genes per block
+        :return: a dataframe of mean1, mean2 and log2_fold_change with genes/transcripts as the index
+        """
+        stats1 = self.cohort_stats(cohort1, gene=gene, what=what, log=log, block_size=block_size)
+        stats2 = self.cohort_stats(cohort2, gene=gene, what=what, log=log, block_size=block_size)
+        results = pd.DataFrame({"mean1": stats1["mean"], "mean2": stats2["mean"]})
+        if log:
+            results["log2_fold_change"] = results["mean1"] - results["mean2"]
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                results["log2_fold_change"] = np.log2(results["mean1"] / results["mean2"])
+        return results
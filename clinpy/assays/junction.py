@@ -1,17 +1,64 @@
 import pandas as pd
-from sqlalchemy import Table, select, and_, or_
+from sqlalchemy import select, and_, or_, func
 import pyranges
-from clinpy.utils.utils import calc_overlap
+from clinpy.utils.utils import calc_overlap, read_regions, create_region_tables, create_id_table, drop_temp_tables
+from clinpy.utils.junction_functions import match_junctions
 import numpy as np
-from clinpy.assays.assay_base import Assay
+from clinpy.assays.assay_base import Assay, fetch_df
+from clinpy.utils.schema import reflected_table
 from functools import partial
 
 
 class Junctions(Assay):
     def __init__(self, db, genome):
-        super.__init__(db, genome)
+        super().__init__(db, genome)
 
-    def select(self, cohort=None, uniq=False, samples=None, df=True, filtered=True):
+    def recurrence_filter(self, id_col, filtered=True, min_samples=None, max_samples=None, cohorts=None):
+        """
+        where clause on the number of samples a junction is found in, this is a primary key lookup in the recurrence
+        table per junction instead of counting the mapping table
+        :param id_col: junction id column of the query
+        :param filtered: junctions or all_junctions
+        :param min_samples: junction needs to be in at least this many samples
+        :param max_samples: junction can be in at most this many samples
+        :param cohorts: only count samples from these cohorts, if None all the samples
+        :return: a sqlalchemy clause
+        """
+        recurrence = self.table("junction_recurrence" if filtered else "alljunction_recurrence")
+        num_samples = select(func.coalesce(func.sum(recurrence.c.num_samples), 0)). \
+            where(recurrence.c.junction == id_col)
+        if cohorts is not None:
+            num_samples = num_samples.where(recurrence.c.cohort.in_(cohorts))
+        num_samples = num_samples.scalar_subquery()
+        clauses = []
+        if min_samples is not None:
+            clauses.append(num_samples >= min_samples)
+        if max_samples is not None:
+            clauses.append(num_samples <= max_samples)
+        return and_(*clauses)
+
+    def recurrence_counts(self, cohort=None, filtered=True):
+        """
+        number of samples and read support of each junction per cohort
+        :param cohort: list of cohorts, if None all of them
+        :param filtered: junctions or all_junctions
+        :return: a dataframe of junction coordinates, cohort, num_samples and total/max uniq_map and multi_map
+        """
+        if filtered:
+            table = self.table("junctions")
+            recurrence = self.table("junction_recurrence")
+        else:
+            table = self.table("all_junctions")
+            recurrence = self.table("alljunction_recurrence")
+        query = select(table.c.id, table.c.chrom, table.c.start, table.c.end, table.c.strand,
+                       *[col for col in recurrence.columns if col.name != "junction"]). \
+            select_from(recurrence.join(table, table.c.id == recurrence.c.junction))
+        if cohort is not None:
+            query = query.filter(recurrence.c.cohort.in_(cohort))
+        return self.fetch_df(query)
+
+    def select(self, cohort=None, uniq=False, samples=None, df=True, filtered=True, min_samples=None,
+               max_samples=None, recurrence_cohort=None):
         """
         returns a dataframe of junctions this is different than the junction class
         instances returned from Sample.junctions
@@ -20,19 +67,20 @@ class Junctions(Assay):
         :param samples: return junctions from those samples
         :param df: return a dataframe otherwise Junction instance
         :param filtered: use the filtered junction table instead of all junctions
+        :param min_samples: only junctions that are in at least this many samples, see recurrence_filter
+        :param max_samples: only junctions that are in at most this many samples
+        :param recurrence_cohort: count samples only in these cohorts for min/max_samples
         :return: a dataframe of junctions and reads mapping to them, if uniq is
         selected mappings will not be there since different samples will have different
         numbers of reads mapping to each junction.
         """
 
         if filtered:
-            table = Table("junctions", self.metadata, autoload=True, autoload_with=self.db)
-            sample_to_junction = Table("sample_to_junction", self.metadata,
-                                       autoload=True, autoload_with=self.db)
+            table = self.table("junctions")
+            sample_to_junction = self.table("sample_to_junction")
         else:
-            table = Table("all_junctions", self.metadata, autoload=True, autoload_with=self.db)
-            sample_to_junction = Table("sample_to_alljunction", self.metadata,
-                                           autoload=True, autoload_with=self.db)
+            table = self.table("all_junctions")
+            sample_to_junction = self.table("sample_to_alljunction")
 
         query = select(table.c.chrom, table.c.start, table.c.end, table.c.strand)
 
@@ -42,11 +90,11 @@ class Junctions(Assay):
             query = query.join(sample_to_junction, table.c.id == sample_to_junction.c.junction)
 
         if cohort is not None:
-            sample_table = Table("samples", self.metadata, autoload=True, autoload_with=self.db)
-            samples = select(sample_table.c.study_id).filter(sample_table.c.cohort.in_(cohort))
+            sample_table = self.table("samples")
+            cohort_samples = select(sample_table.c.sample_id).filter(sample_table.c.cohort.in_(cohort))
 
             junctions = select(sample_to_junction.c.junction).distinct(). \
-                filter(sample_to_junction.c.samplename.in_(samples))
+                filter(sample_to_junction.c.samplename.in_(cohort_samples))
 
             query = query.filter(table.c.id.in_(junctions))
 
@@ -56,60 +104,169 @@ class Junctions(Assay):
 
             query = query.filter(table.c.id.in_(junctions))
 
-        results = self.session.execute(query).fetchall()
-        results = pd.DataFrame(results)
-        results.columns = list(self.session.execute(query).keys())
+        if min_samples is not None or max_samples is not None:
+            query = query.filter(self.recurrence_filter(table.c.id, filtered, min_samples, max_samples,
+                                                        recurrence_cohort))
+
+        results = self.fetch_df(query)
 
         if df:
             return results
         elif not df and not uniq:
             juncs = []
             for chrom, start, end, strand, uniq_map, multi_map in zip(results.chrom, results.start, results.end,
-                                                                      results.strand, results.uniq, results.multi):
+                                                                      results.strand, results.uniq_map,
+                                                                      results.multi_map):
                 juncs.append(Junction(chrom, start, end, strand, uniq_map, multi_map))
-                return juncs
+            return juncs
         else:
             raise NotImplementedError("returning unique junctions as a junction class is not implemented")
 
-    def search(self, gr, samples=None, unique=False, filtered=True):
+    def search(self, gr, samples=None, unique=False, filtered=True, min_samples=None, max_samples=None,
+               recurrence_cohort=None):
         """
-        search a given region for junctions
-        :param gr: a pyranges
+        search a set of regions for junctions, all the regions are searched with a single query by joining a temporary
+        table of the regions (and their bins) to the junctions
+        :param gr: a pyranges with one or more intervals, a dataframe or the path of a bed file see utils.read_regions
+        if there is a strand only junctions on the same strand are returned
         :param samples: sample id, if none search all samples otherwise limit to the list of samples provided an interable
         :param  unique: whether to return unique junctions, sample infomation will not be present, otherwise return
         other data as well
-        :return: a dataframe of junctions that are in a given region
+        :param filtered: search the filtered junctions otherwise all junctions
+        :param min_samples: only junctions that are in at least this many samples, see recurrence_filter
+        :param max_samples: only junctions that are in at most this many samples
+        :param recurrence_cohort: count samples only in these cohorts for min/max_samples
+        :return: a dataframe of junctions that are in a given region, the region column is the row number of the
+        interval the junction overlaps, a junction is reported once for each region it overlaps
         """
         if filtered:
-            junctions = Table("junctions", self.metadata, autoload=True, autoload_with=self.db)
-            sample_to_junction = Table("sample_to_junction", self.metadata,
-                                           autoload=True, autoload_with=self.db)
+            junctions = self.table("junctions")
+            sample_to_junction = self.table("sample_to_junction")
         else:
-            junctions = Table("all_junctions", self.metadata, autoload=True, autoload_with=self.db)
-            sample_to_junction = Table("sample_to_alljunction", self.metadata,
-                                           autoload=True, autoload_with=self.db)
+            junctions = self.table("all_junctions")
+            sample_to_junction = self.table("sample_to_alljunction")
 
-        query = select(junctions.c.chrom, junctions.c.start, junctions.c.end, junctions.c.strand).filter(
-            and_(junctions.c.chrom == str(gr.Chromosomes), junctions.c.strand == str(gr.Strand))).filter(
-            and_(junctions.c.end >= int(gr.Start), junctions.c.start <= int(gr.End)))
+        key, results = self.cache_lookup("search", gr, samples, unique, filtered, min_samples, max_samples,
+                                         recurrence_cohort)
+        if results is not None:
+            return results
 
-        if samples is not None:
-            sample_junctions = select(sample_to_junction.c.junction).filter(
-                sample_to_junction.c.samplename.in_(samples))
-            query = query.filter(junctions.c.id.in_(sample_junctions))
+        conn = self.session.connection()  # temp tables are only visible to the connection that created them
+        region_table, bin_table = create_region_tables(read_regions(gr), conn)
+        # the + 0 keeps sqlite from using the (chrom, start, ...) key index for a range scan instead of the bins
+        overlaps = and_(junctions.c.chrom == region_table.c.chrom,
+                        junctions.c.end >= region_table.c.start, junctions.c.start + 0 <= region_table.c.end,
+                        or_(region_table.c.strand == None, junctions.c.strand == region_table.c.strand))
+        if "bin" in junctions.c:  # the bins narrow the search down to the junctions near the region
+            regions = bin_table.join(region_table, bin_table.c.region == region_table.c.region). \
+                join(junctions, and_(junctions.c.chrom == bin_table.c.chrom, junctions.c.bin == bin_table.c.bin,
+                                     overlaps))
+        else:
+            regions = region_table.join(junctions, overlaps)
+
+        query = select(region_table.c.region, junctions.c.chrom, junctions.c.start, junctions.c.end,
+                       junctions.c.strand).select_from(regions)
 
         if not unique:
             query = query.add_columns(sample_to_junction.c.samplename, sample_to_junction.c.uniq_map,
                                       sample_to_junction.c.multi_map)
             query = query.join(sample_to_junction, junctions.c.id == sample_to_junction.c.junction)
+            if samples is not None:
+                query = query.filter(sample_to_junction.c.samplename.in_(samples))
+        elif samples is not None:
+            sample_junctions = select(sample_to_junction.c.junction).filter(
+                sample_to_junction.c.samplename.in_(samples))
+            query = query.filter(junctions.c.id.in_(sample_junctions))
 
-        results = self.session.execute(query).fetchall()
-        columns = list(self.session.execute(query).keys())
-        results = pd.DataFrame(results)
-        results.columns = columns
+        if min_samples is not None or max_samples is not None:
+            query = query.filter(self.recurrence_filter(junctions.c.id, filtered, min_samples, max_samples,
+                                                        recurrence_cohort))
+
+        order = [region_table.c.region, junctions.c.start, junctions.c.end]
+        if not unique:
+            order.append(sample_to_junction.c.samplename)
+        try:
+            results = self.fetch_df(query.order_by(*order), conn)
+        finally:
+            drop_temp_tables(conn, region_table, bin_table)
+            self.session.commit()  # sqlite keeps a lock on the database until the transaction ends
+        self.cache_store(key, results)
 
         return results
 
+    def recurrence(self, junctions, tolerance=None, overlap=None, reciprocal=False, cohort=None, samples=None,
+                   filtered=True, batch_size=10000):
+        """
+        batch version of Junction.samples, find the junctions in the project that match many junctions at once. The
+        matching is done with numpy one chromosome at a time (see utils.junction_functions.match_junctions) and the
+        samples of all the matches are fetched with a single query
+        :param junctions: a dataframe with chrom, start, end and strand columns (like the output of select) or a list
+        of Junction instances
+        :param tolerance: a tuple how much the start and end can differ, if neither tolerance nor overlap the
+        junctions need to be identical
+        :param overlap: fraction of the junction that needs to be covered, 0 returns junctions that at least touch
+        :param reciprocal: if True reciprocal overlap must be >= overlap value
+        :param cohort: only report samples from these cohorts
+        :param samples: only report these samples
+        :param filtered: search the filtered junctions otherwise all junctions
+        :param batch_size: number of junctions to match at a time
+        :return: a dataframe with one row per query, matching junction and sample. query is the row number of the
+        junction in the input, overlap is the fraction of the query covered by the match and match_overlap is the
+        other way around
+        """
+        if filtered:
+            table = self.table("junctions")
+            sample_to_junction = self.table("sample_to_junction")
+        else:
+            table = self.table("all_junctions")
+            sample_to_junction = self.table("sample_to_alljunction")
+
+        if not isinstance(junctions, pd.DataFrame):
+            junctions = pd.DataFrame([{"chrom": junc.chrom, "start": junc.start, "end": junc.end,
+                                       "strand": junc.strand} for junc in junctions],
+                                     columns=["chrom", "start", "end", "strand"])
+        queries = junctions[["chrom", "start", "end", "strand"]].reset_index(drop=True)
+        queries["chrom"] = queries["chrom"].astype(str)
+
+        matches = []
+        for chrom, chrom_queries in queries.groupby("chrom", sort=False):
+            query = select(table.c.id, table.c.start, table.c.end, table.c.strand).filter(table.c.chrom == chrom)
+            chrom_junctions = self.fetch_df(query)
+            for strand, strand_queries in chrom_queries.groupby("strand", sort=False):
+                candidates = chrom_junctions[chrom_junctions["strand"] == strand]
+                strand_matches = match_junctions(strand_queries, candidates, tolerance, overlap, reciprocal,
+                                                 batch_size)
+                # back to row numbers of the whole input
+                strand_matches["query"] = strand_queries.index.to_numpy()[strand_matches["query"].to_numpy(int)]
+                matches.append(strand_matches)
+
+        columns = ["query", "junction", "chrom", "start", "end", "strand", "overlap", "match_overlap",
+                   "samplename", "uniq_map", "multi_map"]
+        if len(matches) == 0:
+            return pd.DataFrame(columns=columns)
+        matches = pd.concat(matches, ignore_index=True)
+
+        conn = self.session.connection()  # temp tables are only visible to the connection that created them
+        id_table = create_id_table(matches["junction"], conn)
+        query = select(table.c.id, table.c.chrom, table.c.start, table.c.end, table.c.strand,
+                       sample_to_junction.c.samplename, sample_to_junction.c.uniq_map,
+                       sample_to_junction.c.multi_map). \
+            select_from(id_table.join(table, table.c.id == id_table.c.id).
+                        join(sample_to_junction, sample_to_junction.c.junction == table.c.id))
+        if cohort is not None:
+            query = query.filter(sample_to_junction.c.samplename.in_(
+                select(self.sample_table.c.sample_id).filter(self.sample_table.c.cohort.in_(cohort))))
+        if samples is not None:
+            query = query.filter(sample_to_junction.c.samplename.in_(samples))
+        try:
+            mappings = self.fetch_df(query, conn)
+        finally:
+            drop_temp_tables(conn, id_table)
+            self.session.commit()
+
+        results = matches.merge(mappings.rename(columns={"id": "junction"}), on="junction", how="inner")
+        return results[columns].sort_values(["query", "junction", "samplename"]).reset_index(drop=True)
+
     #TODO
     def filter(self, junc_func, skip_existing=True, **kwargs):
         """
@@ -156,18 +313,15 @@ class Junction:
         :param genome: genome class instance
         :return: genes that match the start and end of the junction and if there are other genes in the middle
         """
-        table = Table("genes", genome.metadata, autoload=True, autoload_with=genome)
+        table = reflected_table("genes", genome.metadata, genome.db)
         # find the start and end genes, there might be others in between
         query = select(table).filter(and_(table.c.chrom == self.chrom,
                                                   table.c.strand == self.strand)). \
             filter(or_(and_(table.c.start <= self.start, table.c.end >= self.start),
                            and_(table.c.start <= self.end, table.c.end >= self.end)))
 
-        results=genome.session.execute(query).fetchall()
-        if len(results)>0:
-            results = pd.DataFrame(results)
-            results.columns = list(genome.session.execute(query).keys())
-        else:
+        results = fetch_df(genome.session, query)
+        if results.shape[0] == 0:
             return None
 
         if df:
@@ -193,9 +347,8 @@ class Junction:
         :return: a pyranges or dataframe with all the transcript that match the description.
         """
 
-        gene_table = Table("genes", genome.metadata, autoload=True, autoload_with=genome)
-        tx_table = Table("transcripts", genome.metadata,
-                             autoload=True, autoload_with=genome)
+        gene_table = reflected_table("genes", genome.metadata, genome.db)
+        tx_table = reflected_table("transcripts", genome.metadata, genome.db)
 
         subq = select(gene_table.c.id, gene_table.c.chrom, gene_table.c.strand).subquery()
         query = select(tx_table, subq.c.chrom, subq.c.strand). \
@@ -207,11 +360,8 @@ class Junction:
         if biotype is not None:
             query = query.where(tx_table.c.biotype.in_(biotype))
 
-        results = genome.session.execute(query).fetchall()
-        if len(results)>0:
-            results = pd.DataFrame(results)
-            results.columns = genome.session.execute(query).keys()
-        else:
+        results = fetch_df(genome.session, query)
+        if results.shape[0] == 0:
             return None
 
         if df:
@@ -273,9 +423,8 @@ class Junction:
         :param return_junctions: if True return a tuple with sample id and list of junctions that match
         :return:
         """
-        junctions_table = Table("junctions", project.metadata, autoload=True, autoload_with=project)
-        sample_to_junction = Table("sample_to_junction", project.metadata, autoload=True,
-                                       autoload_with=project)
+        junctions_table = project.table("junctions")
+        sample_to_junction = project.table("sample_to_junction")
         subq = select(junctions_table.c.id).filter(and_(junctions_table.c.chrom == self.chrom,
                                                                 junctions_table.c.strand == self.strand))
         if overlap is None:
@@ -288,8 +437,7 @@ class Junction:
 
             query = select(sample_to_junction.c.samplename, sample_to_junction.c.junction,
                                sample_to_junction.c.uniq_map, sample_to_junction.c.multi_map).where(sample_to_junction.c.junction.in_(subq))
-            samples_junctions = project.session.execute(query).fetchall()
-            columns = list(project.session.execute(query).keys())
+            samples_junctions = fetch_df(project.session, query)
 
         else:
             if tolerance is not None:
@@ -317,19 +465,13 @@ class Junction:
                                           sample_to_junction.c.uniq_map, sample_to_junction.c.multi_map).where(
                     sample_to_junction.c.junction.in_(overlapping))
 
-                samples_junctions = project.session.execute(sample_query).fetchall()
-                columns = list(project.session.execute(sample_query).keys())
-
-        samples_junctions=pd.DataFrame(samples_junctions)
-        samples_junctions.columns=columns
+                samples_junctions = fetch_df(project.session, sample_query)
 
         if return_junctions:
             junc_ids=samples_junctions["junction"].drop_duplicates().to_list()
             junc_coords_q=select(junctions_table.c.id, junctions_table.c.chrom, junctions_table.c.start,
                                   junctions_table.c.end, junctions_table.c.strand).filter(junctions_table.c.id.in_(junc_ids))
-            junc_coords=project.session.execute(junc_coords_q).fetchall()
-            junc_coords=pd.DataFrame(junc_coords)
-            junc_coords.columns = list(project.session.execute(junc_coords_q).keys())
+            junc_coords = fetch_df(project.session, junc_coords_q)
 
             samples_junctions=samples_junctions.merge(junc_coords, how="left", left_on="junction", right_on="id")
             return samples_junctions
@@ -1,6 +1,7 @@
 import pandas as pd
-from sqlalchemy import Table, select, update, func
+from sqlalchemy import select, update, func
 from clinpy.assays.assay_base import Assay
+from clinpy.utils.query_cache import bump_generation
 
 
 class Project(Assay):
@@ -10,7 +11,7 @@ class Project(Assay):
 
 
     def view_meta_fields(self):
-        table = Table("samples", self.metadata, autoload=True, autoload_with=self.db)
+        table = self.table("samples")
         query=select(table.c.sample_meta)
         fields=self.session.execute(query).fetchone()
         fields=list(fields[0].keys())
@@ -23,14 +24,12 @@ class Project(Assay):
         :param cohort: name of the cohort if none all samples an interable
         :return:
         """
-        table = Table("samples", self.metadata, autoload=True, autoload_with=self.db)
+        table = self.table("samples")
         query = select(table.c.study_id, table.c.tm_id, table.c.cohort, table.c.user_annot)
         if cohort is not None:
             query = query.where(table.c.cohort.in_(cohort))
 
-        results = self.session.execute(query).fetchall()
-        results = pd.DataFrame(results)
-        results.columns = list(self.session.execute(query).keys())
+        results = self.fetch_df(query)
 
         mandatory=results.loc[:,["sample_id", "cohort"]]
         others=pd.DataFrame.from_records(results.sample_meta.to_list())
@@ -46,18 +45,20 @@ class Project(Assay):
         :param annot: dict of annotations
         :return: nothing adds the dict to the json field of either gene or transcript table
         """
-        table = Table("samples", self.metadata, autoload=True, autoload_with=self.db)
+        table = self.table("samples")
 
         command = update(table).values(sample_meta={"user_annot": annot}).where(table.c.sample_id == to)
         self.session.execute(command)
         self.session.commit()
+        if self.table("project_info", required=False) is not None:  # cached results might have the old annotation
+            bump_generation(self.db)
 
 
     def __str__(self):
         """
         :return: summary stats, number of sample in each cohort
         """
-        table = Table("samples", self.metadata, autoload=True, autoload_with=self.db)
+        table = self.table("samples")
         query = select(table.c.cohort, func.count(table.c.cohort)).group_by(table.c.cohort)
         results = pd.DataFrame(self.session.execute(query).fetchall())
         cohorts = ",".join([str(x) for x in results[0].to_list()])
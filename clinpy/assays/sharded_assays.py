@@ -0,0 +1,287 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+from clinpy.assays.junction import Junction, Junctions
+from clinpy.assays.variants import Variants
+from clinpy.utils.genotype_matrix import stack_matrices
+from clinpy.utils.snp_functions import ALL_COHORTS, NO_COHORT
+from clinpy.utils.shards import attach_shard, shard_engine
+from clinpy.utils.utils import read_regions
+
+
+def merge_frames(frames, unique=False, sort=None):
+    """
+    put the results of the shards together
+    :param frames: list of dataframes or None
+    :param unique: drop rows that came from more than one shard, for results that do not have sample level data of a
+    project sharded by cohort
+    :param sort: columns to sort by, the order of the rows within a shard stays the same
+    :return: a dataframe or None if all of them are None
+    """
+    frames = [frame for frame in frames if frame is not None]
+    if len(frames) == 0:
+        return None
+    # empty results do not have the column types
+    results = pd.concat([frame for frame in frames if frame.shape[0] > 0] or frames[:1], ignore_index=True)
+    if unique:
+        results = results.drop_duplicates(ignore_index=True)
+    if sort is not None:
+        results = results.sort_values(sort, kind="stable", ignore_index=True)
+    return results
+
+
+class ShardedAssay:
+    """
+    an assay of a project that was split into shards with shard_project.py. The queries are run by the methods of the
+    regular assay class (assay_class) on a connection to the catalog with one shard attached, tables are not
+    qualified in the queries so sqlite finds them in the catalog or in the shard. Region searches only go to the shards
+    of the chromosomes in the regions, everything else runs on every shard that can have results at the same time in a
+    thread pool and the results are put together. The query cache of the assays is not used, the cache keys are the
+    same for every shard
+    """
+    assay_class = None
+
+    def __init__(self, catalog, *args, immutable=False, workers=None, **kwargs):
+        """
+        :param catalog: path of the catalog database made by shard_project.py
+        :param args: the rest of the arguments of assay_class
+        :param immutable: open the databases with immutable=1, see utils.read_engine
+        :param workers: number of shards that are queried at the same time, all of them by default
+        :param kwargs: same as args
+        """
+        self.db, self.by, self.shards = shard_engine(catalog, immutable)
+        self.immutable = immutable
+        self.workers = len(self.shards) if workers is None else workers
+        self.assay = self.assay_class(self.db, *args, **kwargs)
+        # the session of the calling thread is replaced for each call, see run
+        self.assay.session = scoped_session(sessionmaker(bind=self.db))
+        with self.db.connect() as conn:
+            samples = self.assay.sample_table
+            # sample ids are compared as strings, the mapping tables and the callers do not always use the same type
+            self.sample_cohorts = {str(sample): cohort for sample, cohort in conn.execute(
+                select(samples.c.sample_id, func.coalesce(samples.c.cohort, NO_COHORT)))}
+
+    def table(self, name, required=True):
+        """
+        see Assay.table, the tables of the shards are in there too
+        """
+        return self.assay.table(name, required)
+
+    def route(self, chroms=None, cohorts=None, samples=None):
+        """
+        the shards a query needs to go to
+        :param chroms: chromosomes the query is about, if the project is sharded by chromosome
+        :param cohorts: cohorts the query is about, if the project is sharded by cohort
+        :param samples: samples the query is about, if the project is sharded by cohort
+        :return: list of shard paths, at least one so the methods return what they return when nothing is found
+        """
+        keys = None
+        if self.by == "chrom" and chroms is not None:
+            keys = {str(chrom) for chrom in chroms}
+        elif self.by == "cohort" and (cohorts is not None or samples is not None):
+            keys = set(cohorts) if cohorts is not None else None
+            if samples is not None:
+                sample_keys = {self.sample_cohorts.get(str(sample)) for sample in samples}
+                keys = sample_keys if keys is None else keys & sample_keys
+        if keys is None:
+            return list(self.shards.keys())
+        shards = [shard for shard, shard_keys in self.shards.items() if len(keys.intersection(shard_keys)) > 0]
+        return shards if len(shards) > 0 else list(self.shards.keys())[:1]
+
+    def run(self, shard, method, *args, **kwargs):
+        """
+        call a method of the assay on one shard
+        :param shard: path of the shard
+        :param method: name of the method
+        :param args: arguments of the method
+        :param kwargs: keyword arguments of the method
+        :return: whatever the method returns
+        """
+        with self.db.connect() as conn:
+            attach_shard(conn, shard, self.immutable)
+            session = Session(bind=conn)
+            self.assay.session.registry.set(session)
+            try:
+                return getattr(self.assay, method)(*args, **kwargs)
+            finally:
+                self.assay.session.registry.clear()
+                session.close()
+
+    def parallel(self, function, shards):
+        """
+        call a function for several shards at the same time
+        :param function: function that gets the path of a shard
+        :param shards: list of shard paths, see route
+        :return: list of what the function returned for each shard, in the same order as shards
+        """
+        if len(shards) == 1:
+            return [function(shards[0])]
+        with ThreadPoolExecutor(min(self.workers, len(shards))) as pool:
+            return list(pool.map(function, shards))
+
+    def fan_out(self, shards, method, *args, **kwargs):
+        """
+        call a method of the assay on several shards at the same time, see parallel
+        :param shards: list of shard paths, see route
+        :param method: name of the method
+        :param args: arguments of the method
+        :param kwargs: keyword arguments of the method
+        :return: list of what the method returned for each shard, in the same order as shards
+        """
+        return self.parallel(lambda shard: self.run(shard, method, *args, **kwargs), shards)
+
+    def close(self):
+        """
+        close the connections of the catalog
+        :return: nothing
+        """
+        self.db.dispose()
+
+
+class ShardedJunctions(ShardedAssay):
+    assay_class = Junctions
+
+    def select(self, cohort=None, uniq=False, samples=None, df=True, filtered=True, min_samples=None,
+               max_samples=None, recurrence_cohort=None):
+        """
+        see Junctions.select. cohort and samples pick the junctions but the rows of every sample are returned, by
+        cohort the other samples of those junctions are in other shards. The junctions are found in the shards of
+        the cohorts and of the samples and then their rows are fetched from every shard with an exact recurrence
+        search
+        """
+        if self.by == "chrom" or (cohort is None and samples is None):
+            results = self.fan_out(self.route(cohorts=cohort, samples=samples), "select", cohort, uniq, samples, df,
+                                   filtered, min_samples, max_samples, recurrence_cohort)
+            if not df:
+                return [junction for shard_results in results for junction in shard_results]
+            return merge_frames(results, unique=uniq and self.by == "cohort")
+        if uniq and not df:
+            raise NotImplementedError("returning unique junctions as a junction class is not implemented")
+
+        # a junction has to be in the cohorts and in the samples, not necessarily in the same shard
+        junctions = None
+        for cohorts, names in [(cohort, None), (None, samples)]:
+            if cohorts is None and names is None:
+                continue
+            found = merge_frames(self.fan_out(self.route(cohorts=cohorts, samples=names), "select", cohorts, True,
+                                              names, True, filtered, min_samples, max_samples, recurrence_cohort),
+                                 unique=True)
+            junctions = found if junctions is None else junctions.merge(found)
+        if uniq:
+            return junctions
+
+        results = self.fan_out(list(self.shards.keys()), "recurrence", junctions, None, None, False, None, None,
+                               filtered)
+        columns = ["chrom", "start", "end", "strand", "samplename", "uniq_map", "multi_map"]
+        results = merge_frames(results, sort=["junction", "samplename"])[columns]
+        if not df:
+            return [Junction(chrom, start, end, strand, uniq_map, multi_map) for chrom, start, end, strand, uniq_map,
+                    multi_map in zip(results.chrom, results.start, results.end, results.strand, results.uniq_map,
+                                     results.multi_map)]
+        return results
+
+    def search(self, gr, samples=None, unique=False, filtered=True, min_samples=None, max_samples=None,
+               recurrence_cohort=None):
+        """
+        see Junctions.search, only the shards of the chromosomes in gr are searched
+        """
+        regions = read_regions(gr)
+        results = self.fan_out(self.route(chroms=regions["chrom"].unique(), samples=samples), "search", regions,
+                               samples, unique, filtered, min_samples, max_samples, recurrence_cohort)
+        sort = ["region", "start", "end"] if unique else ["region", "start", "end", "samplename"]
+        return merge_frames(results, unique=unique and self.by == "cohort", sort=sort)
+
+    def recurrence(self, junctions, tolerance=None, overlap=None, reciprocal=False, cohort=None, samples=None,
+                   filtered=True, batch_size=10000):
+        """
+        see Junctions.recurrence, only the shards of the chromosomes of the junctions are searched
+        """
+        if not isinstance(junctions, pd.DataFrame):
+            junctions = pd.DataFrame([{"chrom": junc.chrom, "start": junc.start, "end": junc.end,
+                                       "strand": junc.strand} for junc in junctions],
+                                     columns=["chrom", "start", "end", "strand"])
+        junctions = junctions.reset_index(drop=True)
+        junctions["chrom"] = junctions["chrom"].astype(str)
+
+        def shard_recurrence(shard):
+            # by chromosome each shard only gets the junctions of its chromosomes, query is the row number of the
+            # junction in the whole input again afterwards
+            queries = junctions[junctions["chrom"].isin(self.shards[shard])] if self.by == "chrom" else junctions
+            results = self.run(shard, "recurrence", queries.reset_index(drop=True), tolerance, overlap, reciprocal,
+                               cohort, samples, filtered, batch_size)
+            results["query"] = queries.index.to_numpy()[results["query"].to_numpy(int)]
+            return results
+
+        results = self.parallel(shard_recurrence, self.route(chroms=junctions["chrom"].unique(), cohorts=cohort,
+                                                             samples=samples))
+        return merge_frames(results, sort=["query", "junction", "samplename"])
+
+    def recurrence_counts(self, cohort=None, filtered=True):
+        """
+        see Junctions.recurrence_counts, by cohort the recurrence tables are in the catalog
+        """
+        shards = self.route() if self.by == "chrom" else list(self.shards.keys())[:1]
+        return merge_frames(self.fan_out(shards, "recurrence_counts", cohort, filtered))
+
+
+class ShardedVariants(ShardedAssay):
+    assay_class = Variants
+
+    def list_impacts(self):
+        """
+        see Variants.list_impacts
+        """
+        return self.run(list(self.shards.keys())[0], "list_impacts")
+
+    def list_variant_quals(self):
+        """
+        see Variants.list_variant_quals
+        """
+        return self.run(list(self.shards.keys())[0], "list_variant_quals")
+
+    def filter(self, impacts=None, formats=None, min_af=None, max_af=None, af_cohort=ALL_COHORTS):
+        """
+        see Variants.filter, by cohort only the format filters need the shards
+        """
+        shards = self.route()
+        if self.by == "cohort" and formats is None:
+            shards = shards[:1]
+        return merge_frames(self.fan_out(shards, "filter", impacts, formats, min_af, max_af, af_cohort),
+                            unique=self.by == "cohort")
+
+    def search_region(self, gr, samples=None):
+        """
+        see Variants.search_region, only the shards of the chromosomes in gr are searched
+        """
+        regions = read_regions(gr)
+        results = self.fan_out(self.route(chroms=regions["chrom"].unique(), samples=samples), "search_region",
+                               regions, samples)
+        return merge_frames(results, sort=["region", "pos"])
+
+    def variant_samples(self, cohort=None, samples=None):
+        """
+        see Variants.variant_samples
+        """
+        if isinstance(cohort, str):
+            cohort = [cohort]
+        results = self.fan_out(self.route(cohorts=cohort, samples=samples), "variant_samples", cohort, samples)
+        return sorted({sample for shard_samples in results for sample in shard_samples})
+
+    def genotype_matrix(self, field="gt", gr=None, samples=None, cohort=None, matrix_format="csr",
+                        chunk_size=100000):
+        """
+        see Variants.genotype_matrix, each shard makes the matrix of its variants or samples and they are put
+        together with utils.genotype_matrix.stack_matrices. There is no cache argument
+        """
+        if isinstance(cohort, str):
+            cohort = [cohort]
+        chroms = None
+        if gr is not None:
+            gr = read_regions(gr)
+            chroms = gr["chrom"].unique()
+        results = self.fan_out(self.route(chroms=chroms, cohorts=cohort, samples=samples), "genotype_matrix", field,
+                               gr, samples, cohort, matrix_format, None, chunk_size)
+        return stack_matrices(results, matrix_format)
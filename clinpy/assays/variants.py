@@ -1,8 +1,10 @@
 import pandas as pd
-from sqlalchemy import Table, select, and_, func, distinct
+from sqlalchemy import select, and_, func, distinct, case, Integer, Float, Boolean
 from clinpy.assays.assay_base import Assay
 from sqlalchemy_filters import apply_filters
-from clinpy.utils.snp_functions import add_to_variant_tables
+from clinpy.utils.snp_functions import add_to_variant_tables, alt_dosage, ALL_COHORTS
+from clinpy.utils.utils import read_regions, create_region_tables, drop_temp_tables
+from clinpy.utils.genotype_matrix import MATRIX_TYPES, sparse_from_chunks, save_matrix, load_matrix
 
 class Variants(Assay):
     def __init__(self, db, rna=False, filtered=False):
@@ -15,24 +17,29 @@ class Variants(Assay):
         :param rna: are you referring to RNA-Seq variants
         :param filtered: are referring to filtered variants
         """
-        super.__init__(db)
+        super().__init__(db)
         table = "variants"
         mapping = "sample_variants"
         impacts = "variant_impacts"
+        counts = "variant_counts"
 
         if rna:
             table = "rna_" + table
             mapping = "rna_" + mapping
             impacts = "rna_" + impacts
+            counts = "rna_" + counts
 
         if filtered:
             table = "filtered_" + table
             mapping = "filtered_" + mapping
             impacts = "filtered_" + impacts
+            counts = "filtered_" + counts
 
-        self.variants_table = Table(table, self.metadata, autoload=True, autoload_with=self.db)
-        self.mapping_table = Table(mapping, self.metadata, autoload=True, autoload_with=self.db)
-        self.impacts_table = Table(impacts, self.metadata, autoload=True, autoload_with=self.db)
+        self.variants_table = self.table(table)
+        self.mapping_table = self.table(mapping)
+        self.impacts_table = self.table(impacts)
+        # None for projects that were created before the counts tables
+        self.counts_table = self.table(counts, required=False)
         self.rna=rna
 
     def list_impacts(self):
@@ -50,64 +57,192 @@ class Variants(Assay):
         return list(self.mapping_table.columns.keys())
 
     #TODO need a more memory efficient way to get this done
-    def filter(self, impacts=None, formats=None):
+    def af_filter(self, min_af=None, max_af=None, cohort=ALL_COHORTS):
+        """
+        allele frequency filter on the variant counts table, both bounds are range scans on the (cohort, af) index.
+        Variants that are not in the counts table for a cohort have an af of 0 there so max_af is done as a NOT IN
+        :param min_af: af >= min_af
+        :param max_af: af < max_af
+        :param cohort: cohort name, "all" for all samples
+        :return: a list of sqlalchemy filter expressions on the variant_id
+        """
+        if self.counts_table is None:
+            raise ValueError("there is no variant counts table in this project, add samples to create it")
+        counts = self.counts_table
+        filters = []
+        if min_af is not None:
+            filters.append(self.variants_table.c.variant_id.in_(
+                select(counts.c.variant_id).where(and_(counts.c.cohort == cohort, counts.c.af >= min_af))))
+        if max_af is not None:
+            filters.append(self.variants_table.c.variant_id.not_in(
+                select(counts.c.variant_id).where(and_(counts.c.cohort == cohort, counts.c.af >= max_af))))
+        return filters
+
+    def filter(self, impacts=None, formats=None, min_af=None, max_af=None, af_cohort=ALL_COHORTS):
         """
         filter unfiltered variants, the filters need to be a dict where the key is the field name and value is what you are searching for
         for categorical need to provide a list for numerircal if you want exact values you can provide a list again if you want comparisons
         you would need to provide
         :param impacts: impact filters a SQLAlchem filters json
         :param formats: same for fomat fields
-        :param save: save results to "filtered variants table(s).
+        :param min_af: minimum allele frequency in af_cohort, see af_filter
+        :param max_af: allele frequency in af_cohort needs to be smaller than this, see af_filter
+        :param af_cohort: cohort for the allele frequency filters, by default all samples
         :return: a dataframe of variants with all the applicable columns
         """
         #TODO put it back in the database
-        query=select(self.variants_table).join(self.impacts_table).join(self.impacts_table)
+        query=select(self.variants_table)
 
-        if impacts is None and formats is None:
-            raise ValueError("Both impacts and formats are none, there are no filters specified")
+        if impacts is None and formats is None and min_af is None and max_af is None:
+            raise ValueError("impacts, formats and allele frequencies are none, there are no filters specified")
 
         if impacts is not None:
+            query=query.join(self.impacts_table)
             query=apply_filters(query, impacts)
 
         if formats is not None:
+            query=query.join(self.mapping_table)
             query=apply_filters(query, formats)
 
-        # if too many variants are there this might fail but not sure how many is too many
-        variants=self.session.execute(query).fetchall()
-        variants=pd.DataFrame(variants)
-        variants.columns=self.session.execute(query).keys()
+        for af_filter in self.af_filter(min_af, max_af, af_cohort) if min_af is not None or max_af is not None \
+                else []:
+            query=query.filter(af_filter)
 
-        return variants
+        # if too many variants are there this might fail but not sure how many is too many
+        return self.fetch_df(query)
 
     def search_region(self, gr, samples=None):
         """
-        search a given genomic region for variants
-        :param gr: a pyranges object strand is ignored if there
+        search a set of genomic regions for variants, all the regions are searched with a single query by joining a
+        temporary table of the regions to the variants. Variants are points so the (chrom, pos, ...) key index is
+        already a range seek per region, unlike junctions they do not have bins
+        :param gr: a pyranges with one or more intervals, a dataframe or the path of a bed file see utils.read_regions
+        strand is ignored if there
         :param samples search specific samples for variants
-        :return: a dataframe of variants and impact, a variant may have more than one impact
+        :return: a dataframe of variants and format fields, the region column is the row number of the interval the
+        variant is in, None if there are no variants
         """
         format_cols = self.list_variant_quals()[1:]
+        key, results = self.cache_lookup("search_region", self.mapping_table.name, gr, samples)
+        if results is not None:
+            return results
+
+        conn = self.session.connection()  # temp tables are only visible to the connection that created them
+        region_table, _ = create_region_tables(read_regions(gr), conn, bins=False)
+        overlaps = and_(self.variants_table.c.chrom == region_table.c.chrom,
+                        self.variants_table.c.pos >= region_table.c.start,
+                        self.variants_table.c.pos <= region_table.c.end)
+        regions = region_table.join(self.variants_table, overlaps)
 
-        query = select(self.variants_table).filter(and_(self.variants_table.c.pos <= int(gr.Start),
-                                                        self.variants_table.c.pos >= int(gr.End)),
-                                                   self.variants_table.c.chrom == gr.Chromosomes). \
+        query = select(region_table.c.region, self.variants_table).select_from(regions). \
             join(self.mapping_table, self.mapping_table.c.variant_id == self.variants_table.c.variant_id). \
             add_columns(*[self.mapping_table.c[col] for col in format_cols])
 
         if samples is not None:
-            query.filter(self.mapping_table.c.variant_id.in_(samples))
+            query = query.filter(self.mapping_table.c.samplename.in_(samples))
 
-        results = self.session.execute(query).fetchall()
+        try:
+            results = self.fetch_df(query.order_by(region_table.c.region, self.variants_table.c.pos), conn)
+        finally:
+            drop_temp_tables(conn, region_table)
+            self.session.commit()  # ends the transaction the temp tables started, it locks out writers
 
-        if len(results) > 0:
-            results = pd.DataFrame(results)
-            colnames = self.session.execute(query).keys()
-            results.columns = colnames
-        else:
+        if results.shape[0] == 0:
             results = None
+        self.cache_store(key, results)
 
         return results
 
+    def variant_samples(self, cohort=None, samples=None):
+        """
+        samples that have variants
+        :param cohort: a cohort or a list of cohorts
+        :param samples: specific samples
+        :return: sorted list of sample names
+        """
+        if isinstance(cohort, str):
+            cohort = [cohort]
+        query = select(self.mapping_table.c.samplename).distinct().order_by(self.mapping_table.c.samplename)
+        if cohort is not None:
+            query = query.where(self.mapping_table.c.samplename.in_(
+                select(self.sample_table.c.sample_id).where(self.sample_table.c.cohort.in_(cohort))))
+        if samples is not None:
+            query = query.where(self.mapping_table.c.samplename.in_(samples))
+        return self.session.execute(query).scalars().all()
+
+    def genotype_matrix(self, field="gt", gr=None, samples=None, cohort=None, matrix_format="csr", cache=None,
+                        chunk_size=100000):
+        """
+        a variant x sample scipy sparse matrix of the genotype dosage or another numeric format field. The sample
+        variants table is streamed in variant order and only the non-zero entries are kept so this never goes through a
+        long dataframe or a pivot. Samples that do not have a variant and missing (NULL) values are 0
+        :param field: "gt" for the number of alt alleles or any numeric column of the sample variants table, see
+        list_variant_quals
+        :param gr: only the variants in these regions, see search_region
+        :param samples: specific samples
+        :param cohort: a cohort or a list of cohorts
+        :param matrix_format: "csr" or "csc"
+        :param cache: path of a .npz file, if it was made with the same arguments from the same data it is loaded
+        instead, otherwise the matrix is saved there
+        :param chunk_size: number of rows to fetch at a time
+        :return: the sparse matrix, a numpy array of variant ids (rows) and a numpy array of samplenames (columns)
+        """
+        if field not in self.mapping_table.c:
+            raise ValueError("{} is not a column of {}".format(field, self.mapping_table.name))
+        column = self.mapping_table.c[field]
+        if field == "gt":
+            value, dtype = alt_dosage(column), MATRIX_TYPES["gt"]
+        elif isinstance(column.type, Boolean):
+            value, dtype = column, MATRIX_TYPES["bool"]
+        elif isinstance(column.type, Integer):
+            value, dtype = column, MATRIX_TYPES["int"]
+        elif isinstance(column.type, Float):
+            value, dtype = column, MATRIX_TYPES["float"]
+        else:
+            raise ValueError("{} is not a numeric column".format(field))
+        if matrix_format not in ["csr", "csc"]:
+            raise ValueError("matrix_format can only be 'csr' or 'csc'")
+        if isinstance(cohort, str):
+            cohort = [cohort]
+
+        if cache is not None:
+            regions = None if gr is None else read_regions(gr)[["chrom", "start", "end"]].values.tolist()
+            key = {"table": self.mapping_table.name, "field": field, "regions": regions,
+                   "samples": None if samples is None else sorted([str(sample) for sample in samples]),
+                   "cohort": None if cohort is None else sorted(cohort), "format": matrix_format,
+                   "rows": self.session.execute(select(func.count()).select_from(self.mapping_table)).scalar()}
+            cached = load_matrix(cache, key)
+            if cached is not None:
+                return cached
+
+        columns = self.variant_samples(cohort, samples)
+        query = select(self.mapping_table.c.variant_id, self.mapping_table.c.samplename, value). \
+            where(and_(value != None, value != 0)).order_by(self.mapping_table.c.variant_id)
+        if cohort is not None or samples is not None:
+            query = query.where(self.mapping_table.c.samplename.in_(columns))
+
+        conn = self.session.connection()  # temp tables are only visible to the connection that created them
+        temp_tables = []
+        try:
+            if gr is not None:
+                region_table, _ = create_region_tables(read_regions(gr), conn, bins=False)
+                temp_tables = [region_table]
+                overlaps = and_(self.variants_table.c.chrom == region_table.c.chrom,
+                                self.variants_table.c.pos >= region_table.c.start,
+                                self.variants_table.c.pos <= region_table.c.end)
+                query = query.where(self.mapping_table.c.variant_id.in_(
+                    select(self.variants_table.c.variant_id).select_from(region_table.join(self.variants_table,
+                                                                                            overlaps))))
+            results = conn.execution_options(stream_results=True).execute(query)
+            matrix = sparse_from_chunks(results.partitions(chunk_size), columns, dtype, matrix_format)
+        finally:
+            drop_temp_tables(conn, *temp_tables)
+            self.session.commit()
+
+        if cache is not None:
+            save_matrix(cache, *matrix, key)
+        return matrix
+
     def __str__(self):
         num_samples = self.session.query(func.count(distinct(self.mapping_table.c.samplename)))
         num_variants = self.session.query(func.count(self.variants_table.c.variant_id))
@@ -126,47 +261,60 @@ class Variant(Variants):
     """
 
     def __init__(self, project, rna, filtered, variant_id, chrom, pos, ref, alt):
-        self.id=variant_id,
+        self.id=variant_id
         self.chrom=chrom
         self.pos=pos
         self.ref=ref
         self.alt=alt
         super().__init__(project, rna, filtered)
 
-    #TODO
-    @property
     def counts(self, samples=None, cohort=None):
-        ac_query=None
-        af_query=None
-        num_hets=None
-        num_homs=None
-        pass
+        """
+        allele count, allele number, allele frequency and number of het/hom-alt samples. Cohorts come from the
+        precomputed variant counts table, a list of samples is counted from the sample variants table
+        :param samples: list of samplenames, samples that do not have the variant count as homozygous reference
+        :param cohort: cohort name, if neither this nor samples are given all the cohorts (and "all") are returned
+        :return: a dataframe with cohort, ac, an, af, num_het and num_hom columns
+        """
+        if samples is not None:
+            dosage = alt_dosage(self.mapping_table.c.gt)
+            query = select(func.coalesce(func.sum(dosage), 0), func.coalesce(func.sum(case((dosage == 1, 1), else_=0)), 0),
+                           func.coalesce(func.sum(case((dosage == 2, 1), else_=0)), 0)). \
+                filter(and_(self.mapping_table.c.variant_id == self.id, self.mapping_table.c.samplename.in_(samples)))
+            ac, num_het, num_hom = self.session.execute(query).fetchone()
+            an = 2 * len(set(samples))
+            return pd.DataFrame({"cohort": [None], "ac": [ac], "an": [an], "af": [ac / an if an > 0 else None],
+                                 "num_het": [num_het], "num_hom": [num_hom]})
 
-    @property
-    def samples(self, cohort=None, genotype="both"):
-        query=select(self.mapping_table).filter(self.mapping_table.c.variant_id==self.id)
-        results = self.session.execute(query).fetchall()
-        results = pd.DataFrame(results)
-        results.columns = self.session.execute(query).keys()
+        if self.counts_table is None:
+            raise ValueError("there is no variant counts table in this project, add samples to create it")
+        query = select(*[self.counts_table.c[col] for col in ["cohort", "ac", "an", "af", "num_het", "num_hom"]]). \
+            filter(self.counts_table.c.variant_id == self.id)
+        if cohort is not None:
+            query = query.filter(self.counts_table.c.cohort == cohort)
+        return self.fetch_df(query)
 
-        if genotype=="both":
-            return results
-        elif genotype=="hom":
-            results=results[results["GT"]=="(1, 1)"]
-            return results
+    def samples(self, genotype="both"):
+        """
+        samples that have the variant
+        :param genotype: "both", "het" or "hom" (hom alt)
+        :return: a dataframe of the sample variants rows
+        """
+        query=select(self.mapping_table).filter(self.mapping_table.c.variant_id==self.id)
+        dosage=alt_dosage(self.mapping_table.c.gt)
+        if genotype=="hom":
+            query=query.filter(dosage==2)
         elif genotype=="het":
-            results = results[results["GT"] == "(0, 1)"]
-            return results
+            query=query.filter(dosage==1)
+        elif genotype!="both":
+            raise ValueError("genotype can only be 'both', 'het' or 'hom'")
+        return self.fetch_df(query)
 
 
     @property
     def impact(self):
         query=select(self.impacts_table).filter(self.impacts_table.c.variant_id==self.id)
-        results=self.session.execute(query).fetchall()
-        results=pd.DataFrame(results)
-        results.columns=self.session.execute(query).keys()
-
-        return results
+        return self.fetch_df(query)
 
     def __str__(self):
         return "A variant in {}:{} with from {} to {}".format(self.chrom, self.pos,
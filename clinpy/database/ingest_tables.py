@@ -0,0 +1,38 @@
+from sqlalchemy import Column, Sequence, Integer, String, Float, DateTime, Index, LargeBinary
+
+from clinpy.database.base_tables import ProjectBase
+
+
+class LoadManifest(ProjectBase):  # one row per file that made it into the database, this is how a load is resumed
+    __tablename__ = "load_manifest"
+    __table_args__ = (Index("ix_load_manifest_key", "samplename", "dat_type", unique=True),)
+    id = Column(Integer, Sequence("load_manifest_id_seq"), primary_key=True, autoincrement=True)
+    samplename = Column(String)
+    modality = Column(String)
+    dat_type = Column(String, index=True)  # the column name in the files table
+    file = Column(String)
+    size = Column(Integer)
+    mtime = Column(Float)
+    checksum = Column(String)
+    rows = Column(Integer)
+    stage = Column(String)  # staged: in a temp table waiting to be normalized, done: in its final table
+    updated = Column(DateTime)
+
+
+class ProjectInfo(ProjectBase):  # project level key/value state like the generation counter, see utils.query_cache
+    __tablename__ = "project_info"
+    name = Column(String, primary_key=True)
+    value = Column(Integer)
+
+
+class SchemaSnapshot(ProjectBase):  # json description of the whole schema at the end of a load, see utils.schema
+    __tablename__ = "schema_snapshot"
+    generation = Column(Integer, primary_key=True)  # schema generation, see utils.query_cache
+    snapshot = Column(LargeBinary)
+
+
+class ProjectShard(ProjectBase):  # one row per chromosome or cohort of a sharded project, see utils.shards
+    __tablename__ = "shards"
+    key = Column(String, primary_key=True)  # chromosome or cohort
+    shard = Column(String)  # file name of the shard database, relative to the catalog
+    by = Column(String)  # chrom or cohort
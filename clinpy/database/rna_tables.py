@@ -1,25 +1,31 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Float
+from sqlalchemy import Column, Sequence, ForeignKey, Integer, String, Float, Index, Boolean
 
 from clinpy.database.base_tables import ProjectBase
 
 
 class FilteredJunctions(ProjectBase):  # these are the junctions that pass the intense filtering described elsewhere
     __tablename__ = "junctions"
-    id = Column(Integer, primary_key=True, autoincrement=True)
+    __table_args__ = (Index("ix_junctions_key", "chrom", "start", "end", "strand", unique=True),
+                      Index("ix_junctions_bin", "chrom", "bin"))
+    id = Column(Integer, Sequence("junctions_id_seq"), primary_key=True, autoincrement=True)
     chrom = Column(String())
     start = Column(Integer)
     end = Column(Integer)
     strand = Column(String(1))
+    bin = Column(Integer)  # UCSC bin of (start, end) for region queries, see utils.region_bin
 
 
 class AllJunctions(ProjectBase):  # these are junctions that pass some basic QC that's it They are not processed
     # the way filtered junctions are processed this is just for record keeping
     __tablename__ = "all_junctions"
-    id = Column(Integer, primary_key=True, autoincrement=True)
+    __table_args__ = (Index("ix_all_junctions_key", "chrom", "start", "end", "strand", unique=True),
+                      Index("ix_all_junctions_bin", "chrom", "bin"))
+    id = Column(Integer, Sequence("all_junctions_id_seq"), primary_key=True, autoincrement=True)
     chrom = Column(String)
     start = Column(Integer)
     end = Column(Integer)
     strand = Column(String(1))
+    bin = Column(Integer)  # UCSC bin of (start, end) for region queries, see utils.region_bin
 
 
 # many to many relationships
@@ -39,10 +45,47 @@ class SampleToAllJunction(ProjectBase):
     multi_map = Column(Integer)
 
 
+# per cohort summaries of the mapping tables, updated at ingest so recurrence filters do not scan the mappings
+class JunctionRecurrence(ProjectBase):
+    __tablename__ = "junction_recurrence"
+    junction = Column(ForeignKey("junctions.id"), primary_key=True)
+    cohort = Column(String, primary_key=True)
+    num_samples = Column(Integer)
+    total_uniq_map = Column(Integer)
+    max_uniq_map = Column(Integer)
+    total_multi_map = Column(Integer)
+    max_multi_map = Column(Integer)
+
+
+class AllJunctionRecurrence(ProjectBase):
+    __tablename__ = "alljunction_recurrence"
+    junction = Column(ForeignKey("all_junctions.id"), primary_key=True)
+    cohort = Column(String, primary_key=True)
+    num_samples = Column(Integer)
+    total_uniq_map = Column(Integer)
+    max_uniq_map = Column(Integer)
+    total_multi_map = Column(Integer)
+    max_multi_map = Column(Integer)
+
+
+class Genes(ProjectBase):  # gene dictionary so the expression tables only store integers
+    __tablename__ = "genes"
+    id = Column(Integer, Sequence("genes_id_seq"), primary_key=True, autoincrement=True)
+    name = Column(String, unique=True, index=True)
+
+
+class Transcripts(ProjectBase):
+    __tablename__ = "transcripts"
+    id = Column(Integer, Sequence("transcripts_id_seq"), primary_key=True, autoincrement=True)
+    name = Column(String, unique=True, index=True)
+
+
 class GeneExpression(ProjectBase):
     __tablename__ = "gene_expression"
-    samplename = Column(ForeignKey("samples.sample_id"), primary_key=True, index=True)
-    gene = Column(String, primary_key=True, index=True)
+    # the primary key is the table in sqlite, there is no separate rowid b-tree
+    __table_args__ = {"sqlite_with_rowid": False}
+    samplename = Column(ForeignKey("samples.sample_id"), primary_key=True)
+    gene_id = Column(ForeignKey("genes.id"), primary_key=True, index=True)
     expected_count = Column(Float)
     tpm = Column(Float)
     fpkm = Column(Float)
@@ -50,17 +93,39 @@ class GeneExpression(ProjectBase):
 
 class TranscriptExpression(ProjectBase):
     __tablename__ = "transcript_expression"
-    samplename = Column(ForeignKey("samples.sample_id"), primary_key=True, index=True)
-    transcript = Column(String, primary_key=True, index=True)
+    __table_args__ = {"sqlite_with_rowid": False}
+    samplename = Column(ForeignKey("samples.sample_id"), primary_key=True)
+    transcript_id = Column(ForeignKey("transcripts.id"), primary_key=True, index=True)
     expected_count = Column(Float)
     tpm = Column(Float)
     fpkm = Column(Float)
     isopct = Column(Float)
 
 
+class ExpressionStats(ProjectBase):  # cache of Expression.cohort_stats, emptied every time expression is added
+    __tablename__ = "expression_stats"
+    __table_args__ = (Index("ix_expression_stats_key", "cohort", "level", "metric", "log", "name", unique=True),)
+    id = Column(Integer, Sequence("expression_stats_id_seq"), primary_key=True, autoincrement=True)
+    cohort = Column(String)  # comma separated sorted cohort names or "all"
+    level = Column(String)  # gene or transcript
+    metric = Column(String)
+    log = Column(Boolean)
+    name = Column(String)
+    n = Column(Integer)
+    mean = Column(Float)
+    sd = Column(Float)
+    median = Column(Float)
+    mad = Column(Float)
+    q05 = Column(Float)
+    q25 = Column(Float)
+    q75 = Column(Float)
+    q95 = Column(Float)
+
+
 class RNAVariants(ProjectBase):
     __tablename__ = "rna_variants"
-    variant_id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_rna_variants_key", "chrom", "pos", "ref", "alt", unique=True),)
+    variant_id = Column(Integer, Sequence("rna_variants_variant_id_seq"), primary_key=True, index=True)
     chrom = Column(String, index=True)
     pos = Column(Integer)
     id = Column(String)
@@ -70,7 +135,8 @@ class RNAVariants(ProjectBase):
 
 class FilteredRNAVariants(ProjectBase):
     __tablename__ = "filtered_rna_variants"
-    variant_id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_filtered_rna_variants_key", "chrom", "pos", "ref", "alt", unique=True),)
+    variant_id = Column(Integer, Sequence("filtered_rna_variants_variant_id_seq"), primary_key=True, index=True)
     chrom = Column(String, index=True)
     pos = Column(Integer)
     id = Column(String)
@@ -1,10 +1,11 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Float
+from sqlalchemy import Column, Sequence, ForeignKey, Integer, String, Float, Index
 from .base_tables import ProjectBase
 
 
 class Variants(ProjectBase):
     __tablename__ = "variants"
-    variant_id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_variants_key", "chrom", "pos", "ref", "alt", unique=True),)
+    variant_id = Column(Integer, Sequence("variants_variant_id_seq"), primary_key=True, index=True)
     chrom = Column(String, index=True)
     pos = Column(Integer, index=True)
     id = Column(String)
@@ -13,7 +14,8 @@ class Variants(ProjectBase):
 
 class FilteredVariants(ProjectBase):
     __tablename__ = "filtered_variants"
-    variant_id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (Index("ix_filtered_variants_key", "chrom", "pos", "ref", "alt", unique=True),)
+    variant_id = Column(Integer, Sequence("filtered_variants_variant_id_seq"), primary_key=True, index=True)
     chrom = Column(String, index=True)
     pos = Column(Integer, index=True)
     id = Column(String)
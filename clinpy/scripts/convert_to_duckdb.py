@@ -0,0 +1,108 @@
+#! python3.9
+
+import argparse as arg
+import os
+import shutil
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import MetaData, create_engine, func, select
+from sqlalchemy.schema import Sequence
+
+from clinpy.database.base_tables import ProjectBase
+from clinpy.database.rna_tables import *
+from clinpy.database.snp_tables import *
+from clinpy.database.ingest_tables import ProjectInfo, SchemaSnapshot
+from clinpy.utils.expression_store import store_path
+from clinpy.utils.query_cache import bump_generation
+from clinpy.utils.schema import save_schema_snapshot
+from clinpy.utils.utils import duck_engine, create_table, bin_expression, project_table
+
+
+def copy_table(source, target, table, model, chunk_size):
+    """
+    copy the rows of a sqlite table to the duckdb table, the rows are read chunk_size at a time and inserted with
+    duckdb's dataframe scan instead of one insert per row. Values are read as they are stored in sqlite (no json or
+    date parsing) and duckdb casts them to the column types
+    :param source: sqlite engine
+    :param target: duckdb engine
+    :param table: reflected sqlite table
+    :param model: the table as it will be in duckdb
+    :param chunk_size: rows per chunk
+    :return: number of rows copied
+    """
+    columns = [col.name for col in table.columns if col.name in model.columns]
+    names = ", ".join('"{}"'.format(col) for col in columns)
+    num_rows = 0
+    conn = target.raw_connection()
+    try:
+        with source.connect() as src:
+            results = src.execution_options(stream_results=True). \
+                exec_driver_sql('SELECT {} FROM "{}"'.format(names, table.name))
+            for rows in results.partitions(chunk_size):
+                chunk = pd.DataFrame(rows, columns=columns)
+                conn.register("chunk", chunk)
+                conn.execute('INSERT INTO "{}" ({}) SELECT {} FROM chunk'.format(model.name, names, names))
+                conn.unregister("chunk")
+                num_rows += chunk.shape[0]
+        conn.commit()
+    finally:
+        conn.close()
+    return num_rows
+
+
+if __name__ == "__main__":
+    parser = arg.ArgumentParser(description='convert a sqlite project database to duckdb')
+    parser.add_argument('-i', '--input', help="sqlite project database", type=str, action="store")
+    parser.add_argument('-o', '--output', help="duckdb database to create", type=str, action="store")
+    parser.add_argument('-t', '--threads', help="number of threads duckdb can use, all cores by default", type=int,
+                        action="store", default=None)
+    parser.add_argument('-c', '--chunk_size', help="number of rows copied at a time", type=int, action="store",
+                        default=500000)
+    args = parser.parse_args()
+
+    if args.input is None or not os.path.isfile(args.input):
+        raise FileNotFoundError("could not find {}".format(args.input))
+    if args.output is None:
+        raise ValueError("no output database provided")
+    if os.path.isfile(args.output):
+        raise FileExistsError("{} already exists".format(args.output))
+
+    source = create_engine("sqlite:///{}".format(args.input))
+    target = duck_engine(args.output, threads=args.threads)
+    source_meta = MetaData()
+    source_meta.reflect(bind=source, only=project_table)
+    # tables defined in clinpy.database keep their definitions (and sequences), the rest (samples, variant
+    # impacts...) are created as they are in sqlite. The ORM tables need the samples table for their foreign keys
+    ProjectBase.metadata.reflect(source, only=project_table)
+
+    for table in source_meta.sorted_tables:  # referenced tables first
+        if table.name == SchemaSnapshot.__tablename__:  # the snapshot is of the sqlite schema, a new one is saved
+            continue
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Copying " + table.name)
+        model = ProjectBase.metadata.tables[table.name]
+        with target.begin() as conn:
+            for column in model.columns:
+                if isinstance(column.default, Sequence) and column.name in table.columns:
+                    with source.connect() as src:
+                        last = src.execute(select(func.max(table.c[column.name]))).scalar()
+                    # the ids of new rows continue after the copied ones
+                    conn.exec_driver_sql("CREATE SEQUENCE IF NOT EXISTS {} START WITH {}".
+                                         format(column.default.name, (last or 0) + 1))
+        create_table(model, target)
+        copy_table(source, target, table, model, args.chunk_size)
+
+        if "bin" in model.columns and "bin" not in table.columns:  # older projects do not have bins
+            with target.begin() as conn:
+                conn.execute(model.update().values(bin=bin_expression(model.c.start, model.c.end)))
+
+    store = store_path(args.input)
+    if os.path.isdir(store):
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Copying the expression store")
+        shutil.copytree(store, store_path(args.output))
+
+    create_table(ProjectInfo.__table__, target)
+    create_table(SchemaSnapshot.__table__, target)
+    bump_generation(target)
+    save_schema_snapshot(target)
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Done!")
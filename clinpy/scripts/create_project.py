@@ -2,17 +2,22 @@
 
 import argparse as arg
 from datetime import datetime
-from pysam import VariantFile
 import yaml
 
-from sqlalchemy import MetaData
+from sqlalchemy import MetaData, inspect
 from sqlalchemy.orm import Session
 
 from clinpy.database.rna_tables import *
 from clinpy.database.snp_tables import *
 from clinpy.utils.rna_functions import *
 from clinpy.utils.snp_functions import *
-from clinpy.utils.utils import dict_to_engine
+from clinpy.database.ingest_tables import LoadManifest, ProjectInfo, SchemaSnapshot
+from clinpy.utils.ingest_functions import make_jobs, load_files, pending_jobs, needs_normalization, mark_normalized
+from clinpy.utils.expression_store import build_expression_store, store_path, expression_generation
+from clinpy.utils.utils import dict_to_engine, create_table, set_bulk_pragmas, finish_bulk_load, add_bin_column, \
+    drop_bin_column
+from clinpy.utils.query_cache import bump_generation, SCHEMA_GENERATION
+from clinpy.utils.schema import save_schema_snapshot
 
 
 if __name__ == "__main__":
@@ -20,6 +25,14 @@ if __name__ == "__main__":
                                             'and expression data')
     parser.add_argument('-y', '--yaml', help="config.yaml file see readme for details", type=str, action="store",
                         default="config.yaml")
+    parser.add_argument('-w', '--workers', help="number of processes to parse the files with, the database is "
+                                                "always written by a single process", type=int, action="store",
+                        default=1)
+    parser.add_argument('-b', '--bulk', help="bulk load mode for sqlite, relaxed durability while loading, raw "
+                                             "inserts and indexes are created after all the data is in",
+                        action="store_true")
+    parser.add_argument('-r', '--resume', help="resume an interrupted load, files that are in the load manifest "
+                                               "are skipped", action="store_true")
     args = parser.parse_args()
 
     if args.yaml is None:
@@ -32,20 +45,35 @@ if __name__ == "__main__":
         params = yaml.safe_load(y)
 
     engine = dict_to_engine(params["output"])
+    deferred = None
+    if args.bulk:
+        if engine.dialect.name != "sqlite":
+            raise NotImplementedError("bulk load mode is only available for sqlite")
+        set_bulk_pragmas(engine)
+        deferred = []  # non unique indexes, created after the last insert
     project_meta = MetaData(bind=engine)
     session = Session(engine)
 
     if params["output"]["create"]:
-        if os.path.isfile(params["output"]["name"]):
-            raise FileExistsError("database already exists")
+        if os.path.isfile(params["output"]["name"]) and not args.resume:
+            raise FileExistsError("database already exists, use --resume to continue an interrupted load")
         else:  # create the database
             project_meta.reflect()
             sample_table = dict_to_table(params["sample_meta"]["columns"], "samples", project_meta)
-            sample_table.create()
-            print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Creating database " + params["output"]["name"])
+            create_table(sample_table, engine, deferred)
+            if args.resume:
+                print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Resuming database " + params["output"]["name"])
+            else:
+                print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Creating database " + params["output"]["name"])
     else:
         # just get what kind of tables there
         project_meta.reflect()
+    create_table(LoadManifest.__table__, engine)
+    create_table(ProjectInfo.__table__, engine)
+    create_table(SchemaSnapshot.__table__, engine)
+    # once before and once after the load, anything cached while the load is running is stale at the end
+    bump_generation(engine)
+    bump_generation(engine, SCHEMA_GENERATION)  # the snapshot is stale until the load is done
 
     sample_meta = pd.read_csv(params["sample_meta"]["file"], header=0, sep="\t")
     file_cols = list(sample_meta.columns)
@@ -60,8 +88,15 @@ if __name__ == "__main__":
     if "cohort" not in file_cols:
         raise ValueError("cohort column must be preset in sample metadata")
 
+    if (sample_meta["cohort"] == ALL_COHORTS).any():  # see snp_functions.check_cohort_names
+        raise ValueError("{} is used for the variant counts of all samples, it cannot be the name of a cohort".
+                         format(ALL_COHORTS))
+
     # pandas will check for columns, if there are extra ones they will be omitted if missing ones there will be an error
     sample_meta = sample_meta[list(params["sample_meta"]["columns"].keys())]
+    if args.resume:  # the samples from the interrupted run are already there
+        loaded = pd.read_sql_table("samples", engine, columns=["sample_id"])
+        sample_meta = sample_meta[~sample_meta["sample_id"].isin(loaded["sample_id"])]
     # if there are extra samples or duplicates this will fail with a unique constraint error
     sample_meta.to_sql("samples", engine, index=False, if_exists="append")
 
@@ -89,124 +124,113 @@ if __name__ == "__main__":
                 if column == "samplename":
                     continue
                 elif column == "gene_expression":
-                    GeneExpression.__table__.create(engine)
+                    add_expression_ids(engine, gene=True)  # older projects have the names in the expression tables
+                    bump_generation(engine, expression_generation(gene=True))  # the store is out of date until re-built
+                    create_table(Genes.__table__, engine, deferred)
+                    create_table(GeneExpression.__table__, engine, deferred)
+                    create_table(ExpressionStats.__table__, engine, deferred)
                 elif column == "isoform_expression":
-                    TranscriptExpression.__table__.create(engine)
+                    add_expression_ids(engine, gene=False)
+                    bump_generation(engine, expression_generation(gene=False))
+                    create_table(Transcripts.__table__, engine, deferred)
+                    create_table(TranscriptExpression.__table__, engine, deferred)
+                    create_table(ExpressionStats.__table__, engine, deferred)
                 elif column == "unfiltered_junctions":
-                    AllJunctions.__table__.create(engine)
-                    SampleToAllJunction.__table__.create(engine)
+                    create_table(AllJunctions.__table__, engine, deferred)
+                    add_bin_column(AllJunctions.__table__, engine)  # older projects do not have bins
+                    create_table(SampleToAllJunction.__table__, engine, deferred)
+                    if not inspect(engine).has_table(AllJunctionRecurrence.__tablename__):
+                        create_table(AllJunctionRecurrence.__table__, engine, deferred)
+                        build_junction_recurrence(engine, filtered=False)  # older projects have samples already
                 elif column == "filtered_junctions":
-                    FilteredJunctions.__table__.create(engine)
-                    SampleToJunction.__table__.create(engine)
+                    create_table(FilteredJunctions.__table__, engine, deferred)
+                    add_bin_column(FilteredJunctions.__table__, engine)
+                    create_table(SampleToJunction.__table__, engine, deferred)
+                    if not inspect(engine).has_table(JunctionRecurrence.__tablename__):
+                        create_table(JunctionRecurrence.__table__, engine, deferred)
+                        build_junction_recurrence(engine, filtered=True)
                 elif column == "rna_variants":
-                    RNAVariants.__table__.create(engine)
+                    create_table(RNAVariants.__table__, engine, deferred)
+                    drop_bin_column(RNAVariants.__table__, engine)
                     vcf_files = [file for file in files["rna_variants"].to_list() if not pd.isna(file)]
                     fields, formats = compare_fields(vcf_files, vcf_params["info"]["name"], vcf_params["not_same"],
                                                      vcf_params["info"]["sep"])
                     generate_variant_tables(vcf_params, fields, formats, project_meta,
                                             params["sample_meta"]["columns"]["sample_id"]["type"], rna=True,
-                                            filtered=False)
+                                            filtered=False, deferred=deferred)
                 elif column == "filtered_rna_variants":
-                    FilteredRNAVariants.__table__.create(engine)
+                    create_table(FilteredRNAVariants.__table__, engine, deferred)
+                    drop_bin_column(FilteredRNAVariants.__table__, engine)
                     vcf_files = [file for file in files["filtered_rna_variants"].to_list() if not pd.isna(file)]
                     filt_fields, filt_formats = compare_fields(vcf_files, vcf_params["info"]["name"],
                                                                vcf_params["not_same"],
                                                                vcf_params["info"]["sep"])
                     generate_variant_tables(vcf_params, filt_fields, filt_formats, project_meta,
                                             params["sample_meta"]["columns"]["sample_id"]["type"], rna=True,
-                                            filtered=True)
+                                            filtered=True, deferred=deferred)
+
+            vcf_options = {}
+            if "rna_variants" in columns:
+                vcf_options["rna_variants"] = {"fields": fields, "formats": formats}
+            if "filtered_rna_variants" in columns:
+                vcf_options["filtered_rna_variants"] = {"fields": filt_fields, "formats": filt_formats}
+            for dat_type in vcf_options.keys():
+                vcf_options[dat_type].update({"type_dict": vcf_params["variant_impacts"],
+                                              "field_name": vcf_params["info"]["name"],
+                                              "field_split": vcf_params["info"]["sep"],
+                                              "ignore": vcf_params["missing_impact"],
+                                              "chunk_size": vcf_params.get("chunk_size", 100000),
+                                              "region_workers": vcf_params.get("region_workers", 1),
+                                              "region_size": vcf_params.get("region_size", 10000000)})
+
+            min_junc_reads = params["data"]["modalities"]["rna"]["min_junction_reads"]
+            options = {"unfiltered_junctions": {"min_junc_reads": min_junc_reads},
+                       "filtered_junctions": {"min_junc_reads": min_junc_reads},
+                       **vcf_options}
 
             files = files.to_dict(orient="records")  # create a dict
-            for data in files:
-
-                for dat_type in data.keys():
-                    if dat_type == "samplename":
-                        sample = data["samplename"]
-                    elif dat_type == "gene_expression" and not pd.isna(data[dat_type]):
-                        print("[" + datetime.now().strftime(
-                            "%Y/%m/%d %H:%M:%S") + "] " + "Adding gene expression for " + str(sample))
-                        import_expression(data[dat_type], sample, engine, gene=True)
-
-                    elif dat_type == "isoform_expression" and not pd.isna(data[dat_type]):
-                        print("[" + datetime.now().strftime(
-                            "%Y/%m/%d %H:%M:%S") + "] " + "Adding isoform expression for " + str(sample))
-                        import_expression(data[dat_type], sample, engine, gene=False)
-
-                    elif dat_type == "unfiltered_junctions" and not pd.isna(data[dat_type]):
-                        print("[" + datetime.now().strftime(
-                            "%Y/%m/%d %H:%M:%S") + "] " + "Adding junctions for " + str(sample))
-
-                        import_temp_junction(data[dat_type], sample, engine,
-                                             min_junc_reads=params["data"]["modalities"]["rna"]["min_junction_reads"],
-                                             filtered=False)
-
-
-                    elif dat_type == "filtered_junction" and not pd.isna(data[dat_type]):
-                        print("[" + datetime.now().strftime(
-                            "%Y/%m/%d %H:%M:%S") + "] " + "Adding filtered junctions for " + str(sample))
-
-                        import_temp_junction(data[dat_type], sample,
-                                             params["data"]["modalities"]["rna"]["min_junction_reads"],
-                                             filtered=True)
-
-
-                    elif dat_type == "rna_variants":
-                        if not pd.isna(data[dat_type]):
-                            print("[" + datetime.now().strftime(
-                                "%Y/%m/%d %H:%M:%S") + "] " + "Adding variants for " + str(sample))
-                            vcf = VariantFile(data[dat_type])
-                            variants = parse_vcf(vcf, fields, formats,
-                                                 type_dict=vcf_params["variant_impacts"],
-                                                 field_name=vcf_params["info"]["name"],
-                                                 field_split=vcf_params["info"]["sep"],
-                                                 ignore=vcf_params["missing_impact"])
-                            import_temp_variants(variants, sample, engine, filtered=False)
-
-
-                    elif dat_type == "filtered_rna_variants":
-                        if not pd.isna(data[dat_type]):
-                            print("[" + datetime.now().strftime(
-                                "%Y/%m/%d %H:%M:%S") + "] " + "Adding filtered variants for " + str(sample))
-                            variants = parse_vcf(data[dat_type], fields, formats,
-                                                 type_dict=vcf_params["variant_impacts"],
-                                                 field_name=vcf_params["info"]["name"],
-                                                 field_split=vcf_params["info"]["sep"],
-                                                 ignore=vcf_params["missing_impact"])
-                            import_temp_variants(variants, sample, engine, filtered=True)
-
-                    else:
-                        raise NotImplementedError(
-                            "{} has not been implemented in clinpy you can create a feature request at "
-                            "https://github.com/celalp/clinpy".format(
-                                dat_type))
+            jobs = make_jobs(files, options, modality)
+            jobs = pending_jobs(jobs, engine, resume=args.resume)
+            load_files(jobs, engine, workers=args.workers, bulk=args.bulk)
+            if any([job["dat_type"] in ["gene_expression", "isoform_expression"] for job in jobs]):
+                with engine.begin() as conn:  # cached cohort statistics are out of date now
+                    conn.execute(ExpressionStats.__table__.delete())
 
             # this is the second iteration, now that all the files are in the temp tables we can split
             # them and put them where they belong
             for column in columns:
-                if column=="unfiltered_junctions":
+                if not needs_normalization(engine, column):  # nothing new or done before an interruption
+                    continue
+                elif column=="unfiltered_junctions":
                     print("[" + datetime.now().strftime(
-                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing unfiltered junction tables for " + str(sample))
+                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing unfiltered junction tables")
                     add_to_junction_tables(engine, project_meta, session=session, create=params["output"]["create"],
                                            filtered=False)
                 elif column == "filtered_junctions":
                     print("[" + datetime.now().strftime(
-                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing filtered junction tables for " + str(sample))
+                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing filtered junction tables")
                     add_to_junction_tables(engine, project_meta, session=session, create=params["output"]["create"],
                                            filtered=True)
                 elif column == "rna_variants":
                     print("[" + datetime.now().strftime(
-                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing rna variant tables for  " + str(sample))
+                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing rna variant tables")
                     add_to_variant_tables(engine, project_meta, session, fields, formats,
                                           create=params["output"]["create"], filtered=False,
                                           rna=True)
                 elif column == "filtered_rna_variants":
                     print("[" + datetime.now().strftime(
-                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing filtered rna variant tables for " + str(sample))
-                    add_to_variant_tables(engine, project_meta, session, fields, formats,
+                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing filtered rna variant tables")
+                    add_to_variant_tables(engine, project_meta, session, filt_fields, filt_formats,
                                           create=params["output"]["create"], filtered=True,
                                           rna=True)
-                else:
-                    continue
+                mark_normalized(engine, column)
+
+            if params["data"]["modalities"][modality].get("expression_store", False):
+                for column, gene in [("gene_expression", True), ("isoform_expression", False)]:
+                    if column in columns:
+                        print("[" + datetime.now().strftime(
+                            "%Y/%m/%d %H:%M:%S") + "] " + "Building the " + column + " store")
+                        build_expression_store(engine, store_path(params["output"]["name"]), gene=gene)
 
         elif modality == "snps":
 
@@ -229,70 +253,60 @@ if __name__ == "__main__":
                 if column == "samplename":
                     continue
                 elif column == "variants":
-                    Variants.__table__.create(engine)
+                    create_table(Variants.__table__, engine, deferred)
+                    drop_bin_column(Variants.__table__, engine)
                     vcf_files = [file for file in files["variants"].to_list() if not pd.isna(file)]
                     fields, formats = compare_fields(vcf_files, vcf_params["info"]["name"], vcf_params["not_same"],
                                                  vcf_params["info"]["sep"])
                     generate_variant_tables(vcf_params, fields, formats, project_meta,
                                         params["sample_meta"]["columns"]["sample_id"]["type"], rna=False,
-                                        filtered=False)
-                elif column == "filtered_rna_variants":
-                    FilteredVariants.__table__.create(engine)
+                                        filtered=False, deferred=deferred)
+                elif column == "filtered_variants":
+                    create_table(FilteredVariants.__table__, engine, deferred)
+                    drop_bin_column(FilteredVariants.__table__, engine)
                     vcf_files = [file for file in files["filtered_variants"].to_list() if not pd.isna(file)]
                     filt_fields, filt_formats = compare_fields(vcf_files, vcf_params["info"]["name"],
                                                            vcf_params["not_same"],
                                                            vcf_params["info"]["sep"])
                     generate_variant_tables(vcf_params, filt_fields, filt_formats, project_meta,
                                         params["sample_meta"]["columns"]["sample_id"]["type"], rna=False,
-                                        filtered=True)
+                                        filtered=True, deferred=deferred)
+
+            vcf_options = {}
+            if "variants" in columns:
+                vcf_options["variants"] = {"fields": fields, "formats": formats}
+            if "filtered_variants" in columns:
+                vcf_options["filtered_variants"] = {"fields": filt_fields, "formats": filt_formats}
+            for dat_type in vcf_options.keys():
+                vcf_options[dat_type].update({"type_dict": vcf_params["variant_impacts"],
+                                              "field_name": vcf_params["info"]["name"],
+                                              "field_split": vcf_params["info"]["sep"],
+                                              "ignore": vcf_params["missing_impact"],
+                                              "chunk_size": vcf_params.get("chunk_size", 100000),
+                                              "region_workers": vcf_params.get("region_workers", 1),
+                                              "region_size": vcf_params.get("region_size", 10000000)})
 
             files = files.to_dict(orient="records")  # create a dict
-            for data in files:
-                for dat_type in data.keys():
-                    if dat_type == "samplename":
-                        sample = data["samplename"]
-
-                    elif dat_type == "variants":
-                        if not pd.isna(data[dat_type]):
-                            print("[" + datetime.now().strftime(
-                            "%Y/%m/%d %H:%M:%S") + "] " + "Adding variants for " + str(sample))
-                            vcf=VariantFile(data[dat_type])
-                            variants = parse_vcf(vcf, fields, formats,
-                                             type_dict=vcf_params["variant_impacts"],
-                                             field_name=vcf_params["info"]["name"],
-                                             field_split=vcf_params["info"]["sep"],
-                                             ignore=vcf_params["missing_impact"])
-                            import_temp_variants(variants, sample, engine, filtered=False)
-
-
-                    elif dat_type == "filtered_variants":
-                        if not pd.isna(data[dat_type]):
-                            print("[" + datetime.now().strftime(
-                            "%Y/%m/%d %H:%M:%S") + "] " + "Adding filtered variants for " + str(sample))
-                            variants = parse_vcf(data[dat_type], fields, formats,
-                                             type_dict=vcf_params["variant_impacts"],
-                                             field_name=vcf_params["info"]["name"],
-                                             field_split=vcf_params["info"]["sep"],
-                                             ignore=vcf_params["missing_impact"])
-                            import_temp_variants(variants, sample, engine, filtered=True)
-
-                    else:
-                        raise NotImplementedError(
-                            "{} has not been implemented in clinpy you can create a feature request at "
-                            "https://github.com/celalp/clinpy".format(
-                                type))
+            jobs = make_jobs(files, vcf_options, modality)
+            jobs = pending_jobs(jobs, engine, resume=args.resume)
+            load_files(jobs, engine, workers=args.workers, bulk=args.bulk)
 
             for column in columns:
-                if column == "rna_variants":
-                    add_to_variant_tables(engine, project_meta, session, fields, formats,
-                                      create=params["output"]["create"], filtered=False,
-                                      rna=False)
-                elif column == "filtered_rna_variants":
-                    add_to_variant_tables(engine, project_meta, session, fields, formats,
-                                  create=params["output"]["create"], filtered=True,
-                                  rna=False)
-                else:
+                if not needs_normalization(engine, column):
                     continue
+                elif column == "variants":
+                    print("[" + datetime.now().strftime(
+                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing variant tables")
+                    add_to_variant_tables(engine, project_meta, session, fields, formats,
+                                          create=params["output"]["create"], filtered=False,
+                                          rna=False)
+                elif column == "filtered_variants":
+                    print("[" + datetime.now().strftime(
+                        "%Y/%m/%d %H:%M:%S") + "] " + "Normalizing filtered variant tables")
+                    add_to_variant_tables(engine, project_meta, session, filt_fields, filt_formats,
+                                          create=params["output"]["create"], filtered=True,
+                                          rna=False)
+                mark_normalized(engine, column)
 
         else:  # the list will increase as time goes on
             raise NotImplementedError(
@@ -300,4 +314,10 @@ if __name__ == "__main__":
                 "https://github.com/celalp/clinpy".format(
                     modality))
 
+    if args.bulk:
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Creating indexes")
+        finish_bulk_load(engine, deferred)
+
+    bump_generation(engine)
+    save_schema_snapshot(engine)
     print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Done!")
@@ -0,0 +1,129 @@
+#! python3.9
+
+import argparse as arg
+import os
+import shutil
+from datetime import datetime
+
+from sqlalchemy import MetaData, create_engine, insert, select
+
+from clinpy.database.ingest_tables import ProjectInfo, ProjectShard, SchemaSnapshot
+from clinpy.utils.expression_store import store_path
+from clinpy.utils.query_cache import bump_generation
+from clinpy.utils.schema import save_schema_snapshot
+from clinpy.utils.shards import sharded_tables, shard_filter, shard_weights, split_keys
+from clinpy.utils.utils import create_table, finish_bulk_load, project_table
+
+
+def copy_tables(source, target, tables, project_meta, where=None):
+    """
+    copy tables from the project to the catalog or a shard, the project is attached to the connection as src so the
+    rows are copied by sqlite with an INSERT ... SELECT and never go through python. The non unique indexes are created
+    after the rows are in
+    :param source: path of the project database
+    :param target: sqlite engine of the catalog or the shard
+    :param tables: list of reflected tables
+    :param project_meta: reflected MetaData of the project
+    :param where: function that gets a table of the attached project and returns the where clause of the rows to copy,
+    all the rows if None
+    :return: nothing
+    """
+    # the tables that are not copied are there for the foreign keys, sqlite does not check that they exist
+    target_meta, src_meta = MetaData(), MetaData()
+    models = {table.name: table.to_metadata(target_meta) for table in project_meta.sorted_tables}
+    src_tables = {table.name: table.to_metadata(src_meta, schema="src") for table in project_meta.sorted_tables}
+    deferred = []
+    for table in tables:
+        create_table(models[table.name], target, deferred)
+
+    with target.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS src", (source,))
+        for table in tables:
+            print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Copying " + table.name)
+            query = select(src_tables[table.name])
+            if where is not None:
+                query = query.where(where(src_tables[table.name], src_tables))
+            with conn.begin():
+                conn.execute(insert(models[table.name]).from_select([col.name for col in table.columns], query))
+        conn.exec_driver_sql("DETACH DATABASE src")
+    finish_bulk_load(target, deferred)
+
+
+if __name__ == "__main__":
+    parser = arg.ArgumentParser(description='split a sqlite project database into shards by chromosome or cohort, '
+                                            'the catalog has the rest of the project and the list of shards')
+    parser.add_argument('-i', '--input', help="sqlite project database", type=str, action="store")
+    parser.add_argument('-o', '--output', help="catalog database to create, the shards are created next to it",
+                        type=str, action="store")
+    parser.add_argument('-b', '--by', help="chrom or cohort", type=str, action="store", default="chrom")
+    parser.add_argument('-n', '--num_shards', help="number of shards, chromosomes or cohorts are split between them "
+                                                   "so they are about the same size", type=int, action="store",
+                        default=4)
+    parser.add_argument('-g', '--groups', help="comma separated chromosomes or cohorts of each shard instead of "
+                                               "num_shards, the ones that are not listed get a shard each",
+                        type=str, action="store", nargs="+", default=None)
+    args = parser.parse_args()
+
+    if args.input is None or not os.path.isfile(args.input):
+        raise FileNotFoundError("could not find {}".format(args.input))
+    if args.output is None:
+        raise ValueError("no output database provided")
+    if os.path.isfile(args.output):
+        raise FileExistsError("{} already exists".format(args.output))
+
+    source = create_engine("sqlite:///{}".format(args.input))
+    source_meta = MetaData()
+    source_meta.reflect(bind=source, only=project_table)
+    plan = sharded_tables(source_meta, args.by)
+    if len(plan) == 0:
+        raise ValueError("{} does not have any junctions or variants to shard".format(args.input))
+
+    with source.connect() as conn:
+        weights = shard_weights(conn, source_meta, plan, args.by)
+    if args.groups is not None:
+        groups = [[key for key in group.split(",") if key != ""] for group in args.groups]
+        listed = {key for group in groups for key in group}
+        groups += [[key] for key in sorted(weights) if key not in listed]
+    else:
+        groups = split_keys(weights, args.num_shards)
+
+    stem = os.path.splitext(os.path.basename(args.output))[0]
+    shard_names = ["{}.shard{}.db".format(stem, num) for num in range(len(groups))]
+    for name in shard_names:
+        if os.path.isfile(os.path.join(os.path.dirname(os.path.abspath(args.output)), name)):
+            raise FileExistsError("{} already exists".format(name))
+
+    catalog = create_engine("sqlite:///{}".format(args.output))
+    skip = set(plan.keys()) | {SchemaSnapshot.__tablename__, ProjectShard.__tablename__}
+    copy_tables(os.path.abspath(args.input), catalog,
+                [table for table in source_meta.sorted_tables if table.name not in skip], source_meta)
+
+    sharded = [table for table in source_meta.sorted_tables if table.name in plan]
+    for name, keys in zip(shard_names, groups):
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Creating " + name + " for " +
+              ", ".join(keys))
+        path = os.path.join(os.path.dirname(os.path.abspath(args.output)), name)
+        copy_tables(os.path.abspath(args.input), create_engine("sqlite:///{}".format(path)), sharded, source_meta,
+                    lambda table, tables, keys=keys: shard_filter(table, plan, keys, tables))
+
+    create_table(ProjectShard.__table__, catalog)
+    with catalog.begin() as conn:
+        conn.execute(insert(ProjectShard.__table__),
+                     [{"key": key, "shard": name, "by": args.by} for name, keys in zip(shard_names, groups)
+                      for key in keys])
+
+    store = store_path(args.input)
+    if os.path.isdir(store):
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Copying the expression store")
+        shutil.copytree(store, store_path(args.output))
+
+    create_table(ProjectInfo.__table__, catalog)
+    create_table(SchemaSnapshot.__table__, catalog)
+    bump_generation(catalog)
+    # the snapshot has the tables of the catalog and of the shards, they are the same in every shard
+    catalog_meta = MetaData()
+    catalog_meta.reflect(bind=catalog, only=project_table)
+    catalog_meta.reflect(bind=create_engine("sqlite:///{}".format(
+        os.path.join(os.path.dirname(os.path.abspath(args.output)), shard_names[0]))), only=project_table)
+    save_schema_snapshot(catalog, catalog_meta)
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Done!")
@@ -0,0 +1,117 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy.special import erfc
+
+# quantiles that are reported (and cached) for each gene
+QUANTILES = [0.05, 0.25, 0.75, 0.95]
+# scales the MAD so it estimates the standard deviation of normally distributed values
+MAD_SCALE = 1.4826
+
+
+def quantile_name(quantile):
+    """
+    column name of a quantile
+    :param quantile: a number between 0 and 1
+    :return: q05, q25 etc.
+    """
+    return "q{:02d}".format(int(round(quantile * 100)))
+
+
+def transform(values, log=True):
+    """
+    log2(x+1) transform expression values, this is done before any of the statistics are calculated
+    :param values: numpy array
+    :param log: if False values are returned as float64
+    :return: numpy array
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if log:
+        return np.log2(values + 1)
+    return values
+
+
+def block_statistics(values, quantiles=QUANTILES):
+    """
+    per gene statistics of a gene x sample block, missing values (NaN) are ignored
+    :param values: 2d numpy array genes are rows samples are columns
+    :param quantiles: list of quantiles
+    :return: a dataframe with n, mean, sd, median, mad and one column per quantile, one row per gene
+    """
+    # genes that are not measured in any sample give all NaN rows, numpy warns about those
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median = np.nanmedian(values, axis=1)
+        stats = {"n": np.sum(~np.isnan(values), axis=1),
+                 "mean": np.nanmean(values, axis=1),
+                 "sd": np.nanstd(values, axis=1, ddof=1),
+                 "median": median,
+                 "mad": np.nanmedian(np.abs(values - median[:, None]), axis=1) * MAD_SCALE}
+        if len(quantiles) > 0:
+            qs = np.nanquantile(values, quantiles, axis=1)
+            for quantile, q in zip(quantiles, qs):
+                stats[quantile_name(quantile)] = q
+    return pd.DataFrame(stats)
+
+
+def zscores(values, center, scale):
+    """
+    z-scores of a gene x sample block
+    :param values: 2d numpy array
+    :param center: one value per gene (mean or median)
+    :param scale: one value per gene (sd or mad), genes with 0 spread get NaN
+    :return: 2d numpy array
+    """
+    scale = np.where(scale > 0, scale, np.nan)
+    return (values - center[:, None]) / scale[:, None]
+
+
+def zscore_pvalues(z):
+    """
+    two sided normal p-values of z-scores
+    :param z: numpy array
+    :return: numpy array of the same shape
+    """
+    return erfc(np.abs(z) / np.sqrt(2))
+
+
+def adjust_pvalues(pvalues, m):
+    """
+    Benjamini-Hochberg adjustment. Only the smallest p-values need to be passed as long as m is the total number of
+    tests, the adjusted values are exact for any p-value that ends up below the largest p-value that was passed
+    :param pvalues: 1d numpy array
+    :param m: number of tests
+    :return: adjusted p-values in the same order
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    if len(pvalues) == 0:
+        return pvalues
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * m / np.arange(1, len(pvalues) + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted = np.empty_like(ranked)
+    adjusted[order] = np.minimum(ranked, 1)
+    return adjusted
+
+
+def block_outliers(block, stats, robust=True, pvalue=0.05):
+    """
+    outlier candidates of a gene x sample block given the cohort statistics of the same genes
+    :param block: wide dataframe of transformed values, genes are the index
+    :param stats: output of block_statistics for the same genes in the same order
+    :param robust: use median/mad instead of mean/sd
+    :param pvalue: only tests below this nominal p-value are kept
+    :return: a long dataframe of candidates and the number of tests per sample (a series)
+    """
+    if robust:
+        z = zscores(block.to_numpy(), stats["median"].to_numpy(), stats["mad"].to_numpy())
+    else:
+        z = zscores(block.to_numpy(), stats["mean"].to_numpy(), stats["sd"].to_numpy())
+    p = zscore_pvalues(z)
+    tests = pd.Series(np.sum(~np.isnan(p), axis=0), index=block.columns)
+    rows, cols = np.nonzero(p < pvalue)  # NaN is never smaller
+    candidates = pd.DataFrame({"samplename": block.columns[cols], block.index.name: block.index[rows],
+                               "value": block.to_numpy()[rows, cols], "zscore": z[rows, cols],
+                               "pvalue": p[rows, cols]})
+    return candidates, tests
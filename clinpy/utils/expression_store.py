@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Table, MetaData, select
+
+from clinpy.utils.query_cache import current_generation
+
+# metrics that are stored for each level, these are the columns of the expression tables
+METRICS = {"gene": ["expected_count", "tpm", "fpkm"],
+           "transcript": ["expected_count", "tpm", "fpkm", "isopct"]}
+
+
+def store_path(db_name):
+    """
+    the expression store lives next to the sqlite file
+    :param db_name: path of the project database
+    :return: path of the store directory
+    """
+    return db_name + ".expression"
+
+
+def expression_generation(gene=True):
+    """
+    name of the project_info counter of gene or transcript expression, create_project.py bumps it before adding
+    expression so the stores built before that are out of date, see ExpressionStore.is_current
+    :param gene: gene or transcript expression
+    :return: a name for query_cache.current_generation
+    """
+    return "{}_expression_generation".format("gene" if gene else "transcript")
+
+
+def build_expression_store(engine, path, gene=True, chunk_size=1000000):
+    """
+    write the expression table as dense float32 gene x sample matrices, one .npy file per metric with the gene and
+    sample names as sidecar .npy files. The rows are streamed from the database so the only thing in memory is the
+    matrix being filled, which is written through a memory map. Missing values are NaN. The expression generation of
+    the project (see expression_generation) is saved with the matrices so a store that was not re-built after
+    expression was added is not used. This re-creates the whole store so it needs to be run after every load
+    :param engine: sqlalchemy engine
+    :param path: directory of the store, see store_path
+    :param gene: gene or transcript expression
+    :param chunk_size: number of rows to fetch at a time
+    :return: nothing
+    """
+    level = "gene" if gene else "transcript"
+    meta = MetaData()
+    table = Table("{}_expression".format(level), meta, autoload_with=engine)
+    dictionary = Table(level + "s", meta, autoload_with=engine)
+    name_col = dictionary.c.name.label(level)
+    os.makedirs(path, exist_ok=True)
+
+    with engine.connect() as conn:
+        names = conn.execute(select(dictionary.c.name).order_by(dictionary.c.name)).scalars().all()
+        samples = conn.execute(select(table.c.samplename).distinct().order_by(table.c.samplename)).scalars().all()
+    names = pd.Index(names)
+    samples = pd.Index(samples)
+
+    matrices = {}
+    for metric in METRICS[level]:
+        matrices[metric] = np.lib.format.open_memmap(os.path.join(path, "{}_{}.npy".format(level, metric)),
+                                                     mode="w+", dtype=np.float32,
+                                                     shape=(len(names), len(samples)))
+        matrices[metric][:] = np.nan
+
+    query = select(name_col, table.c.samplename, *[table.c[metric] for metric in METRICS[level]]). \
+        select_from(table.join(dictionary, table.c[level + "_id"] == dictionary.c.id))
+    with engine.connect() as conn:
+        # read before the rows, if expression is added while this runs the store is out of date
+        generation = current_generation(conn, expression_generation(gene))
+        result = conn.execution_options(stream_results=True).execute(query)
+        for rows in result.partitions(chunk_size):
+            rows = pd.DataFrame(rows, columns=[level, "samplename"] + METRICS[level])
+            row_idx = names.get_indexer(rows[level])
+            col_idx = samples.get_indexer(rows["samplename"])
+            for metric in METRICS[level]:
+                matrices[metric][row_idx, col_idx] = rows[metric].to_numpy(dtype=np.float32)
+
+    for metric in METRICS[level]:
+        matrices[metric].flush()
+    # names are saved as fixed width arrays so they can be loaded without pickle
+    np.save(os.path.join(path, "{}_names.npy".format(level)), np.asarray(names.to_list()))
+    np.save(os.path.join(path, "{}_samples.npy".format(level)), np.asarray(samples.to_list()))
+    np.save(os.path.join(path, "{}_generation.npy".format(level)), np.asarray([generation]))
+
+
+def as_slice(positions):
+    """
+    sorted unique positions as a slice if they are consecutive, numpy returns a view of the memory map for a slice and
+    a copy for an array of positions
+    :param positions: sorted numpy array of unique positions
+    :return: a slice or the positions
+    """
+    if len(positions) > 0 and positions[-1] - positions[0] == len(positions) - 1:
+        return slice(positions[0], positions[-1] + 1)
+    return positions
+
+
+class ExpressionStore:
+    """
+    read only access to the matrices written by build_expression_store, the matrices are memory mapped so opening
+    the store is instant and only the pages that are sliced are read from disk
+    """
+
+    def __init__(self, path, gene=True):
+        """
+        :param path: directory of the store
+        :param gene: gene or transcript expression
+        """
+        self.path = path
+        self.level = "gene" if gene else "transcript"
+        self.names = pd.Index(np.load(os.path.join(path, "{}_names.npy".format(self.level))))
+        self.samples = pd.Index(np.load(os.path.join(path, "{}_samples.npy".format(self.level))))
+        # stores built before the generation was saved do not have it
+        generation = os.path.join(path, "{}_generation.npy".format(self.level))
+        self.generation = int(np.load(generation)[0]) if os.path.isfile(generation) else None
+        self.matrices = {}
+
+    @staticmethod
+    def exists(path, gene=True):
+        """
+        check if a store has been built
+        :param path: directory of the store
+        :param gene: gene or transcript expression
+        :return: bool
+        """
+        level = "gene" if gene else "transcript"
+        return os.path.isfile(os.path.join(path, "{}_names.npy".format(level)))
+
+    def is_current(self, generation):
+        """
+        check if the store has the same expression as the database, a load without expression_store adds expression
+        but does not re-build the store
+        :param generation: expression generation of the project, see expression_generation
+        :return: bool, False for stores that do not have a generation
+        """
+        return self.generation is not None and self.generation == generation
+
+    def matrix(self, what):
+        """
+        the memory mapped matrix of a metric, genes are rows and samples are columns
+        :param what: one of the metrics in METRICS
+        :return: a read only numpy memmap
+        """
+        if what not in METRICS[self.level]:
+            raise ValueError("{} is not one of {}".format(what, ", ".join(METRICS[self.level])))
+        if what not in self.matrices.keys():
+            self.matrices[what] = np.load(os.path.join(self.path, "{}_{}.npy".format(self.level, what)),
+                                          mmap_mode="r")
+        return self.matrices[what]
+
+    def get(self, what, names=None, samples=None):
+        """
+        return a wide dataframe of expression, same as pivoting the expression table
+        :param what: one of the metrics in METRICS
+        :param names: genes/transcripts if None all of them
+        :param samples: samples if None all of them
+        :return: a dataframe with genes/transcripts as the index and samples as columns, genes/samples that are not in
+        the store are dropped and the ones that are asked for more than once are returned once like the database does
+        """
+        matrix = self.matrix(what)
+        # all the genes/samples or consecutive ones are sliced, these are views of the memory map and nothing is read
+        # until the values are used. Any other subset is copied out of the map
+        if names is None:
+            rows = slice(None)
+            row_names = self.names
+        else:
+            rows = self.names.get_indexer(list(names))
+            rows = np.unique(rows[rows >= 0])
+            row_names = self.names[rows]
+            rows = as_slice(rows)
+
+        if samples is None:
+            cols = slice(None)
+            col_names = self.samples
+        else:
+            cols = self.samples.get_indexer(list(samples))
+            cols = np.unique(cols[cols >= 0])
+            col_names = self.samples[cols]
+            cols = as_slice(cols)
+
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            values = matrix[rows, cols]
+        else:
+            values = matrix[np.ix_(rows, cols)]
+        wide = pd.DataFrame(values, index=row_names, columns=col_names)
+        wide.index.name = self.level
+        wide.columns.name = "samplename"
+        return wide
@@ -0,0 +1,107 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# sparse matrix types, anything else in a FORMAT column is not a number
+MATRIX_TYPES = {"int": np.int32, "float": np.float32, "bool": np.int8, "gt": np.int8}
+
+
+def sparse_from_chunks(chunks, samples, dtype=np.int8, matrix_format="csr"):
+    """
+    build a variant x sample sparse matrix from chunks of (variant, sample, value) rows. The rows need to be ordered by
+    variant so the row of a variant is known the first time it is seen and only the non-zero entries are ever in
+    memory
+    :param chunks: an iterable of lists of (variant_id, samplename, value) tuples
+    :param samples: list of samplenames, these are the columns, entries of other samples are dropped
+    :param dtype: numpy type of the values
+    :param matrix_format: "csr" or "csc"
+    :return: the sparse matrix, numpy array of variant ids (rows) and numpy array of samplenames (columns)
+    """
+    columns = pd.Index(samples)
+    variants, rows, cols, values = [], [], [], []
+    last, num_rows = None, 0
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        chunk = pd.DataFrame(chunk, columns=["variant_id", "samplename", "value"])
+        ids = chunk["variant_id"].to_numpy()
+        new = np.empty(len(ids), dtype=bool)
+        new[0] = ids[0] != last
+        new[1:] = ids[1:] != ids[:-1]
+        chunk_rows = num_rows + np.cumsum(new) - 1
+        chunk_cols = columns.get_indexer(chunk["samplename"])
+        keep = chunk_cols >= 0
+
+        variants.append(ids[new])
+        rows.append(chunk_rows[keep])
+        cols.append(chunk_cols[keep])
+        values.append(chunk["value"].to_numpy(dtype=dtype)[keep])
+        last, num_rows = ids[-1], num_rows + int(new.sum())
+
+    if num_rows == 0:
+        variants, rows, cols, values = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)], \
+                                       [np.array([], dtype=np.int64)], [np.array([], dtype=dtype)]
+    matrix = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(num_rows, len(columns)))
+    matrix = matrix.tocsc() if matrix_format == "csc" else matrix.tocsr()
+    return matrix, np.concatenate(variants), np.asarray(columns)
+
+
+def save_matrix(path, matrix, variants, samples, key):
+    """
+    save a sparse matrix and its row/column names to a single .npz file
+    :param path: path of the file
+    :param matrix: csr or csc matrix
+    :param variants: row names
+    :param samples: column names
+    :param key: a json serializable description of how the matrix was made, load_matrix only returns a matrix with
+    the same key
+    :return: nothing
+    """
+    with open(path, "wb") as out:  # np.savez would add .npz to the path
+        np.savez(out, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.asarray(matrix.shape),
+                 format=np.asarray(matrix.format), variants=variants, samples=np.asarray(samples),
+                 key=np.asarray(json.dumps(key, sort_keys=True)))
+
+
+def load_matrix(path, key):
+    """
+    load a matrix saved with save_matrix
+    :param path: path of the file
+    :param key: the key the matrix was saved with
+    :return: the same as sparse_from_chunks or None if there is no file or the key is different
+    """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path, allow_pickle=False) as saved:
+        if str(saved["key"]) != json.dumps(key, sort_keys=True):
+            return None
+        make = sparse.csc_matrix if str(saved["format"]) == "csc" else sparse.csr_matrix
+        matrix = make((saved["data"], saved["indices"], saved["indptr"]), shape=tuple(saved["shape"]))
+        return matrix, saved["variants"], saved["samples"]
+
+
+def stack_matrices(parts, matrix_format="csr"):
+    """
+    combine matrices made from different parts of a project (the shards, see utils.shards) into one. The rows are all
+    the variants and the columns all the samples of the parts, in variant id and samplename order like a matrix made
+    from the whole project. Entries that are in more than one part are added up
+    :param parts: list of (matrix, variant ids, samplenames) like sparse_from_chunks returns
+    :param matrix_format: "csr" or "csc"
+    :return: the same as sparse_from_chunks
+    """
+    variants = np.unique(np.concatenate([part[1] for part in parts]))
+    samples = np.asarray(sorted({sample for part in parts for sample in part[2]}))
+    rows, cols, values = [], [], []
+    for matrix, part_variants, part_samples in parts:
+        matrix = matrix.tocoo()
+        rows.append(np.searchsorted(variants, np.asarray(part_variants))[matrix.row])
+        cols.append(pd.Index(samples).get_indexer(part_samples)[matrix.col])
+        values.append(matrix.data)
+    matrix = sparse.coo_matrix((np.concatenate(values).astype(parts[0][0].dtype), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(len(variants), len(samples)))
+    matrix = matrix.tocsc() if matrix_format == "csc" else matrix.tocsr()
+    return matrix, variants, samples
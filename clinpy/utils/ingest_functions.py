@@ -0,0 +1,349 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from sqlalchemy import select, update, delete, func, inspect, Table, MetaData
+
+from clinpy.database.ingest_tables import LoadManifest
+from clinpy.utils.rna_functions import read_expression, read_temp_junction, encode_expression_names
+from clinpy.utils.snp_functions import read_vcf
+from clinpy.utils.utils import bulk_insert
+
+# where each file type ends up, expression goes directly to its table the rest go to temp tables that are
+# normalized after all the files are in
+STAGING_TABLES = {"gene_expression": "gene_expression",
+                  "isoform_expression": "transcript_expression",
+                  "unfiltered_junctions": "temp_all_junc",
+                  "filtered_junctions": "temp_filt_junc",
+                  "rna_variants": "temp_all_variants",
+                  "filtered_rna_variants": "temp_filt_variants",
+                  "variants": "temp_all_variants",
+                  "filtered_variants": "temp_filt_variants"}
+
+MESSAGES = {"gene_expression": "Adding gene expression for ",
+            "isoform_expression": "Adding isoform expression for ",
+            "unfiltered_junctions": "Adding junctions for ",
+            "filtered_junctions": "Adding filtered junctions for ",
+            "rna_variants": "Adding variants for ",
+            "filtered_rna_variants": "Adding filtered variants for ",
+            "variants": "Adding variants for ",
+            "filtered_variants": "Adding filtered variants for "}
+
+
+def make_jobs(files, options, modality):
+    """
+    create a list of parsing jobs from the files table of a modality, one job per sample and file type
+    :param files: list of dicts, the files table as records
+    :param options: dict of dat_type: dict of parser arguments (see parse_file)
+    :param modality: name of the modality in the config, this is recorded in the manifest
+    :return: a list of job dicts with dat_type, file, samplename, modality and options, in the same order as the
+    files table
+    """
+    jobs = []
+    for data in files:
+        sample = data["samplename"]
+        for dat_type in data.keys():
+            if dat_type == "samplename":
+                continue
+            elif dat_type not in STAGING_TABLES.keys():
+                raise NotImplementedError(
+                    "{} has not been implemented in clinpy you can create a feature request at "
+                    "https://github.com/celalp/clinpy".format(dat_type))
+            elif pd.isna(data[dat_type]):
+                continue
+            else:
+                jobs.append({"dat_type": dat_type, "file": data[dat_type], "samplename": sample,
+                             "modality": modality, "options": options.get(dat_type, {})})
+    return jobs
+
+
+def parse_file(job):
+    """
+    parse a single processed file, this does not touch the database so it can run in a worker process
+    :param job: a job dict see make_jobs
+    :return: tablename and a generator of dataframes to be inserted to that table, vcfs are read in chunks the
+    rest are small enough to be read at once
+    """
+    dat_type = job["dat_type"]
+    options = job["options"]
+    if dat_type == "gene_expression":
+        chunks = iter([read_expression(job["file"], job["samplename"], gene=True)])
+    elif dat_type == "isoform_expression":
+        chunks = iter([read_expression(job["file"], job["samplename"], gene=False)])
+    elif dat_type in ["unfiltered_junctions", "filtered_junctions"]:
+        chunks = iter([read_temp_junction(job["file"], job["samplename"], options["min_junc_reads"])])
+    else:
+        chunks = read_vcf(job["file"], job["samplename"], options["fields"], options["formats"],
+                          type_dict=options["type_dict"], field_name=options["field_name"],
+                          field_split=options["field_split"], ignore=options["ignore"],
+                          chunk_size=options.get("chunk_size", 100000),
+                          region_workers=options.get("region_workers", 1),
+                          region_size=options.get("region_size", 10000000))
+    return STAGING_TABLES[dat_type], chunks
+
+
+def spool_file(job, spool_dir):
+    """
+    this is what each worker process runs, parse a file and pickle the chunks one after the other to a file in
+    spool_dir so neither the worker nor the writer need to hold the whole file in memory
+    :param job: a job dict see make_jobs
+    :param spool_dir: directory for the spool files
+    :return: tablename and path of the spool file
+    """
+    tablename, chunks = parse_file(job)
+    fd, path = tempfile.mkstemp(suffix=".pkl", dir=spool_dir)
+    with os.fdopen(fd, "wb") as spool:
+        for chunk in chunks:
+            pickle.dump(chunk, spool, protocol=pickle.HIGHEST_PROTOCOL)
+    return tablename, path
+
+
+def read_spool(path):
+    """
+    read the chunks back from a spool file and remove it when done
+    :param path: path of the spool file from spool_file
+    :return: a generator of dataframes
+    """
+    with open(path, "rb") as spool:
+        while True:
+            try:
+                yield pickle.load(spool)
+            except EOFError:
+                break
+    os.remove(path)
+
+
+def iter_parsed(jobs, workers=1, spool_dir=None):
+    """
+    parse the files either serially or in a process pool. The results are always returned in the order of jobs so
+    the database ends up the same regardless of the number of workers. At most 2*workers files are parsed ahead of
+    the writer, their chunks wait on disk in spool_dir
+    :param jobs: list of jobs from make_jobs
+    :param workers: number of worker processes, 1 means no pool
+    :param spool_dir: where to put the spool files if None the system temp dir
+    :return: a generator of job, (tablename, generator of dataframes)
+    """
+    if workers is None or workers <= 1:
+        for job in jobs:
+            yield job, parse_file(job)
+    else:
+        with tempfile.TemporaryDirectory(dir=spool_dir) as spool, ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for job in jobs:
+                pending.append((job, pool.submit(spool_file, job, spool)))
+                if len(pending) >= 2 * workers:
+                    done_job, future = pending.popleft()
+                    tablename, path = future.result()
+                    yield done_job, (tablename, read_spool(path))
+            while len(pending) > 0:
+                done_job, future = pending.popleft()
+                tablename, path = future.result()
+                yield done_job, (tablename, read_spool(path))
+
+
+def file_checksum(file, block_size=1048576):
+    """
+    a quick checksum of a file, sha1 of its size and its first and last blocks. Hashing whole vcfs would take about
+    as long as parsing them, this is enough to notice that a file was replaced
+    :param file: path to the file
+    :param block_size: number of bytes to read from each end
+    :return: hex digest
+    """
+    size = os.path.getsize(file)
+    digest = hashlib.sha1(str(size).encode())
+    with open(file, "rb") as f:
+        digest.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(size - block_size, block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def manifest_entry(job, rows):
+    """
+    create a manifest row for a job that has been written to the database
+    :param job: a job dict see make_jobs
+    :param rows: number of rows that were inserted
+    :return: a dict with the columns of the load_manifest table
+    """
+    stat = os.stat(job["file"])
+    # expression goes straight to its final table everything else needs to be normalized
+    if STAGING_TABLES[job["dat_type"]].startswith("temp_"):
+        stage = "staged"
+    else:
+        stage = "done"
+    return {"samplename": str(job["samplename"]), "modality": job["modality"], "dat_type": job["dat_type"],
+            "file": job["file"], "size": stat.st_size, "mtime": stat.st_mtime,
+            "checksum": file_checksum(job["file"]), "rows": rows, "stage": stage, "updated": datetime.now()}
+
+
+def record_jobs(engine, entries):
+    """
+    add finished jobs to the manifest
+    :param engine: sqlalchemy engine
+    :param entries: list of dicts from manifest_entry
+    :return: nothing
+    """
+    if len(entries) > 0:
+        with engine.begin() as conn:
+            conn.execute(LoadManifest.__table__.insert(), entries)
+
+
+def remove_partial(jobs, engine):
+    """
+    if a load was interrupted some of the rows of the jobs that are not in the manifest may already be in the
+    database, delete them so they are not added twice
+    :param jobs: jobs that are not in the manifest
+    :param engine: sqlalchemy engine
+    :return: nothing
+    """
+    tables = {}
+    for job in jobs:
+        tables.setdefault(STAGING_TABLES[job["dat_type"]], set()).add(str(job["samplename"]))
+
+    meta = MetaData()
+    for tablename, samples in tables.items():
+        if not inspect(engine).has_table(tablename):
+            continue
+        table = Table(tablename, meta, autoload_with=engine)
+        with engine.begin() as conn:
+            present = conn.execute(select(table.c.samplename).distinct()).scalars().all()
+            partial = [sample for sample in present if str(sample) in samples]
+            if len(partial) > 0:
+                print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " +
+                      "Removing partially loaded samples from " + tablename)
+                conn.execute(delete(table).where(table.c.samplename.in_(partial)))
+
+
+def pending_jobs(jobs, engine, resume=False):
+    """
+    remove the jobs that are already in the manifest. If the file of a job changed after it was loaded there is no
+    way to undo it so this will raise an error
+    :param jobs: list of jobs from make_jobs
+    :param engine: sqlalchemy engine
+    :param resume: if this is resuming an interrupted load remove the partially loaded jobs
+    :return: a list of jobs that need to be loaded
+    """
+    manifest = LoadManifest.__table__
+    with engine.connect() as conn:
+        done = conn.execute(select(manifest.c.samplename, manifest.c.dat_type, manifest.c.size,
+                                   manifest.c.mtime, manifest.c.checksum)).fetchall()
+    done = {(row.samplename, row.dat_type): row for row in done}
+
+    pending = []
+    for job in jobs:
+        key = (str(job["samplename"]), job["dat_type"])
+        if key not in done:
+            pending.append(job)
+            continue
+        entry = done[key]
+        stat = os.stat(job["file"])
+        if (stat.st_size != entry.size or stat.st_mtime != entry.mtime) and \
+                file_checksum(job["file"]) != entry.checksum:
+            raise ValueError("{} for sample {} has changed since it was loaded".format(job["file"],
+                                                                                   job["samplename"]))
+
+    if len(pending) < len(jobs):
+        print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Skipping " +
+              str(len(jobs) - len(pending)) + " files that are already loaded")
+    if resume:
+        remove_partial(pending, engine)
+    return pending
+
+
+def needs_normalization(engine, dat_type):
+    """
+    check if there are staged files of a type waiting to be normalized. The normalization drops the temp table in
+    the same transaction so if it is gone the normalization finished but the manifest was not updated
+    :param engine: sqlalchemy engine
+    :param dat_type: column name in the files table
+    :return: True if the temp table needs to be normalized
+    """
+    manifest = LoadManifest.__table__
+    with engine.connect() as conn:
+        staged = conn.execute(select(func.count()).select_from(manifest).
+                              where(manifest.c.dat_type == dat_type, manifest.c.stage == "staged")).scalar()
+    if staged == 0:
+        return False
+    if not inspect(engine).has_table(STAGING_TABLES[dat_type]):
+        mark_normalized(engine, dat_type)
+        return False
+    return True
+
+
+def mark_normalized(engine, dat_type):
+    """
+    update the manifest after a temp table is normalized
+    :param engine: sqlalchemy engine
+    :param dat_type: column name in the files table
+    :return: nothing
+    """
+    manifest = LoadManifest.__table__
+    with engine.begin() as conn:
+        conn.execute(update(manifest).where(manifest.c.dat_type == dat_type, manifest.c.stage == "staged").
+                     values(stage="done", updated=datetime.now()))
+
+
+def write_batch(tablename, frames, engine, bulk=False):
+    """
+    insert a list of dataframes into a table in one transaction, gene/transcript names are replaced with their ids
+    :param tablename: name of the table
+    :param frames: list of dataframes with the same columns
+    :param engine: sqlalchemy engine
+    :param bulk: use the raw DBAPI executemany instead of to_sql see utils.bulk_insert
+    :return: nothing
+    """
+    batch = pd.concat(frames, ignore_index=True)
+    if tablename == "gene_expression":
+        batch = encode_expression_names(batch, engine, gene=True)
+    elif tablename == "transcript_expression":
+        batch = encode_expression_names(batch, engine, gene=False)
+
+    if bulk:
+        bulk_insert(batch, tablename, engine)
+    else:
+        with engine.begin() as conn:
+            batch.to_sql(tablename, conn, if_exists="append", index=False)
+
+
+def load_files(jobs, engine, workers=1, batch_rows=500000, spool_dir=None, bulk=False):
+    """
+    parse the files in jobs and insert them into the database. There is only one writer (this process) so there
+    is no lock contention in sqlite, the chunks are buffered per table and written once there are batch_rows rows
+    so the memory use does not depend on the size of the files
+    :param jobs: list of jobs from make_jobs
+    :param engine: sqlalchemy engine
+    :param workers: number of parser processes
+    :param batch_rows: number of rows to buffer before writing
+    :param spool_dir: where the workers put the parsed chunks, see iter_parsed
+    :param bulk: write with the raw DBAPI, see write_batch
+    :return: nothing
+    """
+    buffers = {}
+    buffered = {}
+    finished = {}  # jobs whose last chunk is in the buffer, they go to the manifest after the buffer is written
+    for job, (tablename, chunks) in iter_parsed(jobs, workers, spool_dir):
+        print("[" + datetime.now().strftime(
+            "%Y/%m/%d %H:%M:%S") + "] " + MESSAGES[job["dat_type"]] + str(job["samplename"]))
+        rows = 0
+        for df in chunks:
+            rows += df.shape[0]
+            buffers.setdefault(tablename, []).append(df)
+            buffered[tablename] = buffered.get(tablename, 0) + df.shape[0]
+            if buffered[tablename] >= batch_rows:
+                write_batch(tablename, buffers[tablename], engine, bulk)
+                record_jobs(engine, finished.get(tablename, []))
+                buffers[tablename] = []
+                buffered[tablename] = 0
+                finished[tablename] = []
+        finished.setdefault(tablename, []).append(manifest_entry(job, rows))
+
+    for tablename in finished.keys():  # a vcf without any variants does not have a buffer
+        if len(buffers.get(tablename, [])) > 0:
+            write_batch(tablename, buffers[tablename], engine, bulk)
+        record_jobs(engine, finished[tablename])
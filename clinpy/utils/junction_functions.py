@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+
+
+def overlap_fractions(start1, end1, start2, end2):
+    """
+    vectorized utils.calc_overlap, fraction of interval 1 that is covered by interval 2
+    :param start1: numpy array of starts
+    :param end1: numpy array of ends
+    :param start2: numpy array of starts
+    :param end2: numpy array of ends
+    :return: numpy array of fractions between 0 and 1
+    """
+    intersection = np.minimum(end1, end2) - np.maximum(start1, start2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.clip(intersection, 0, None) / (end1 - start1)
+
+
+def window_pairs(starts, lower, upper):
+    """
+    all (query, target) pairs where the target start is between the lower and upper bound of the query
+    :param starts: sorted numpy array of target starts
+    :param lower: lower bound of the start for each query
+    :param upper: upper bound of the start for each query
+    :return: two numpy arrays, positions in the queries and positions in starts
+    """
+    first = np.searchsorted(starts, lower, side="left")
+    last = np.searchsorted(starts, upper, side="right")
+    counts = np.maximum(last - first, 0)
+    queries = np.repeat(np.arange(len(first)), counts)
+    # position within each window
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    targets = np.repeat(first, counts) + offsets
+    return queries, targets
+
+
+def match_junctions(queries, junctions, tolerance=None, overlap=None, reciprocal=False, batch_size=10000):
+    """
+    match query junctions to junctions in the same chromosome and strand, with neither tolerance nor overlap the
+    start and end need to be identical. Targets are sorted by start and each query only looks at a window of them,
+    for overlaps the targets are split into length classes (powers of 2) so the window is bounded by the longest
+    junction in the class rather than the longest junction in the chromosome
+    :param queries: dataframe with start and end columns
+    :param junctions: dataframe with id, start and end columns
+    :param tolerance: a tuple of how much the start and end can differ
+    :param overlap: fraction of the query that needs to be covered by the junction
+    :param reciprocal: the query also needs to cover the same fraction of the junction
+    :param batch_size: number of queries to process at a time, limits the number of candidate pairs in memory
+    :return: a dataframe of query (position in queries), junction (id), overlap and match_overlap (fraction of the
+    junction covered by the query)
+    """
+    if tolerance is not None and overlap is not None:
+        raise NotImplementedError("you can specify tolerance OR overlap")
+
+    q_start = queries["start"].to_numpy(dtype=np.int64)
+    q_end = queries["end"].to_numpy(dtype=np.int64)
+    j_start = junctions["start"].to_numpy(dtype=np.int64)
+    j_end = junctions["end"].to_numpy(dtype=np.int64)
+    j_id = junctions["id"].to_numpy()
+
+    if overlap is None:
+        groups = [np.arange(len(j_start))]
+    else:
+        classes = np.ceil(np.log2(np.maximum(j_end - j_start, 1))).astype(np.int64)
+        groups = [np.flatnonzero(classes == cls) for cls in np.unique(classes)]
+
+    matches = []
+    for group in groups:
+        order = group[np.argsort(j_start[group], kind="stable")]
+        starts = j_start[order]
+        for i in range(0, len(q_start), batch_size):
+            qs = q_start[i:i + batch_size]
+            qe = q_end[i:i + batch_size]
+            if overlap is not None:
+                # the intersection has to be at least need long so the junction has to start before qe - need and
+                # can not start before qs + need - (longest junction in the class)
+                need = overlap * (qe - qs)
+                max_len = np.max(j_end[order] - starts) if len(order) > 0 else 0
+                lower, upper = qs + need - max_len, qe - need
+            elif tolerance is not None:
+                lower, upper = qs - tolerance[0], qs + tolerance[0]
+            else:
+                lower, upper = qs, qs
+
+            pairs_q, pairs_t = window_pairs(starts, lower, upper)
+            targets = order[pairs_t]
+            olap = overlap_fractions(qs[pairs_q], qe[pairs_q], j_start[targets], j_end[targets])
+            match_olap = overlap_fractions(j_start[targets], j_end[targets], qs[pairs_q], qe[pairs_q])
+
+            if overlap is not None:
+                # the window also has junctions that end before the query in the longer length classes, with
+                # overlap 0 they would pass the fraction check without touching the query
+                keep = (j_end[targets] >= qs[pairs_q]) & (j_start[targets] <= qe[pairs_q]) & (olap >= overlap)
+                if reciprocal:
+                    keep &= match_olap >= overlap
+            elif tolerance is not None:
+                keep = np.abs(j_end[targets] - qe[pairs_q]) <= tolerance[1]
+            else:
+                keep = j_end[targets] == qe[pairs_q]
+
+            matches.append(pd.DataFrame({"query": pairs_q[keep] + i, "junction": j_id[targets[keep]],
+                                         "overlap": olap[keep], "match_overlap": match_olap[keep]}))
+
+    if len(matches) == 0:
+        return pd.DataFrame(columns=["query", "junction", "overlap", "match_overlap"])
+    return pd.concat(matches, ignore_index=True)
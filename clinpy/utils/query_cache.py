@@ -0,0 +1,124 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.sql import ClauseElement
+
+from clinpy.database.ingest_tables import ProjectInfo
+from clinpy.utils.utils import insert_or_accumulate
+
+GENERATION = "generation"
+# changes only when tables or columns can change (loads), the schema snapshot is kept for it, see utils.schema
+SCHEMA_GENERATION = "schema_generation"
+
+
+def bump_generation(engine, name=GENERATION):
+    """
+    increment the generation of the project, anything that changes the data needs to call this so cached query
+    results are not used anymore
+    :param engine: sqlalchemy engine
+    :param name: GENERATION, SCHEMA_GENERATION or an expression generation (see expression_store)
+    :return: nothing
+    """
+    table = ProjectInfo.__table__
+    with engine.begin() as conn:
+        conn.execute(insert_or_accumulate(table, conn, ["name"], sums=["value"]).values(name=name, value=1))
+
+
+def current_generation(bind, name=GENERATION):
+    """
+    generation of the project
+    :param bind: session, connection or engine
+    :param name: GENERATION, SCHEMA_GENERATION or an expression generation (see expression_store)
+    :return: an integer, 0 if nothing has bumped it yet
+    """
+    table = ProjectInfo.__table__
+    generation = bind.execute(select(table.c.value).where(table.c.name == name)).scalar()
+    return 0 if generation is None else generation
+
+
+def cache_key(*parts):
+    """
+    hash of the parts of a query, sql statements are compiled and their parameters added, dataframes and pyranges
+    (regions) are hashed by their contents, paths of existing files (bed files) by their modification time and size
+    so they do not need to be parsed and everything else by its repr
+    :param parts: statements, dataframes or simple values
+    :return: a hex digest
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if hasattr(part, "df"):  # pyranges
+            part = part.df
+        if isinstance(part, ClauseElement):
+            compiled = part.compile()
+            digest.update(str(compiled).encode())
+            digest.update(pickle.dumps(sorted(compiled.params.items(), key=lambda item: item[0])))
+        elif isinstance(part, pd.DataFrame):
+            digest.update(pickle.dumps((list(part.columns), [part[col].to_numpy() for col in part.columns])))
+        elif isinstance(part, str) and os.path.isfile(part):
+            stat = os.stat(part)
+            digest.update(repr((os.path.abspath(part), stat.st_mtime_ns, stat.st_size)).encode())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class QueryCache:
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        in process LRU cache of query results (dataframes), entries are dropped starting from the least recently
+        used one when the total size goes over max_bytes and all of them when the generation of the project changes
+        :param max_bytes: size limit, results larger than this are not cached
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = None
+        self.lock = threading.Lock()  # shared by the threads of an assay
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def get(self, key, generation):
+        """
+        :param key: output of cache_key
+        :param generation: current generation of the project
+        :return: a copy of the cached dataframe or None
+        """
+        with self.lock:
+            if generation != self.generation:
+                self.clear()
+                self.generation = generation
+                return None
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0].copy()
+
+    def put(self, key, results, generation):
+        """
+        :param key: output of cache_key
+        :param results: a dataframe
+        :param generation: generation of the project when the query was run
+        :return: nothing
+        """
+        size = int(results.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            return
+        results = results.copy()
+        with self.lock:
+            if generation != self.generation:
+                self.clear()
+                self.generation = generation
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (results, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
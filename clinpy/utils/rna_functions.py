@@ -1,6 +1,10 @@
 import pandas as pd
-from sqlalchemy import Table, select
+from sqlalchemy import Table, MetaData, Index, select, and_, exists, func, literal_column, inspect
 import gc
+from datetime import datetime
+
+from clinpy.database.rna_tables import Genes, Transcripts, GeneExpression, TranscriptExpression
+from clinpy.utils.utils import insert_or_ignore, insert_or_accumulate, region_bin, bin_expression
 
 def modify_strand(df):
     if df["strand"]==0: #undefined
@@ -12,22 +16,100 @@ def modify_strand(df):
     else:
         raise ValueError("unknown value in strand column")
 
-def import_expression(file, samplename, engine, gene=True):
+def read_expression(file, samplename, gene=True):
+    """
+    read an RSEM gene or isoform results file and return a dataframe that is ready to be inserted
+    :param file: path to the RSEM output
+    :param samplename: name of the sample
+    :param gene: is this gene or isoform expression
+    :return: a dataframe with the same columns as the expression table
+    """
     dat = pd.read_csv(file, header=0, sep="\t")
     dat["samplename"] = samplename
     if gene:
         dat = dat.drop(columns=["length", "effective_length", "transcript_id(s)"])
         dat.columns = ["gene", "expected_count", "tpm", "fpkm", "samplename"]
-        dat.to_sql("gene_expression", engine, if_exists="append", index=False)
     else:
-        dat = pd.read_csv(file, header=0, sep="\t")
-        dat["samplename"] = samplename
         dat = dat.drop(columns=["length", "effective_length", "gene_id"])
         dat.columns = ["transcript", "expected_count", "tpm", "fpkm", "isopct", "samplename"]
+    return dat
+
+
+def encode_expression_names(dat, engine, gene=True):
+    """
+    replace the gene/transcript names in an expression dataframe with their integer ids from the genes/transcripts
+    tables, names that are not there yet are added
+    :param dat: output of read_expression
+    :param engine: sqlalchemy engine
+    :param gene: is this gene or isoform expression
+    :return: a dataframe with gene_id/transcript_id instead of gene/transcript
+    """
+    level = "gene" if gene else "transcript"
+    dictionary = Table(level + "s", MetaData(), autoload_with=engine)
+    names = dat[level].drop_duplicates().to_list()
+    with engine.begin() as conn:
+        conn.execute(insert_or_ignore(dictionary, conn), [{"name": name} for name in names])
+        # the dictionary is small (tens of thousands of rows) fetching it is cheaper than a huge IN list
+        ids = dict(conn.execute(select(dictionary.c.name, dictionary.c.id)).fetchall())
+    dat = dat.copy()
+    dat[level] = dat[level].map(ids)
+    return dat.rename(columns={level: level + "_id"})
+
+
+def add_expression_ids(engine, gene=True):
+    """
+    projects created before the genes/transcripts tables were added have the names in the expression tables, put the
+    names in the genes/transcripts table and rebuild the expression table with their ids. This is done in a single
+    transaction, nothing happens if the project does not have the table or already has the ids
+    :param engine: sqlalchemy engine
+    :param gene: is this gene or isoform expression
+    :return: nothing
+    """
+    level = "gene" if gene else "transcript"
+    inspector = inspect(engine)
+    name = "{}_expression".format(level)
+    if not inspector.has_table(name) or level not in [col["name"] for col in inspector.get_columns(name)]:
+        return
+    # the foreign keys do not have types, they come from the samples and genes/transcripts tables
+    meta = MetaData()
+    Table("samples", meta, autoload_with=engine)
+    dictionary = (Genes.__table__ if gene else Transcripts.__table__).to_metadata(meta)
+    model = (GeneExpression.__table__ if gene else TranscriptExpression.__table__).to_metadata(meta)
+    print("[" + datetime.now().strftime("%Y/%m/%d %H:%M:%S") + "] " + "Moving the {} names of {} to the {} "
+          "table".format(level, model.name, dictionary.name))
+    dictionary.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        old = Table(model.name, MetaData(), autoload_with=conn)
+        conn.execute(insert_or_ignore(dictionary, conn).from_select(
+            ["name"], select(old.c[level]).distinct().order_by(old.c[level])))
+        conn.exec_driver_sql("ALTER TABLE {0} RENAME TO {0}_old".format(model.name))
+        old = Table(model.name + "_old", MetaData(), autoload_with=conn)
+        model.create(conn)
+        metrics = [col.name for col in model.columns if col.name not in ["samplename", level + "_id"]]
+        conn.execute(model.insert().from_select(
+            ["samplename", level + "_id"] + metrics,
+            select(old.c.samplename, dictionary.c.id, *[old.c[metric] for metric in metrics]).
+            select_from(old.join(dictionary, dictionary.c.name == old.c[level]))))
+        old.drop(conn)
+
+
+def import_expression(file, samplename, engine, gene=True):
+    dat = read_expression(file, samplename, gene=gene)
+    dat = encode_expression_names(dat, engine, gene=gene)
+    if gene:
+        dat.to_sql("gene_expression", engine, if_exists="append", index=False)
+    else:
         dat.to_sql("transcript_expression", engine, if_exists="append", index=False)
 
 
-def import_temp_junction(file, samplename, engine, min_junc_reads, filtered=True):
+def read_temp_junction(file, samplename, min_junc_reads):
+    """
+    read a STAR SJ.out.tab file and return the junctions that pass the read filter
+    :param file: path to the SJ.out.tab file
+    :param samplename: name of the sample
+    :param min_junc_reads: minimum number of uniquely mapping reads
+    :return: a dataframe with the same columns as the temp junction tables
+    """
     j = pd.read_csv(file, header=None, sep="\t", low_memory=False)
     j["samplename"] = samplename
     # star annotated is useless because it is actually not the annotated but annotated+detected in
@@ -37,28 +119,162 @@ def import_temp_junction(file, samplename, engine, min_junc_reads, filtered=True
     j = j.drop(columns=["max_ohang", "motif", "annotated"])
     j["strand"] = j.apply(modify_strand, axis=1)
     j = j[(j.uniq_map >= min_junc_reads) & (j.strand != ".")]
+    return j
+
+
+def import_temp_junction(file, samplename, engine, min_junc_reads, filtered=True):
+    j = read_temp_junction(file, samplename, min_junc_reads)
     if not filtered:
         j.to_sql("temp_all_junc", engine, if_exists="append", index=False)
     else:
         j.to_sql("temp_filt_junc", engine, if_exists="append", index=False)
 
-def add_to_junction_tables(engine, meta, session, create=True, filtered=True):
+# cohort of samples without one in the recurrence tables
+NO_COHORT = "unassigned"
+
+
+def recurrence_query(mapping, junction_col, samples_table, source=None):
+    """
+    the per cohort summary of a set of sample to junction rows
+    :param mapping: table with samplename, uniq_map and multi_map columns
+    :param junction_col: the junction id column
+    :param samples_table: samples table
+    :param source: what to select from if not just the mapping table (a join with the mapping table in it)
+    :return: a select statement with the same columns as the recurrence tables
+    """
+    if source is None:
+        source = mapping
+    if "cohort" in samples_table.c:
+        cohort = func.coalesce(samples_table.c.cohort, literal_column("'{}'".format(NO_COHORT)))
+    else:
+        cohort = literal_column("'{}'".format(NO_COHORT))
+    query = select(junction_col, cohort, func.count(), func.sum(mapping.c.uniq_map), func.max(mapping.c.uniq_map),
+                   func.sum(mapping.c.multi_map), func.max(mapping.c.multi_map)). \
+        select_from(source.join(samples_table, samples_table.c.sample_id == mapping.c.samplename)). \
+        group_by(junction_col, cohort)
+    return query
+
+
+def update_junction_recurrence(conn, junc_temp, junc_table, samp_to_junc, recurrence_table, samples_table):
+    """
+    add the junctions in the temp table to the recurrence table, this needs to run before the mappings are inserted
+    because sample/junction pairs that are already in the mapping table are not counted again
+    :param conn: sqlalchemy connection
+    :param junc_temp: temp junctions table
+    :param junc_table: junctions or all_junctions table, the temp junctions need to be in it already
+    :param samp_to_junc: the sample to junction mapping table
+    :param recurrence_table: junction_recurrence or alljunction_recurrence table
+    :param samples_table: samples table
+    :return: nothing
+    """
+    junc_cols = ["chrom", "start", "end", "strand"]
+    same_junction = and_(*[junc_temp.c[col] == junc_table.c[col] for col in junc_cols])
+    new_rows = recurrence_query(junc_temp, junc_table.c.id, samples_table,
+                                source=junc_temp.join(junc_table, same_junction)). \
+        where(~exists().where(and_(samp_to_junc.c.samplename == junc_temp.c.samplename,
+                                   samp_to_junc.c.junction == junc_table.c.id)))
+    stmt = insert_or_accumulate(recurrence_table, conn, ["junction", "cohort"],
+                                sums=["num_samples", "total_uniq_map", "total_multi_map"],
+                                maxes=["max_uniq_map", "max_multi_map"])
+    conn.execute(stmt.from_select([col.name for col in recurrence_table.columns], new_rows))
+
+
+def build_junction_recurrence(engine, filtered=True):
+    """
+    (re)build a recurrence table from its mapping table, only needed for projects that were created before the
+    recurrence tables existed, after that they are updated as samples are added
+    :param engine: sqlalchemy engine
+    :param filtered: junctions or all_junctions
+    :return: nothing
+    """
+    meta = MetaData()
+    if filtered:
+        samp_to_junc = Table("sample_to_junction", meta, autoload_with=engine)
+        recurrence_table = Table("junction_recurrence", meta, autoload_with=engine)
+    else:
+        samp_to_junc = Table("sample_to_alljunction", meta, autoload_with=engine)
+        recurrence_table = Table("alljunction_recurrence", meta, autoload_with=engine)
+    samples_table = Table("samples", meta, autoload_with=engine)
+    with engine.begin() as conn:
+        conn.execute(recurrence_table.delete())
+        conn.execute(recurrence_table.insert().from_select(
+            [col.name for col in recurrence_table.columns],
+            recurrence_query(samp_to_junc, samp_to_junc.c.junction, samples_table)))
+
+
+def normalize_junction_tables(engine, junc_temp, junc_table, samp_to_junc, recurrence_table=None,
+                              samples_table=None):
+    """
+    move the junctions from the temp table to the junction and mapping tables without leaving the database, this is
+    done in a single transaction with INSERT ... SELECT statements so memory use does not depend on the cohort size.
+    Junctions that are already in the project are skipped by the unique index on (chrom, start, end, strand) so the
+    same statements work for new and existing projects and the cost depends only on the size of the temp table
+    :param engine: sqlalchemy engine
+    :param junc_temp: temp junctions table
+    :param junc_table: junctions or all_junctions table
+    :param samp_to_junc: the sample to junction mapping table
+    :param recurrence_table: junction recurrence table to update, see update_junction_recurrence
+    :param samples_table: samples table, needed for the cohorts if there is a recurrence table
+    :return: nothing, the temp table is dropped at the end
+    """
+    junc_cols = ["chrom", "start", "end", "strand"]
+    same_junction = and_(*[junc_temp.c[col] == junc_table.c[col] for col in junc_cols])
+    with engine.begin() as conn:
+        # the joins below are on all 4 columns, without this they are full scans of the temp table
+        Index("ix_{}_key".format(junc_temp.name), *[junc_temp.c[col] for col in junc_cols]).create(conn)
+
+        distinct_junc = select(*[junc_temp.c[col] for col in junc_cols],
+                               bin_expression(junc_temp.c.start, junc_temp.c.end)).distinct(). \
+            order_by(*[junc_temp.c[col] for col in junc_cols])
+        conn.execute(insert_or_ignore(junc_table, conn).from_select(junc_cols + ["bin"], distinct_junc))
+
+        if recurrence_table is not None:
+            update_junction_recurrence(conn, junc_temp, junc_table, samp_to_junc, recurrence_table, samples_table)
+
+        mapping = select(junc_temp.c.samplename, junc_table.c.id, junc_temp.c.uniq_map, junc_temp.c.multi_map). \
+            select_from(junc_temp.join(junc_table, same_junction))
+        conn.execute(insert_or_ignore(samp_to_junc, conn).from_select(
+            ["samplename", "junction", "uniq_map", "multi_map"], mapping))
+        junc_temp.drop(conn)
+
+
+def add_to_junction_tables(engine, meta, session, create=True, filtered=True, in_database=True):
+    """
+    process the temp junctions table and then remove it
+    :param engine: sqlalchemy engine
+    :param meta: project db metadata
+    :param session: session object, only used if in_database is False
+    :param create: is this a new project or added to an existing one, only used if in_database is False
+    :param filtered: are these filtered junctions
+    :param in_database: do the normalization with INSERT ... SELECT statements (see normalize_junction_tables)
+    otherwise the junctions go through pandas
+    :return: nothing
+    """
     meta.reflect()
     if filtered:
         table = "junctions"
-        mapping = "sample_to_junctions"
+        mapping = "sample_to_junction"
         temp = "temp_filt_junc"
         junc_table = Table("junctions", meta, autoload=True, autoload_with=engine)
         samp_to_junc = Table("sample_to_junction", meta, autoload=True, autoload_with=engine)
         junc_temp = Table("temp_filt_junc", meta, autoload=True, autoload_with=engine)
+        recurrence = "junction_recurrence"
     else:
         table = "all_junctions"
-        mapping = "sample_to_alljunctions"
+        mapping = "sample_to_alljunction"
         temp = "temp_all_junc"
         junc_temp = Table("temp_all_junc", meta, autoload=True, autoload_with=engine)
         junc_table = Table("all_junctions", meta, autoload=True, autoload_with=engine)
         samp_to_junc = Table("sample_to_alljunction", meta, autoload=True, autoload_with=engine)
+        recurrence = "alljunction_recurrence"
+
+    samples_table = Table("samples", meta, autoload=True, autoload_with=engine)
+    recurrence_table = meta.tables.get(recurrence)  # None for projects without recurrence tables
 
+    if in_database:
+        normalize_junction_tables(engine, junc_temp, junc_table, samp_to_junc, recurrence_table, samples_table)
+        meta.remove(junc_temp)
+        return
 
     if create:
         # this means the all_junctions and junction tables are empty
@@ -67,6 +283,7 @@ def add_to_junction_tables(engine, meta, session, create=True, filtered=True):
         distinct_junc = session.execute(distinct_junc).fetchall()
         distinct_junc = pd.DataFrame(distinct_junc)
         distinct_junc.columns = ["chrom", "start", "end", "strand"]
+        distinct_junc["bin"] = region_bin(distinct_junc["start"], distinct_junc["end"])
         # this may take a while and run out of memory probably need a generator
         distinct_junc.to_sql(table, engine, index=False, if_exists="append")
         del (distinct_junc)
@@ -74,19 +291,15 @@ def add_to_junction_tables(engine, meta, session, create=True, filtered=True):
     else:
         # this means there are already files in junctions and alljunctions tables so we need to figure
         # out what the junction ids are if they are in the table and insert new ones
-        new_juncs = select(junc_temp.c.chrom, junc_temp.c.start, junc_temp.c.end,
-                           junc_temp.c.strand).distinct().join(junc_table,
-                                                               (junc_temp.c.chrom == junc_table.c.chrom) &
-                                                               (junc_temp.c.start == junc_table.c.start) &
-                                                               (junc_temp.c.end == junc_table.c.end) &
-                                                               (junc_temp.c.strand == junc_table.c.strand)). \
-            add_columns(junc_table.c.id).filter(junc_table.c.id == None)
+        same_junction = (junc_temp.c.chrom == junc_table.c.chrom) & (junc_temp.c.start == junc_table.c.start) & \
+                        (junc_temp.c.end == junc_table.c.end) & (junc_temp.c.strand == junc_table.c.strand)
+        new_juncs = select(junc_temp.c.chrom, junc_temp.c.start, junc_temp.c.end, junc_temp.c.strand).distinct(). \
+            select_from(junc_temp.outerjoin(junc_table, same_junction)).filter(junc_table.c.id == None)
         new_juncs = session.execute(new_juncs).fetchall()
 
         if len(new_juncs)>0:
-            new_juncs = pd.DataFrame(new_juncs)
-            new_juncs.columns = ["chrom", "start", "end", "strand", "id"]
-            new_juncs = new_juncs.drop(columns=["id"])
+            new_juncs = pd.DataFrame(new_juncs, columns=["chrom", "start", "end", "strand"])
+            new_juncs["bin"] = region_bin(new_juncs["start"], new_juncs["end"])
             new_juncs.to_sql(table, engine, if_exists="append", index=False)
 
     query = select(junc_temp.c.samplename, junc_temp.c.uniq_map,
@@ -97,6 +310,9 @@ def add_to_junction_tables(engine, meta, session, create=True, filtered=True):
         add_columns(junc_table.c.id)
     junction_mapping = pd.DataFrame(session.execute(query).fetchall())
     junction_mapping.columns = ["samplename", "uniq_map", "multi_map", "junction"]
+    if recurrence_table is not None:
+        with engine.begin() as conn:
+            update_junction_recurrence(conn, junc_temp, junc_table, samp_to_junc, recurrence_table, samples_table)
     junction_mapping.to_sql(mapping, engine, index=False, if_exists="append")
     del (junction_mapping)
     gc.collect()
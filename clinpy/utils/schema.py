@@ -0,0 +1,157 @@
+import json
+import threading
+
+from sqlalchemy import Column, ForeignKeyConstraint, Index, MetaData, Table, inspect, select
+from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.sql import sqltypes
+
+from clinpy.database.ingest_tables import ProjectInfo, SchemaSnapshot
+from clinpy.utils.query_cache import SCHEMA_GENERATION, current_generation
+from clinpy.utils.utils import project_table
+
+# reflected schemas shared by all the assays of a process, engine url: (schema generation, MetaData)
+_SCHEMAS = {}
+_LOCK = threading.RLock()
+
+
+def describe_metadata(meta):
+    """
+    plain description of the tables of a MetaData, this is what the snapshot stores so loading it does not run
+    anything from the database and does not depend on the sqlalchemy version
+    :param meta: reflected MetaData
+    :return: a list of dicts with the name, columns, indexes and foreign keys of each table
+    """
+    tables = []
+    for table in meta.sorted_tables:
+        tables.append({
+            "name": table.name,
+            "columns": [{"name": col.name, "type": type(col.type).__name__, "nullable": col.nullable,
+                         "primary_key": col.primary_key} for col in table.columns],
+            "indexes": [{"name": index.name, "columns": [col.name for col in index.columns], "unique": index.unique}
+                        for index in table.indexes],
+            "foreign_keys": [{"columns": [fk.parent.name for fk in constraint.elements],
+                              "references": [fk.target_fullname for fk in constraint.elements]}
+                             for constraint in table.foreign_key_constraints]})
+    return tables
+
+
+def column_type(name, dialect):
+    """
+    the type of a column from the name describe_metadata stored, generic types are adapted to the dialect by
+    sqlalchemy like reflected ones
+    :param name: class name of the type
+    :param dialect: dialect of the engine, for the types that only it has
+    :return: a sqlalchemy type, NullType if it is not known
+    """
+    types = {cls.__name__: cls for cls in getattr(dialect, "ischema_names", {}).values()}
+    coltype = types.get(name, getattr(sqltypes, name, None))
+    if not isinstance(coltype, type) or not issubclass(coltype, sqltypes.TypeEngine):
+        return sqltypes.NullType()
+    try:
+        return coltype()
+    except TypeError:  # types that need arguments
+        return sqltypes.NullType()
+
+
+def metadata_from_description(tables, dialect):
+    """
+    :param tables: from describe_metadata
+    :param dialect: dialect of the engine
+    :return: a MetaData with the tables
+    """
+    meta = MetaData()
+    for table in tables:
+        Table(table["name"], meta,
+              *[Column(col["name"], column_type(col["type"], dialect), nullable=col["nullable"],
+                       primary_key=col["primary_key"]) for col in table["columns"]],
+              *[ForeignKeyConstraint(fk["columns"], fk["references"]) for fk in table["foreign_keys"]],
+              *[Index(index["name"], *index["columns"], unique=index["unique"]) for index in table["indexes"]])
+    return meta
+
+
+def save_schema_snapshot(engine, meta=None):
+    """
+    reflect the whole project and store a description of it (see describe_metadata) with the current schema
+    generation, create_project.py does this at the end of every load so assays can skip reflection entirely
+    :param engine: sqlalchemy engine
+    :param meta: MetaData to store instead of reflecting engine, the catalog of a sharded project also has the tables
+    of the shards in there (see utils.shards)
+    :return: nothing
+    """
+    snapshot = SchemaSnapshot.__table__
+    if meta is None:
+        meta = MetaData()
+        meta.reflect(bind=engine, only=project_table)
+    data = json.dumps({"tables": describe_metadata(meta)}).encode()
+    with engine.begin() as conn:
+        generation = current_generation(conn, SCHEMA_GENERATION)
+        conn.execute(snapshot.delete())
+        conn.execute(snapshot.insert().values(generation=generation, snapshot=data))
+
+
+def load_schema_snapshot(engine, generation):
+    """
+    :param engine: sqlalchemy engine
+    :param generation: current schema generation of the project
+    :return: the MetaData from save_schema_snapshot or None if there is none for this generation or it cannot be
+    read (snapshots of older versions were pickled), the tables are reflected as they are used then
+    """
+    snapshot = SchemaSnapshot.__table__
+    with engine.connect() as conn:
+        data = conn.execute(select(snapshot.c.snapshot).where(snapshot.c.generation == generation)).scalar()
+    if data is None:
+        return None
+    try:
+        meta = metadata_from_description(json.loads(data)["tables"], engine.dialect)
+    except (ValueError, KeyError, TypeError):
+        return None
+    meta.info["complete"] = True  # every table is in there, see reflected_table
+    return meta
+
+
+def project_metadata(engine):
+    """
+    MetaData of a project shared by every assay in the process, tables are added to it as they are used (see
+    reflected_table). It is replaced when the schema generation of the project changes because a load can add tables
+    and columns, a new one starts from the snapshot if there is one for the current schema generation
+    :param engine: sqlalchemy engine
+    :return: MetaData
+    """
+    key = str(engine.url)
+    tables = inspect(engine).get_table_names()
+    generation = None
+    if ProjectInfo.__tablename__ in tables:
+        with engine.connect() as conn:
+            generation = current_generation(conn, SCHEMA_GENERATION)
+    with _LOCK:
+        cached = _SCHEMAS.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        meta = None
+        if generation is not None and SchemaSnapshot.__tablename__ in tables:
+            meta = load_schema_snapshot(engine, generation)
+        if meta is None:
+            meta = MetaData()
+        _SCHEMAS[key] = (generation, meta)
+        return meta
+
+
+def reflected_table(name, meta, bind, required=True):
+    """
+    get a table from a MetaData reflecting it the first time it is used
+    :param name: table name
+    :param meta: MetaData
+    :param bind: engine to reflect the table from
+    :param required: raise NoSuchTableError if the table does not exist, otherwise return None
+    :return: sqlalchemy Table
+    """
+    table = meta.tables.get(name)
+    if table is not None:
+        return table
+    with _LOCK:
+        table = meta.tables.get(name)
+        if table is None and not meta.info.get("complete", False) and inspect(bind).has_table(name):
+            table = Table(name, meta, autoload_with=bind)
+    if table is None and required:
+        raise NoSuchTableError(name)
+    return table
@@ -0,0 +1,179 @@
+import os
+from urllib.request import pathname2url
+
+from sqlalchemy import event, func, select
+
+from clinpy.database.ingest_tables import ProjectShard
+from clinpy.utils.snp_functions import NO_COHORT
+from clinpy.utils.utils import read_engine
+
+# name of the shard database in the connections of shard_engine
+SHARD_SCHEMA = "shard"
+
+
+def sharded_tables(meta, by="chrom"):
+    """
+    which tables of a project are split between the shards and how, everything else stays in the catalog.
+    By chromosome the tables with a chrom column (junctions and variants) are split and the tables that have a foreign
+    key to them (sample mappings, recurrence, counts, impacts) follow their rows. By cohort only the tables that map
+    samples to junctions or variants are split, the junctions and variants themselves and the cohort level tables
+    (counts, recurrence) are in the catalog
+    :param meta: reflected MetaData of the project
+    :param by: "chrom" or "cohort"
+    :return: a dict of table name: (column, parent table, parent column, key column), if parent table is None the
+    rows go to the shard of their column value, otherwise column is a foreign key to parent column and the rows go to
+    the shard of the key column of the parent row
+    """
+    if by not in ["chrom", "cohort"]:
+        raise ValueError("projects can only be sharded by chrom or cohort")
+    chrom_tables = {table.name for table in meta.tables.values() if "chrom" in table.columns}
+    plan = {}
+    for table in meta.sorted_tables:
+        parents = [fk for fk in table.foreign_keys if fk.column.table.name in chrom_tables]
+        if by == "chrom" and table.name in chrom_tables:
+            plan[table.name] = ("chrom", None, None, None)
+        elif by == "chrom" and len(parents) > 0:
+            plan[table.name] = (parents[0].parent.name, parents[0].column.table.name, parents[0].column.name, "chrom")
+        elif by == "cohort" and len(parents) > 0 and "samplename" in table.columns:
+            plan[table.name] = ("samplename", "samples", "sample_id", "cohort")
+    return plan
+
+
+def shard_filter(table, plan, keys, tables):
+    """
+    where clause for the rows of a table that go to a shard
+    :param table: sqlalchemy table, one of sharded_tables
+    :param plan: from sharded_tables
+    :param keys: chromosomes or cohorts of the shard
+    :param tables: dict of table name: sqlalchemy table to get the parent tables from
+    :return: a sqlalchemy clause
+    """
+    column, parent, parent_column, key = plan[table.name]
+    if parent is None:
+        return table.c[column].in_(keys)
+    parent = tables[parent]
+    key = parent.c[key] if key == "chrom" else func.coalesce(parent.c[key], NO_COHORT)
+    return table.c[column].in_(select(parent.c[parent_column]).where(key.in_(keys)))
+
+
+def shard_weights(conn, meta, plan, by="chrom"):
+    """
+    how big each chromosome or cohort is, used to balance the shards
+    :param conn: sqlalchemy connection of the project
+    :param meta: reflected MetaData of the project
+    :param plan: from sharded_tables
+    :param by: "chrom" or "cohort"
+    :return: a dict of chromosome or cohort: number of rows
+    """
+    weights = {}
+    if by == "chrom":
+        for name, (column, parent, _, _) in plan.items():
+            if parent is None:
+                table = meta.tables[name]
+                for chrom, rows in conn.execute(select(table.c.chrom, func.count()).group_by(table.c.chrom)):
+                    weights[chrom] = weights.get(chrom, 0) + rows
+    else:
+        samples = meta.tables["samples"]
+        cohort = func.coalesce(samples.c.cohort, NO_COHORT)
+        for name in plan.keys():
+            table = meta.tables[name]
+            query = select(cohort, func.count()).select_from(
+                table.join(samples, samples.c.sample_id == table.c.samplename)).group_by(cohort)
+            for key, rows in conn.execute(query):
+                weights[key] = weights.get(key, 0) + rows
+        # cohorts without any data still get a shard so every sample has one
+        for key in conn.execute(select(cohort).distinct()).scalars():
+            weights.setdefault(key, 0)
+    return weights
+
+
+def split_keys(weights, num_shards):
+    """
+    split chromosomes or cohorts into shards of about the same size, the biggest ones are placed first each in the
+    shard that has the fewest rows so far
+    :param weights: from shard_weights
+    :param num_shards: number of shards, at most one per key
+    :return: a list of lists of keys
+    """
+    num_shards = max(1, min(num_shards, len(weights)))
+    shards = [[] for _ in range(num_shards)]
+    sizes = [0] * num_shards
+    for key in sorted(weights, key=lambda key: (-weights[key], str(key))):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append(key)
+        sizes[smallest] += weights[key]
+    return [sorted(keys) for keys in shards if len(keys) > 0]
+
+
+def read_shards(engine):
+    """
+    :param engine: engine of the catalog
+    :return: how the project was sharded ("chrom" or "cohort") and a dict of shard file name: list of keys
+    """
+    table = ProjectShard.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(select(table.c.key, table.c.shard, table.c.by).order_by(table.c.shard,
+                                                                                   table.c.key)).all()
+    if len(rows) == 0:
+        raise ValueError("{} is not the catalog of a sharded project".format(engine.url.database))
+    shards = {}
+    for key, shard, by in rows:
+        shards.setdefault(shard, []).append(key)
+    return rows[0].by, shards
+
+
+def shard_uri(path, immutable=False):
+    """
+    :param path: path of a shard database
+    :param immutable: immutable=1 instead of mode=ro, see utils.read_engine
+    :return: a sqlite uri that opens the shard read only
+    """
+    return "file:{}?{}".format(pathname2url(os.path.abspath(path)), "immutable=1" if immutable else "mode=ro")
+
+
+def attach_shard(conn, path, immutable=False):
+    """
+    attach a shard to a connection of shard_engine as the shard database, replacing the one that is attached. Tables
+    are not qualified in the queries of the assays, sqlite looks for them in the catalog first and then in the shard
+    :param conn: sqlalchemy connection, it cannot be in a transaction
+    :param path: path of the shard database
+    :param immutable: see shard_uri
+    :return: nothing
+    """
+    uri = shard_uri(path, immutable)
+    if conn.info.get(SHARD_SCHEMA) == uri:  # the pool hands out connections with the last shard still attached
+        return
+    if SHARD_SCHEMA in conn.info:
+        conn.exec_driver_sql("DETACH DATABASE {}".format(SHARD_SCHEMA))
+        del conn.info[SHARD_SCHEMA]
+    conn.exec_driver_sql("ATTACH DATABASE ? AS {}".format(SHARD_SCHEMA), (uri,))
+    conn.info[SHARD_SCHEMA] = uri
+
+
+def shard_engine(catalog, immutable=False, pool_size=5, max_overflow=10, busy_timeout=30):
+    """
+    read only engine of the catalog of a sharded project (see shard_project.py and utils.read_engine). Every
+    connection has a shard attached, the first one until attach_shard replaces it, so the tables of the shards can be
+    reflected like those of a regular project
+    :param catalog: path of the catalog database
+    :param immutable: open the catalog and the shards with immutable=1
+    :param pool_size: number of connections kept open
+    :param max_overflow: number of connections that can be opened on top of pool_size
+    :param busy_timeout: seconds to wait for a lock
+    :return: a sqlalchemy engine, how the project was sharded and a dict of shard path: list of keys
+    """
+    engine = read_engine(catalog, immutable, pool_size, max_overflow, busy_timeout)
+    by, shards = read_shards(engine)
+    shards = {os.path.join(os.path.dirname(os.path.abspath(catalog)), shard): keys for shard, keys in shards.items()}
+    for path in shards.keys():
+        if not os.path.isfile(path):
+            raise FileNotFoundError("could not find the shard {}".format(path))
+    engine.dispose()  # the connection read_shards used does not have a shard attached
+    first = shard_uri(list(shards.keys())[0], immutable)
+
+    @event.listens_for(engine, "connect")
+    def first_shard(dbapi_connection, connection_record):
+        dbapi_connection.execute("ATTACH DATABASE ? AS {}".format(SHARD_SCHEMA), (first,))
+        connection_record.info[SHARD_SCHEMA] = first
+
+    return engine, by, shards
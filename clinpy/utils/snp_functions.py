@@ -2,10 +2,22 @@ import gc
 import os
 import pandas as pd
 import pysam
-from functools import reduce
-from sqlalchemy import Table, select
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, reduce
+from sqlalchemy import Table, MetaData, Index, Float, String, select, and_, exists, func, case, cast, literal, literal_column, inspect
 
-from clinpy.utils.utils import dict_to_table
+from clinpy.utils.utils import dict_to_table, insert_or_ignore, insert_or_accumulate, create_table
+
+
+# vcf header types of the format fields
+VCF_TYPES = {"Integer": "int", "Float": "float", "String": "str", "Character": "str", "Flag": "bool"}
+# number of values kept for per allele/genotype format fields, see format_columns
+FORMAT_WIDTHS = {"R": 2, "G": 3}
+# nullable pandas types, otherwise a missing value turns an integer column into float
+PANDAS_TYPES = {"int": "Int64", "float": "float64", "bool": "boolean"}
+# impact field types in vcf.yaml and how the text is converted, strings are kept as they are, see csq_decoder
+CSQ_CONVERTERS = {"str": None, "int": int, "float": float, "bool": bool}
 
 
 def compare_fields(files, info_name="CSQ", not_same="error", info_sep="|"):
@@ -15,10 +27,11 @@ def compare_fields(files, info_name="CSQ", not_same="error", info_sep="|"):
     :param files: list of vcf paths
     :param field_name: info fileld name to investigate
     :param not_same: what to do if they are not identical, "error", "union", "intersection"
-    :return: list of fields to get
+    :return: list of fields to get and a dict of format fields with their type and number from the vcf header
     """
     descriptions = []
     formats = []
+    format_specs = {}
     for file in files:
         if not os.path.isfile(file):
             raise FileNotFoundError("{} file does not exist".format(file))
@@ -28,6 +41,9 @@ def compare_fields(files, info_name="CSQ", not_same="error", info_sep="|"):
             info = header.info[info_name]
             descriptions.append(info.description)
             formats.append(list(header.formats.keys()))
+            for key, format in header.formats.items():
+                if key.lower() not in format_specs:  # the first file with a format decides its type
+                    format_specs[key.lower()] = {"type": VCF_TYPES.get(format.type, "str"), "number": format.number}
 
     if not all(descriptions) or not all(formats):
         if not_same == "error":
@@ -48,10 +64,90 @@ def compare_fields(files, info_name="CSQ", not_same="error", info_sep="|"):
         formats = formats[0]
 
     fields = [field.lower() for field in fields]
-    formats = [format.lower() for format in formats]
+    formats = {format.lower(): format_specs[format.lower()] for format in formats}
     return fields, formats
 
 
+def format_columns(formats):
+    """
+    sample variants columns of the format fields. GT is stored as the number of alt alleles (0 hom ref, 1 het, 2 hom
+    alt, NULL if missing) and a phased flag. Only the first alt allele is kept so Number=R fields become 2 columns
+    (ref, alt), Number=G 3 columns (the diploid ref/ref, ref/alt, alt/alt genotypes), Number=A and Number=1 a single
+    column and fixed numbers one column per value, e.g. ad_0 and ad_1. Anything else (Number=. and strings with more
+    than one value) is stored as comma separated text
+    :param formats: output of compare_fields
+    :return: dict of column name to type, format name and the position of the value in the pysam tuple (None for
+    scalars and "join" for text)
+    """
+    columns = {}
+    for format, spec in formats.items():
+        number = spec["number"]
+        if format == "gt":
+            columns["gt"] = {"type": "int", "format": format, "position": None}
+            columns["gt_phased"] = {"type": "bool", "format": format, "position": None}
+        elif number == 1:
+            columns[format] = {"type": spec["type"], "format": format, "position": None}
+        elif spec["type"] != "str" and number == "A":
+            columns[format] = {"type": spec["type"], "format": format, "position": 0}
+        elif spec["type"] != "str" and (number in FORMAT_WIDTHS or isinstance(number, int)):
+            for i in range(FORMAT_WIDTHS.get(number, number)):
+                columns["{}_{}".format(format, i)] = {"type": spec["type"], "format": format, "position": i}
+        else:
+            columns[format] = {"type": "str", "format": format, "position": "join"}
+    return columns
+
+
+def genotype_code(alleles):
+    """
+    number of alt (first alt allele) alleles in a pysam genotype
+    :param alleles: pysam GT tuple
+    :return: 0, 1 or 2, None if the genotype is missing
+    """
+    if alleles is None or all(allele is None for allele in alleles):
+        return None
+    return sum(1 for allele in alleles if allele == 1)
+
+
+def format_values(sample, columns):
+    """
+    convert the format fields of a pysam sample to the sample variants columns
+    :param sample: pysam VariantRecordSample
+    :param columns: output of format_columns
+    :return: dict of column name to value
+    """
+    values = {}
+    fetched = {}  # gt and the per allele fields are more than one column
+    for column, spec in columns.items():
+        if spec["format"] not in fetched:
+            fetched[spec["format"]] = sample.get(spec["format"].upper())
+        value = fetched[spec["format"]]
+        if column == "gt":
+            values[column] = genotype_code(value)
+        elif column == "gt_phased":
+            values[column] = sample.phased if genotype_code(sample.get("GT")) is not None else None
+        elif value is None or spec["position"] is None:
+            values[column] = value
+        elif spec["position"] == "join":
+            values[column] = ",".join(["." if item is None else str(item) for item in value]) \
+                if isinstance(value, tuple) else str(value)
+        else:
+            values[column] = value[spec["position"]] if len(value) > spec["position"] else None
+    return values
+
+
+def typed_chunk(chunk, columns):
+    """
+    set the dtypes of the format columns so missing values do not turn integer columns into floats or strings
+    :param chunk: dataframe from parse_vcf_chunks
+    :param columns: output of format_columns
+    :return: the same dataframe
+    """
+    for column, spec in columns.items():
+        if spec["type"] in PANDAS_TYPES:
+            chunk[column] = chunk[column].astype(PANDAS_TYPES[spec["type"]])
+    return chunk
+
+
 def coerce(effects, type_dict):
     """
     take a description from config dict and convert them to appropriatie types
@@ -78,60 +174,258 @@ def coerce(effects, type_dict):
     return new_var
 
 
-def parse_vcf(file, fields, formats, type_dict, field_name="CSQ", field_split="|", ignore=True):
+def csq_decoder(split_fields, fields, type_dict):
     """
-    get the consequences of variants based on the field name
+    compile the impact fields of a vcf header and the types in vcf.yaml into what parse_vcf_chunks needs to decode a
+    consequence, this is done once per file instead of looking up every field and its type for every consequence
+    :param split_fields: lower case field names in the description of the info field, without the allele
+    :param fields: output of compare fields
+    :param type_dict: the dict of data types and whether to index from vcf.yaml
+    :return: a list of (column, position in the split consequence, converter or None for strings) and a list of the
+    fields of the header that are not in fields
+    """
+    decoder = {}
+    for i, field in enumerate(split_fields):  # if a field is there twice the last one is used
+        if field in fields and field in type_dict and type_dict[field]["type"] in CSQ_CONVERTERS:
+            decoder[field] = (field, i + 1, CSQ_CONVERTERS[type_dict[field]["type"]])
+    missing = [field for field in split_fields if field not in fields]
+    return list(decoder.values()), missing
+
+
+def decode_csq(consqs, decoder):
+    """
+    decode the consequences of a chunk of variants column by column, each column is converted in a single pass
+    :param consqs: list of consequences split by the field separator, the allele first
+    :param decoder: from csq_decoder
+    :return: a dict of column name: list of values, empty values are None
+    """
+    if len(consqs) == 0:
+        return {column: [] for column, position, convert in decoder}
+    values = list(zip(*consqs))
+    columns = {}
+    for column, position, convert in decoder:
+        if convert is None:
+            columns[column] = [value or None for value in values[position]]
+        else:
+            columns[column] = [None if value == "" else convert(value) for value in values[position]]
+    return columns
+
+
+def parse_vcf_chunks(file, fields, formats, type_dict, field_name="CSQ", field_split="|", ignore=True,
+                     chunk_size=100000, region=None, empty=False):
+    """
+    get the consequences of variants based on the field name, this is a generator that yields dataframes of about
+    chunk_size rows (a variant is never split between chunks) so the whole vcf is never in memory. Each row is a
+    variant/consequence pair, the chunks always have the same columns so they can be appended to the same table
     :param file: vcf file connection via pysam
     :param fields: output of compare fields
     :param formats: output of compare fileds
     :param type_dict the dict of data types and whether to index from vcf.yaml
     :param field_name: name of the variant consequence field default is CSQ for VEP
     :param field_split: split char of the specifiic info
-    :return: a dataframe this is to be inserted as a temp table and then further processed like junctions
+    :param ignore: ignore the impact fields that are not in the vcf config
+    :param chunk_size: number of rows in a chunk
+    :param region: only parse the variants that start in this (contig, start, end) region, see vcf_regions. The file
+    needs an index
+    :param empty: yield an empty chunk with all the columns if there are no variants, otherwise nothing is yielded
+    :return: a generator of dataframes, these are to be inserted as a temp table and then further processed like
+    junctions
     """
     header = file.header
     info = header.info[field_name]
     split_fields = info.description.split(field_split)[1:]
     split_fields = [field.lower() for field in
                     split_fields]  # this is re-done in the vcf to compare with the union/intersection stuff
+    decoder, missing = csq_decoder(split_fields, fields, type_dict)
+    if len(missing) > 0 and not ignore:
+        raise ValueError("{} is not defined in the vcf config".format(", ".join(missing)))
+
+    # only the fields in the vcf config are kept so these are the only impact columns we will ever see
+    impact_cols = [field for field in fields if field in type_dict.keys()]
+    format_cols = format_columns(formats)
+    variant_cols = ["chrom", "pos", "id", "ref", "alt", "qual", "filter"] + list(format_cols)
+    columns = variant_cols + impact_cols
+    # impact columns that are not in this file or have a type that is not converted are always empty
+    empty_cols = [column for column in impact_cols if column not in [decoded[0] for decoded in decoder]]
+    # variants without consequences get one with all the fields empty
+    no_consequence = [""] * (len(split_fields) + 1)
+
+    # one list per variant column, the consequences are kept split and decoded a column at a time per chunk
+    buffers = {column: [] for column in variant_cols}
+    chunk_consqs = []
+    yielded = False
+    records = file if region is None else file.fetch(*region)
+    for var in records:  # go over each variant
+        if region is not None and region[1] is not None and var.start < region[1]:
+            continue  # fetch also returns the variants that start in the previous region and overlap this one
+        # the first value is the allele, this is vep specific not ideal
+        consqs = [cons.split(field_split) for cons in var.info[field_name]] if field_name in var.info else []
+        if len(consqs) == 0:
+            consqs = [no_consequence]  # keep the variant even if there are no consequences
+        chunk_consqs.extend(consqs)
 
-    variants = []
-    for var in file:  # go over each variant
         var_details = {"chrom": var.chrom, "pos": var.pos, "id": var.id, "ref": var.ref, "alt": var.alts[0],
                        "qual": var.qual, "filter": var.filter.keys()[0]}  # these are mandatory vcf fields
+        # assuming one sample per vcf, otherwise will get the first one not ideal
+        var_details.update(format_values(var.samples[0], format_cols))
+        for column in variant_cols:
+            buffers[column].extend([var_details[column]] * len(consqs))
+
+        if len(chunk_consqs) >= chunk_size:
+            yield csq_chunk(buffers, chunk_consqs, decoder, empty_cols, columns, format_cols)
+            buffers = {column: [] for column in variant_cols}
+            chunk_consqs = []
+            yielded = True
+
+    if len(chunk_consqs) > 0 or (empty and not yielded):
+        yield csq_chunk(buffers, chunk_consqs, decoder, empty_cols, columns, format_cols)
+
+
+def csq_chunk(buffers, consqs, decoder, empty_cols, columns, format_cols):
+    """
+    make a dataframe of a chunk of parse_vcf_chunks
+    :param buffers: dict of variant column: list of values, one per consequence
+    :param consqs: list of split consequences
+    :param decoder: from csq_decoder
+    :param empty_cols: impact columns that are not decoded
+    :param columns: column names in order
+    :param format_cols: output of format_columns
+    :return: a dataframe
+    """
+    buffers.update(decode_csq(consqs, decoder))
+    for column in empty_cols:
+        buffers[column] = [None] * len(consqs)
+    return typed_chunk(pd.DataFrame(buffers, columns=columns), format_cols)
+
+
+def parse_vcf(file, fields, formats, type_dict, field_name="CSQ", field_split="|", ignore=True):
+    """
+    get the consequences of variants based on the field name, this reads the whole vcf into memory use
+    parse_vcf_chunks for large files
+    :param file: vcf file connection via pysam
+    :param fields: output of compare fields
+    :param formats: output of compare fileds
+    :param type_dict the dict of data types and whether to index from vcf.yaml
+    :param field_name: name of the variant consequence field default is CSQ for VEP
+    :param field_split: split char of the specifiic info
+    :return: a dataframe this is to be inserted as a temp table and then further processed like junctions, a vcf
+    without variants gives an empty dataframe with the same columns
+    """
+    chunks = list(parse_vcf_chunks(file, fields, formats, type_dict, field_name=field_name,
+                                   field_split=field_split, ignore=ignore, empty=True))
+    return pd.concat(chunks, ignore_index=True)
+
 
-        for item in var.samples[0].keys():  # assuming one sample per vcf, otherwise will get the first one not ideal
-            if item in formats:
-                var_details[item.lower()] = str(var.samples[0][item])
-
-        consequences = []  # there will be a separate consequence for each transcript
-        consqs = var.info[field_name]
-        consqs = [cons.split(field_split)[1:] for cons in
-                  consqs]  # because we are removing the first one above this is vep specific not ideal
-        for impact in consqs:  # go over each impact
-            consequence = {}
-            for i in range(len(split_fields)):
-                if split_fields[i] in fields:
-                    consequence[split_fields[i]] = impact[
-                        i]  # having a hard time with variable names TODO refactor for better namin
-                else:
-                    if ignore:
-                        continue
-                    else:
-                        raise ValueError("{} is not defined in the vcf config".format(impact))
-            consequences.append(coerce(consequence, type_dict))
-        var_details["CSQ"] = consequences
-        variants.append(var_details)
-
-    variants = pd.DataFrame(variants)
-    variants = variants.explode("CSQ", ignore_index=True)
-    consequence_df = pd.json_normalize(variants["CSQ"].to_list())
-    variants = pd.concat([variants, consequence_df], axis=1)
-    variants = variants.drop(columns="CSQ")
-    return variants
-
-
-def generate_variant_tables(vcf_params, fields, formats, meta, name_type=str, rna=False, filtered=False):
+def vcf_regions(file, region_size=10000000):
+    """
+    split an indexed vcf into regions that can be parsed at the same time, the contigs are in the order of the index
+    which is the order they are in the file
+    :param file: path to a bgzipped and tabix indexed vcf or an indexed bcf
+    :param region_size: length of the regions, a contig without a length in the header is a single region
+    :return: a list of (contig, start, end) 0 based half open, the end of the last region of a contig is None so
+    nothing past the length in the header is missed. None if the file does not have an index
+    """
+    vcf = pysam.VariantFile(file)
+    try:
+        if vcf.index is None:
+            return None
+        regions = []
+        for contig in vcf.index.keys():
+            length = vcf.header.contigs[contig].length if contig in vcf.header.contigs else None
+            starts = [0] if length is None else list(range(0, length, region_size)) or [0]
+            ends = starts[1:] + [None]
+            regions += [(contig, start, end) for start, end in zip(starts, ends)]
+        return regions
+    finally:
+        vcf.close()
+
+
+def read_vcf_region(region, file, fields, formats, type_dict, field_name="CSQ", field_split="|", ignore=True,
+                    chunk_size=100000):
+    """
+    parse one region of an indexed vcf, this is what the region workers of read_vcf run
+    :param region: (contig, start, end) see vcf_regions
+    :param file: path to the vcf file
+    :return: a list of dataframes, see parse_vcf_chunks for the rest of the arguments
+    """
+    vcf = pysam.VariantFile(file)
+    try:
+        return list(parse_vcf_chunks(vcf, fields, formats, type_dict, field_name=field_name,
+                                     field_split=field_split, ignore=ignore, chunk_size=chunk_size, region=region))
+    finally:
+        vcf.close()
+
+
+def parse_vcf_regions(file, regions, workers, chunk_size=100000, **kwargs):
+    """
+    parse the regions of an indexed vcf in a process pool and put the results back together in the order of the
+    regions, so the rows are in the same order as reading the file front to back. At most 2*workers regions are
+    parsed ahead of the caller and the small chunks of the regions are concatenated to about chunk_size rows
+    :param file: path to the vcf file
+    :param regions: from vcf_regions
+    :param workers: number of processes
+    :param chunk_size: number of rows in a chunk
+    :param kwargs: the rest of the arguments of parse_vcf_chunks
+    :return: a generator of dataframes
+    """
+    parse = partial(read_vcf_region, file=file, chunk_size=chunk_size, **kwargs)
+
+    def parsed_regions():
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for region in regions:
+                pending.append(pool.submit(parse, region))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while len(pending) > 0:
+                yield from pending.popleft().result()
+
+    chunks, num_rows = [], 0
+    for chunk in parsed_regions():
+        chunks.append(chunk)
+        num_rows += chunk.shape[0]
+        if num_rows >= chunk_size:
+            yield pd.concat(chunks, ignore_index=True)
+            chunks, num_rows = [], 0
+    if len(chunks) > 0:
+        yield pd.concat(chunks, ignore_index=True)
+
+
+def read_vcf(file, samplename, fields, formats, type_dict, field_name="CSQ", field_split="|", ignore=True,
+             chunk_size=100000, region_workers=1, region_size=10000000):
+    """
+    open a vcf file and parse it in chunks, this takes a path so it can be used in a worker process where pysam
+    file handles cannot be passed around. Indexed files can be split into regions that are parsed by region_workers
+    processes, unindexed ones are always read front to back
+    :param file: path to the vcf file
+    :param samplename: name of the sample
+    :param fields: output of compare fields
+    :param formats: output of compare fields
+    :param type_dict: the dict of data types and whether to index from vcf.yaml
+    :param field_name: name of the variant consequence field default is CSQ for VEP
+    :param field_split: split char of the specifiic info
+    :param ignore: ignore the impact fields that are not in the vcf config
+    :param chunk_size: number of rows in a chunk
+    :param region_workers: number of processes to parse the regions of an indexed file with, see parse_vcf_regions
+    :param region_size: length of the regions, see vcf_regions
+    :return: a generator of dataframes with the samplename added, ready to be inserted into the temp variants table
+    """
+    regions = vcf_regions(file, region_size) if region_workers is not None and region_workers > 1 else None
+    if regions is None:
+        vcf = pysam.VariantFile(file)
+        chunks = parse_vcf_chunks(vcf, fields, formats, type_dict, field_name=field_name,
+                                  field_split=field_split, ignore=ignore, chunk_size=chunk_size)
+    else:
+        chunks = parse_vcf_regions(file, regions, region_workers, chunk_size=chunk_size, fields=fields,
+                                   formats=formats, type_dict=type_dict, field_name=field_name,
+                                   field_split=field_split, ignore=ignore)
+    for chunk in chunks:
+        chunk["samplename"] = samplename
+        yield chunk
+
+
+def generate_variant_tables(vcf_params, fields, formats, meta, name_type=str, rna=False, filtered=False,
+                            deferred=None):
     """
 
     :param vcf_params: vcf yaml containing all the information about the vcf file
@@ -141,8 +435,10 @@ def generate_variant_tables(vcf_params, fields, formats, meta, name_type=str, rn
     :param name_type: name type of the sample id (usually str or int)
     :param rna: are these variants from RNA-Seq
     :param filtered: are these filtered variants
+    :param deferred: list to collect the indexes that will be created after loading, see utils.create_table
     :return: nothing creates the necessary tables in the project database and quits
     """
+    meta.reflect()  # the foreign keys below get their type from the variants table
     impacts = {}
     for field in fields:
         if field in vcf_params["variant_impacts"].keys():
@@ -153,20 +449,23 @@ def generate_variant_tables(vcf_params, fields, formats, meta, name_type=str, rn
     impact_name = "variant_impacts"
     samples_name = "sample_variants"
     variants_name="variants"
+    counts_name = "variant_counts"
     if rna:
         impact_name = "rna_" + impact_name
         samples_name = "rna_" + samples_name
         variants_name= "rna_" + variants_name
+        counts_name = "rna_" + counts_name
     if filtered:
         impact_name = "filtered_" + impact_name
         samples_name = "filtered_" + samples_name
         variants_name = "filtered_" + variants_name
+        counts_name = "filtered_" + counts_name
 
     impacts["variant_id"] = {"type": "fk", "index": True,
                              "fk": {"table": variants_name, "column": "variant_id"}}
 
     impacts_table = dict_to_table(impacts, impact_name, meta)
-    impacts_table.create()
+    create_table(impacts_table, meta.bind, deferred)
 
     sample_variants = {}
     sample_variants["variant_id"] = {"type": "fk", "index": True, "pk": True,
@@ -176,41 +475,304 @@ def generate_variant_tables(vcf_params, fields, formats, meta, name_type=str, rn
     sample_variants["qual"] = {"type": "float", "index": False}
     sample_variants["filter"] = {"type": "str", "index": True}
 
-    for format in formats:
-        if format == "gt":
-            sample_variants[format] = {"type": "str", "index": True}
-        else:
-            sample_variants[format] = {"type": "str", "index": False}
-
-    sample_variants_table = dict_to_table(sample_variants, samples_name, meta)
-    sample_variants_table.create()
+    format_index = vcf_params.get("format_index", ["gt"])
+    for column, spec in format_columns(formats).items():
+        sample_variants[column] = {"type": spec["type"], "index": column in format_index}
+
+    # projects created before the format fields were typed keep their text columns, see mapping_columns
+    if not inspect(meta.bind).has_table(samples_name):
+        sample_variants_table = dict_to_table(sample_variants, samples_name, meta)
+        create_table(sample_variants_table, meta.bind, deferred)
+
+    # per cohort allele counts, the (cohort, af) index is what makes allele frequency filters cheap
+    variant_counts = {"variant_id": {"type": "fk", "index": False, "pk": True,
+                                     "fk": {"table": variants_name, "column": "variant_id"}},
+                      "cohort": {"type": "str", "index": False, "pk": True},
+                      "ac": {"type": "int", "index": False},
+                      "an": {"type": "int", "index": False},
+                      "af": {"type": "float", "index": False},
+                      "num_het": {"type": "int", "index": False},
+                      "num_hom": {"type": "int", "index": False}}
+    new_counts = not inspect(meta.bind).has_table(counts_name)
+    counts_table = dict_to_table(variant_counts, counts_name, meta)
+    Index("ix_{}_af".format(counts_name), counts_table.c.cohort, counts_table.c.af)
+    create_table(counts_table, meta.bind, deferred)
+    if new_counts:  # projects created before the counts tables already have samples
+        build_variant_counts(meta.bind, rna=rna, filtered=filtered)
 
 
 def import_temp_variants(variants, samplename, engine, filtered=False):
     """
     insert into a temp table to further process the variants table
-    :param variants: dataframe of variants, output of parse_vcf
+    :param variants: dataframe of variants, output of parse_vcf or an iterable of dataframes (parse_vcf_chunks)
     :param samplename: name of the sample
     :param engine sqlalchemy connection
     :param filtered are these filtered variants
     :return:
     """
-    variants["samplename"] = samplename
     if filtered:
-        variants.to_sql("temp_filt_variants", engine, if_exists="append", index=False)
+        temp = "temp_filt_variants"
     else:
-        variants.to_sql("temp_all_variants", engine, if_exists="append", index=False)
+        temp = "temp_all_variants"
+
+    if isinstance(variants, pd.DataFrame):
+        variants = [variants]
+
+    for chunk in variants:  # only one chunk is in memory at a time
+        chunk["samplename"] = samplename
+        chunk.to_sql(temp, engine, if_exists="append", index=False)
+
+
+# cohort of samples without one and the pseudo cohort of all samples in the variant count tables
+NO_COHORT = "unassigned"
+ALL_COHORTS = "all"
+
+
+def alt_dosage(gt):
+    """
+    number of alt alleles as a sql expression, this is the gt column itself (see format_columns) except in projects
+    created before the format fields were typed where gt is the string of pysam's genotype tuple
+    :param gt: gt column
+    :return: a sqlalchemy expression 0, 1 or 2 (NULL if missing)
+    """
+    if not isinstance(gt.type, String):
+        return gt
+    return case((gt == "(1, 1)", 2),
+                (gt.in_(["(0, 1)", "(1, 0)", "(1, None)", "(None, 1)", "(1,)"]), 1),
+                else_=0)
+
+
+def mapping_columns(temp_table, mapping_table, formats):
+    """
+    columns of the sample variants table and the temp table expressions that fill them. In projects created before
+    the format fields were typed they are text columns with the string of the pysam value, for those the same text is
+    rebuilt from the typed columns (phasing is lost and 1 is always written as "(0, 1)" like before). Format fields
+    the mapping table does not have are skipped
+    :param temp_table: temp variants table
+    :param mapping_table: sample variants table
+    :param formats: output of compare_fields
+    :return: dict of column name to sqlalchemy expression
+    """
+    columns = {col: temp_table.c[col] for col in ["samplename", "qual", "filter"]}
+    format_cols = format_columns(formats)
+    for format in formats:
+        typed = [col for col, spec in format_cols.items() if spec["format"] == format]
+        legacy = format in mapping_table.c and isinstance(mapping_table.c[format].type, String) and \
+            (format == "gt" or format_cols.get(format, {"type": None})["type"] != "str")
+        if not legacy:
+            columns.update({col: temp_table.c[col] for col in typed if col in mapping_table.c})
+        elif format == "gt":
+            columns[format] = case((temp_table.c.gt == 0, "(0, 0)"), (temp_table.c.gt == 1, "(0, 1)"),
+                                   (temp_table.c.gt == 2, "(1, 1)"), else_="(None, None)")
+        else:
+            values = [func.coalesce(cast(temp_table.c[col], String), "None") for col in typed]
+            if len(typed) == 1 and format_cols[typed[0]]["position"] is None:
+                columns[format] = values[0]
+            elif len(values) == 1:
+                columns[format] = "(" + values[0] + ",)"
+            else:
+                text = values[0]
+                for value in values[1:]:
+                    text = text + ", " + value
+                columns[format] = "(" + text + ")"
+    return columns
+
+
+def sample_cohort(samples_table):
+    """
+    cohort of a sample as a sql expression
+    :param samples_table: samples table
+    :return: sqlalchemy expression
+    """
+    if "cohort" in samples_table.c:
+        return func.coalesce(samples_table.c.cohort, literal_column("'{}'".format(NO_COHORT)))
+    return literal_column("'{}'".format(NO_COHORT))
+
+
+def check_cohort_names(conn, samples_table):
+    """
+    ALL_COHORTS is the cohort of every sample in the variant counts tables, the counts of a real cohort with that name
+    would be added to it. create_project.py does not load such samples, this is for projects that already have them
+    :param conn: sqlalchemy connection
+    :param samples_table: samples table
+    :return: nothing, raises a ValueError if there is a cohort called ALL_COHORTS
+    """
+    if "cohort" in samples_table.c and conn.execute(
+            select(func.count()).where(samples_table.c.cohort == ALL_COHORTS)).scalar() > 0:
+        raise ValueError("{} is used for the variant counts of all samples, it cannot be the name of a cohort".
+                         format(ALL_COHORTS))
+
+
+def variant_counts_query(genotypes, samples_table, by_cohort=True):
+    """
+    allele counts of a set of genotypes, an and af are left as 0 and filled in by update_allele_numbers
+    :param genotypes: a table or subquery with variant_id, samplename and gt columns, one row per sample and variant
+    :param samples_table: samples table
+    :param by_cohort: one row per variant and cohort otherwise one row per variant for ALL_COHORTS
+    :return: a select statement with the same columns as the variant count tables
+    """
+    dosage = alt_dosage(genotypes.c.gt)
+    cohort = sample_cohort(samples_table) if by_cohort else literal_column("'{}'".format(ALL_COHORTS))
+    query = select(genotypes.c.variant_id, cohort, func.sum(dosage), literal(0), literal(0.0),
+                   func.sum(case((dosage == 1, 1), else_=0)), func.sum(case((dosage == 2, 1), else_=0))). \
+        select_from(genotypes.join(samples_table, samples_table.c.sample_id == genotypes.c.samplename)). \
+        group_by(genotypes.c.variant_id, cohort)
+    return query
 
 
-def add_to_variant_tables(engine, meta, session, fields, formats, create=True, filtered=False, rna=False):
+def update_allele_numbers(conn, mapping_table, counts_table, samples_table, cohorts):
+    """
+    set an (2 x number of samples, samples without a variant are assumed to be homozygous reference) and af for the
+    given cohorts, this changes every time a sample is added to a cohort even for variants the sample does not have
+    :param conn: sqlalchemy connection
+    :param mapping_table: sample variants table, it needs to have the new samples already
+    :param counts_table: variant counts table
+    :param samples_table: samples table
+    :param cohorts: cohorts to update
+    :return: nothing
+    """
+    loaded = select(mapping_table.c.samplename).distinct().subquery()
+    cohort = sample_cohort(samples_table)
+    sizes = conn.execute(select(cohort, func.count()).
+                         select_from(loaded.join(samples_table, samples_table.c.sample_id == loaded.c.samplename)).
+                         group_by(cohort)).fetchall()
+    sizes = {row[0]: row[1] for row in sizes}
+    sizes[ALL_COHORTS] = sum(sizes.values())
+    for name in cohorts:
+        an = 2 * sizes.get(name, 0)
+        if an == 0:
+            continue
+        conn.execute(counts_table.update().where(counts_table.c.cohort == name).
+                     values(an=an, af=cast(counts_table.c.ac, Float) / an))
+
+
+def update_variant_counts(conn, temp_table, variants_table, mapping_table, counts_table, samples_table):
+    """
+    add the genotypes in the temp table to the variant count table, this needs to run before the mappings are
+    inserted because sample/variant pairs that are already in the mapping table are not counted again, call
+    update_allele_numbers after the mappings are inserted
+    :param conn: sqlalchemy connection
+    :param temp_table: temp variants table
+    :param variants_table: variants table, the temp variants need to be in it already
+    :param mapping_table: sample variants table
+    :param counts_table: variant counts table
+    :param samples_table: samples table
+    :return: the cohorts that changed
+    """
+    check_cohort_names(conn, samples_table)
+    key_cols = ["chrom", "pos", "ref", "alt"]
+    same_variant = and_(*[temp_table.c[col] == variants_table.c[col] for col in key_cols])
+    # the temp table has one row per consequence
+    genotypes = select(variants_table.c.variant_id, temp_table.c.samplename, temp_table.c.gt).distinct(). \
+        select_from(temp_table.join(variants_table, same_variant)). \
+        where(~exists().where(and_(mapping_table.c.samplename == temp_table.c.samplename,
+                                   mapping_table.c.variant_id == variants_table.c.variant_id))).subquery()
+    columns = [col.name for col in counts_table.columns]
+    for by_cohort in [True, False]:
+        stmt = insert_or_accumulate(counts_table, conn, ["variant_id", "cohort"], sums=["ac", "num_het", "num_hom"])
+        conn.execute(stmt.from_select(columns, variant_counts_query(genotypes, samples_table, by_cohort)))
+
+    cohorts = select(sample_cohort(samples_table)).distinct(). \
+        select_from(temp_table.join(samples_table, samples_table.c.sample_id == temp_table.c.samplename))
+    return conn.execute(cohorts).scalars().all() + [ALL_COHORTS]
+
+
+def build_variant_counts(engine, rna=False, filtered=False):
+    """
+    (re)build a variant counts table from its sample variants table, only needed for projects that were created before
+    the counts tables existed, after that they are updated as samples are added
+    :param engine: sqlalchemy engine
+    :param rna: rna variants
+    :param filtered: filtered variants
+    :return: nothing
+    """
+    prefix = ("rna_" if rna else "") + ("filtered_" if filtered else "")
+    meta = MetaData()
+    mapping_table = Table(prefix + "sample_variants", meta, autoload_with=engine)
+    counts_table = Table(prefix + "variant_counts", meta, autoload_with=engine)
+    samples_table = Table("samples", meta, autoload_with=engine)
+    columns = [col.name for col in counts_table.columns]
+    with engine.begin() as conn:
+        check_cohort_names(conn, samples_table)
+        conn.execute(counts_table.delete())
+        for by_cohort in [True, False]:
+            conn.execute(counts_table.insert().from_select(columns, variant_counts_query(mapping_table, samples_table,
+                                                                                         by_cohort)))
+        cohorts = conn.execute(select(counts_table.c.cohort).distinct()).scalars().all()
+        update_allele_numbers(conn, mapping_table, counts_table, samples_table, cohorts)
+
+
+def normalize_variant_tables(engine, temp_table, variants_table, mapping_table, impacts_table, counts_table=None,
+                             samples_table=None, formats=None):
+    """
+    move the variants from the temp table to the variant, sample variant and impact tables without leaving the
+    database, this is done in a single transaction with INSERT ... SELECT statements so memory use does not depend
+    on the cohort size. Variants that are already in the project are skipped by the unique index on
+    (chrom, pos, ref, alt) so the same statements work for new and existing projects and the cost depends only on the
+    size of the temp table
+    :param engine: sqlalchemy engine
+    :param temp_table: temp variants table
+    :param variants_table: variants table
+    :param mapping_table: sample variants table
+    :param impacts_table: variant impacts table
+    :param counts_table: variant counts table to update, see update_variant_counts
+    :param samples_table: samples table, needed for the cohorts if there is a counts table
+    :param formats: output of compare_fields, see mapping_columns, if None the columns with the same names are copied
+    :return: nothing, the temp table is dropped at the end
+    """
+    key_cols = ["chrom", "pos", "ref", "alt"]
+    same_variant = and_(*[temp_table.c[col] == variants_table.c[col] for col in key_cols])
+    # a field/format may be in the config but not in the vcf or the other way around
+    if formats is not None:
+        mapping_cols = mapping_columns(temp_table, mapping_table, formats)
+    else:
+        mapping_cols = {col: temp_table.c[col] for col in mapping_table.columns.keys()
+                        if col in temp_table.c and col != "variant_id"}
+    impact_cols = [col for col in impacts_table.columns.keys() if col in temp_table.c and col != "variant_id"]
+
+    with engine.begin() as conn:
+        Index("ix_{}_key".format(temp_table.name), *[temp_table.c[col] for col in key_cols]).create(conn)
+
+        # there is one row per consequence so need to collapse them, the id can differ between vcfs
+        distinct_vars = select(temp_table.c.chrom, temp_table.c.pos, func.max(temp_table.c.id), temp_table.c.ref,
+                               temp_table.c.alt). \
+            group_by(*[temp_table.c[col] for col in key_cols]). \
+            order_by(*[temp_table.c[col] for col in key_cols])
+        conn.execute(insert_or_ignore(variants_table, conn).from_select(["chrom", "pos", "id", "ref", "alt"],
+                                                                        distinct_vars))
+
+        if counts_table is not None:
+            cohorts = update_variant_counts(conn, temp_table, variants_table, mapping_table, counts_table,
+                                            samples_table)
+
+        mapping_query = select(*mapping_cols.values(), variants_table.c.variant_id). \
+            select_from(temp_table.join(variants_table, same_variant)).distinct()
+        conn.execute(insert_or_ignore(mapping_table, conn).from_select(list(mapping_cols) + ["variant_id"],
+                                                                       mapping_query))
+        if counts_table is not None:
+            update_allele_numbers(conn, mapping_table, counts_table, samples_table, cohorts)
+
+        # impacts are the same for a variant regardless of the sample only add them for variants without any
+        impacts_query = select(*[temp_table.c[col] for col in impact_cols], variants_table.c.variant_id). \
+            select_from(temp_table.join(variants_table, same_variant)).distinct(). \
+            where(~exists().where(impacts_table.c.variant_id == variants_table.c.variant_id))
+        conn.execute(impacts_table.insert().from_select(impact_cols + ["variant_id"], impacts_query))
+
+        temp_table.drop(conn)
+
+
+def add_to_variant_tables(engine, meta, session, fields, formats, create=True, filtered=False, rna=False,
+                          in_database=True):
     """
     process the temp variants table and then remove it
     :param engine: slqalchemy connection
     :param meta: project db metadade
-    :param session: session object
-    :param create: is this a new project or added to an existing one
+    :param session: session object, only used if in_database is False
+    :param create: is this a new project or added to an existing one, only used if in_database is False
     :param filtered: are these filtered variants?
     :param rna is this from rnaseq data
+    :param in_database: do the normalization with INSERT ... SELECT statements (see normalize_variant_tables)
+    otherwise the variants go through pandas
     :return:
     """
 
@@ -224,6 +786,7 @@ def add_to_variant_tables(engine, meta, session, fields, formats, create=True, f
         mapping = "rna_" + mapping
         impacts = "rna_" + impacts
 
+    counts = ("rna_" if rna else "") + ("filtered_" if filtered else "") + "variant_counts"
     if filtered:
         table = "filtered_" + table
         mapping = "filtered_" + mapping
@@ -235,6 +798,15 @@ def add_to_variant_tables(engine, meta, session, fields, formats, create=True, f
     temp_table = Table(temp, meta, autoload=True, autoload_with=engine)
     variants_table = Table(table, meta, autoload=True, autoload_with=engine)
 
+    if in_database:
+        mapping_table = Table(mapping, meta, autoload=True, autoload_with=engine)
+        impacts_table = Table(impacts, meta, autoload=True, autoload_with=engine)
+        samples_table = Table("samples", meta, autoload=True, autoload_with=engine)
+        normalize_variant_tables(engine, temp_table, variants_table, mapping_table, impacts_table,
+                                 meta.tables.get(counts), samples_table, formats)
+        meta.remove(temp_table)
+        return
+
     if create:
         distinct_vars = select(temp_table.c.chrom, temp_table.c.pos, temp_table.c.id, temp_table.c.ref,
                                temp_table.c.alt).distinct()
@@ -244,35 +816,39 @@ def add_to_variant_tables(engine, meta, session, fields, formats, create=True, f
         del distinct_vars
         gc.collect()
     else:
+        same_variant = (temp_table.c.chrom == variants_table.c.chrom) & (temp_table.c.pos == variants_table.c.pos) & \
+                       (temp_table.c.ref == variants_table.c.ref) & (temp_table.c.alt == variants_table.c.alt)
         new_vars = select(temp_table.c.chrom, temp_table.c.pos, temp_table.c.id, temp_table.c.ref,
-                          temp_table.c.alt).distinct().join(
-            variants_table,
-            (temp_table.c.chrom == variants_table.c.chrom) &
-            (temp_table.c.pos == variants_table.c.pos) &
-            (temp_table.c.ref == variants_table.c.ref) &
-            (temp_table.c.alt == variants_table.c.alt)
-        ).filter(variants_table.c.variant_id is None)
+                          temp_table.c.alt).distinct().select_from(
+            temp_table.outerjoin(variants_table, same_variant)).filter(variants_table.c.variant_id == None)
 
-        new_vars = session.execute(new_vars)
+        new_vars = session.execute(new_vars).fetchall()
 
         if len(new_vars) > 0:
-            new_vars = pd.DataFrame(new_vars)
-            new_vars.columns = ["chrom", "pos", "id", "ref", "alt", "variant_id"]
-            new_vars = new_vars.drop(columns=["id"])
+            new_vars = pd.DataFrame(new_vars, columns=["chrom", "pos", "id", "ref", "alt"])
             new_vars.to_sql(table, engine, index=False, if_exists="append")
 
-    mapping_cols = ["samplename", "qual", "filter"] + formats
+    mapping_table = Table(mapping, meta, autoload=True, autoload_with=engine)
+    mapping_cols = mapping_columns(temp_table, mapping_table, formats)
     # TODO this is very slow because of the join, would need to find a different way to get the data
-    mapping_query = select(*[temp_table.c[col] for col in mapping_cols]).distinct().join(
+    mapping_query = select(*mapping_cols.values()).distinct().join(
         variants_table, (temp_table.c.chrom == variants_table.c.chrom) &
                         (temp_table.c.pos == variants_table.c.pos) &
                         (temp_table.c.ref == variants_table.c.ref) &
                         (temp_table.c.alt == variants_table.c.alt)
     ).add_columns(variants_table.c.variant_id)
     variant_mapping = pd.DataFrame(session.execute(mapping_query).fetchall())
-    mapping_cols.append("variant_id")
-    variant_mapping.columns = mapping_cols
+    variant_mapping.columns = list(mapping_cols) + ["variant_id"]
+    counts_table = meta.tables.get(counts)
+    if counts_table is not None:
+        samples_table = Table("samples", meta, autoload=True, autoload_with=engine)
+        with engine.begin() as conn:
+            cohorts = update_variant_counts(conn, temp_table, variants_table, mapping_table, counts_table,
+                                            samples_table)
     variant_mapping.to_sql(mapping, engine, index=False, if_exists="append")
+    if counts_table is not None:
+        with engine.begin() as conn:
+            update_allele_numbers(conn, mapping_table, counts_table, samples_table, cohorts)
     del variant_mapping
     gc.collect()
 
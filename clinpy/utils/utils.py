@@ -1,7 +1,17 @@
 from sqlalchemy import Table, Column, Integer, String, Float, Date, Boolean, JSON, ForeignKey
-from sqlalchemy import or_, and_, not_, select
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import or_, and_, not_, select, case, true, func
+from sqlalchemy import create_engine, MetaData, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateColumn, CreateTable, Sequence
+from sqlalchemy.types import FLOAT, REAL
+from sqlalchemy.pool import QueuePool
+from urllib.request import pathname2url
+import numpy as np
+import pandas as pd
 import operator as op
+import os
+import weakref
 
 
 def calc_overlap(int1, int2):
@@ -25,6 +35,218 @@ def calc_overlap(int1, int2):
         return (int2[1] - int1[0]) / len1
 
 
+# UCSC binning scheme, 5 levels of bins 128kb, 1Mb, 8Mb, 64Mb and 512Mb wide. A feature gets the smallest bin it
+# fits in entirely so a region query only needs to look at a handful of bins per level
+BIN_OFFSETS = [585, 73, 9, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAX = 2 ** 29 - 1  # the largest coordinate the scheme covers
+
+
+def region_bin(start, end):
+    """
+    bin of closed intervals [start, end], works on numbers and numpy arrays/pandas series
+    :param start: start coordinate(s)
+    :param end: end coordinate(s)
+    :return: int or numpy array of bins
+    """
+    start_bin = np.asarray(start, dtype=np.int64) >> BIN_FIRST_SHIFT
+    end_bin = np.asarray(end, dtype=np.int64) >> BIN_FIRST_SHIFT
+    bins = np.zeros(np.broadcast(start_bin, end_bin).shape, dtype=np.int64)
+    done = np.zeros(bins.shape, dtype=bool)
+    for offset in BIN_OFFSETS:
+        fits = ~done & (start_bin == end_bin)
+        bins[fits] = offset + np.broadcast_to(start_bin, bins.shape)[fits]
+        done |= fits
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    if bins.ndim == 0:
+        return int(bins)
+    return bins
+
+
+def bin_expression(start, end):
+    """
+    same as region_bin as a sql expression so bins can be calculated in INSERT ... SELECT statements
+    :param start: start column
+    :param end: end column, closed interval
+    :return: a sqlalchemy case expression
+    """
+    whens = []
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        start_bin = start.op(">>")(shift)
+        whens.append((start_bin == end.op(">>")(shift), start_bin + offset))
+        shift += BIN_NEXT_SHIFT
+    return case(*whens, else_=0)
+
+
+def overlapping_bins(start, end):
+    """
+    the bins that features overlapping [start, end] can be in
+    :param start: start of the region
+    :param end: end of the region
+    :return: list of (first, last) bin ranges, one per level
+    """
+    ranges = []
+    start_bin = min(max(int(start), 0), BIN_MAX) >> BIN_FIRST_SHIFT
+    end_bin = min(max(int(end), 0), BIN_MAX) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        ranges.append((offset + start_bin, offset + end_bin))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return ranges
+
+
+def bin_filter(bin_col, start, end, max_bins=1000):
+    """
+    where clause for the bins of a region, this is in addition to the start/end comparisons not instead of them. The
+    bins are listed explicitly, sqlite only uses the (chrom, bin) index for an IN list, ranges in an OR are only
+    used if the database was analyzed
+    :param bin_col: bin column of the table
+    :param start: start of the region
+    :param end: end of the region
+    :param max_bins: regions that span more bins than this (~100Mb) are not worth it, the chrom index is used instead
+    :return: a sqlalchemy clause
+    """
+    bins = [b for first, last in overlapping_bins(start, end) for b in range(first, last + 1)]
+    if len(bins) > max_bins:
+        return true()
+    return bin_col.in_(bins)
+
+
+def read_regions(regions):
+    """
+    read query regions into a dataframe, coordinates are used as they are there is no 0/1 based conversion
+    :param regions: a pyranges, a dataframe with Chromosome, Start, End and optionally Strand columns (chrom, start,
+    end and strand also work) or the path of a bed file
+    :return: a dataframe with region (the row number of the interval in the input), chrom, start, end and strand
+    (None if there is no strand)
+    """
+    if isinstance(regions, str):
+        with open(regions) as bed:
+            regions = pd.DataFrame([line.rstrip("\n").split("\t")[:6] for line in bed
+                                    if line.strip() != "" and not line.startswith(("#", "track", "browser"))])
+        regions.columns = ["chrom", "start", "end", "name", "score", "strand"][:regions.shape[1]]
+    elif hasattr(regions, "df"):  # pyranges
+        regions = regions.df
+    regions = regions.rename(columns={"Chromosome": "chrom", "Start": "start", "End": "end", "Strand": "strand"})
+    for col in ["chrom", "start", "end"]:
+        if col not in regions.columns:
+            raise ValueError("regions need a {} column".format(col))
+
+    parsed = pd.DataFrame({"region": np.arange(regions.shape[0]),
+                           "chrom": regions["chrom"].astype(str).to_numpy(),
+                           "start": regions["start"].astype(np.int64).to_numpy(),
+                           "end": regions["end"].astype(np.int64).to_numpy()})
+    if "strand" in regions.columns:
+        strand = regions["strand"].astype(str).to_numpy()
+        parsed["strand"] = np.where(np.isin(strand, ["+", "-"]), strand, None)
+    else:
+        parsed["strand"] = None
+    return parsed
+
+
+def create_region_tables(regions, conn, bins=True):
+    """
+    put the query regions in temporary tables so a whole panel can be searched with a single join, there is one
+    table for the intervals and one with the bins each interval can overlap (see bin_filter). The tables only exist
+    for this connection, drop them when done with drop_temp_tables
+    :param regions: output of read_regions
+    :param conn: sqlalchemy connection, the query needs to run on the same connection
+    :param bins: also create the bin table, the variant tables do not have bins
+    :return: region and bin tables, the bin table is None if bins is False
+    """
+    meta = MetaData()
+    region_table = Table("query_regions", meta, Column("region", Integer, primary_key=True), Column("chrom", String),
+                         Column("start", Integer), Column("end", Integer), Column("strand", String),
+                         prefixes=["TEMPORARY"])
+    bin_table = Table("query_bins", meta, Column("region", Integer), Column("chrom", String), Column("bin", Integer),
+                      prefixes=["TEMPORARY"])
+    for table in [region_table, bin_table] if bins else [region_table]:
+        table.drop(conn, checkfirst=True)  # left over from a failed query
+        table.create(conn)
+
+    records = regions.astype(object).where(pd.notna(regions), None).to_dict(orient="records")
+    if len(records) > 0:
+        conn.execute(region_table.insert(), records)
+    if not bins:
+        return region_table, None
+
+    region_bins = []
+    for region in records:
+        for first, last in overlapping_bins(region["start"], region["end"]):
+            region_bins.extend([{"region": region["region"], "chrom": region["chrom"], "bin": b}
+                                for b in range(first, last + 1)])
+    if len(region_bins) > 0:
+        conn.execute(bin_table.insert(), region_bins)
+    return region_table, bin_table
+
+
+def create_id_table(ids, conn, name="query_ids"):
+    """
+    a temporary table of ids to join against instead of a long IN clause
+    :param ids: iterable of integers
+    :param conn: sqlalchemy connection, the query needs to run on the same connection
+    :param name: name of the table
+    :return: the table, it has a single id column
+    """
+    table = Table(name, MetaData(), Column("id", Integer, primary_key=True), prefixes=["TEMPORARY"])
+    table.drop(conn, checkfirst=True)
+    table.create(conn)
+    ids = [{"id": int(i)} for i in pd.unique(pd.Series(ids, dtype="int64"))]
+    if len(ids) > 0:
+        conn.execute(table.insert(), ids)
+    return table
+
+
+def drop_temp_tables(conn, *tables):
+    """
+    drop the tables created by create_region_tables or create_id_table
+    :param conn: the same connection the tables were created with
+    :param tables: tables to drop
+    :return: nothing
+    """
+    for table in tables:
+        table.drop(conn, checkfirst=True)
+
+
+def add_bin_column(table, engine, start="start", end="end"):
+    """
+    projects created before the bin columns were added do not have them, add the column, fill it in and index it
+    :param table: sqlalchemy table as defined in clinpy.database (with a bin column and a (chrom, bin) index)
+    :param engine: sqlalchemy engine
+    :param start: name of the start column
+    :param end: name of the end column
+    :return: nothing
+    """
+    if "bin" in [col["name"] for col in inspect(engine).get_columns(table.name)]:
+        return
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE {} ADD COLUMN bin INTEGER".format(table.name))
+        conn.execute(table.update().values(bin=bin_expression(table.c[start], table.c[end])))
+        for index in table.indexes:
+            if "bin" in index.columns.keys():
+                create_index(index, conn)
+
+
+def drop_bin_column(table, engine):
+    """
+    the variant tables used to have a bin column like the junctions. Variants are points so the (chrom, pos, ...) key
+    index is already a range seek per region and the bins were never used, drop the column and its index from
+    projects that have them
+    :param table: sqlalchemy table as defined in clinpy.database
+    :param engine: sqlalchemy engine
+    :return: nothing
+    """
+    if "bin" not in [col["name"] for col in inspect(engine).get_columns(table.name)]:
+        return
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_{}_bin".format(table.name))
+        if engine.dialect.name != "sqlite" or engine.dialect.dbapi.sqlite_version_info >= (3, 35, 0):
+            conn.exec_driver_sql("ALTER TABLE {} DROP COLUMN bin".format(table.name))
+
+
 def str_to_type(st, *args):
     """
     return sqlalchemy types based on a string, this is used to create tables dynamically
@@ -89,20 +311,306 @@ def dict_to_table(dict, tablename, meta):
     return table
 
 
-def dict_to_engine(params, **kwargs):
+@compiles(CreateColumn, "duckdb")
+def duckdb_column(element, compiler, **kwargs):
+    """
+    duckdb has no SERIAL type that the postgres compiler uses for integer primary keys. Keys that are generated have
+    a Sequence (see database.rna_tables) which becomes the default of the column so inserts from selects get ids
+    too, the rest (variant ids, sample ids...) come from the data and are plain integers
+    """
+    column = element.element
+    if column.primary_key and column is column.table._autoincrement_column:
+        colspec = "{} {}".format(compiler.preparer.format_column(column),
+                                 compiler.dialect.type_compiler.process(column.type, type_expression=column))
+        if isinstance(column.default, Sequence):
+            colspec += " DEFAULT nextval('{}')".format(column.default.name)
+        return colspec + " NOT NULL"
+    return compiler.visit_create_column(element, **kwargs)
+
+
+@compiles(Float, "duckdb")
+@compiles(FLOAT, "duckdb")
+@compiles(REAL, "duckdb")
+def duckdb_float(type_, compiler, **kwargs):
+    """
+    FLOAT and REAL are 4 bytes in duckdb, double precision like sqlite (these are also the types reflected from a
+    sqlite project, see scripts/convert_to_duckdb.py)
+    """
+    return "DOUBLE"
+
+
+def insert_or_ignore(table, bind):
+    """
+    an insert statement that silently skips rows that would violate a unique constraint, used with the natural key
+    indexes on the junction and variant tables so that adding samples to an existing project only inserts what is new
+    :param table: sqlalchemy table
+    :param bind: engine or connection, used to figure out the dialect
+    :return: an insert statement, use .values() or .from_select() as usual
+    """
+    if bind.dialect.name == "sqlite":
+        return table.insert().prefix_with("OR IGNORE")
+    elif bind.dialect.name in ["postgresql", "duckdb"]:
+        return postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        raise NotImplementedError("insert or ignore is not implemented for {}".format(bind.dialect.name))
+
+
+def insert_or_accumulate(table, bind, keys, sums=(), maxes=()):
+    """
+    insert statement for summary tables, if a row with the same key is already there the new values are added to
+    the sums and the larger of the old and new values is kept for the maxes
+    :param table: sqlalchemy table
+    :param bind: engine or connection, only used to figure out the dialect
+    :param keys: columns of the primary key/unique index
+    :param sums: columns that are added up
+    :param maxes: columns that keep the maximum
+    :return: an insert statement, use values or from_select on it
+    """
+    if bind.dialect.name == "sqlite":
+        stmt = sqlite.insert(table)
+        greatest = func.max  # max with 2 arguments is a scalar function in sqlite
+    elif bind.dialect.name in ["postgresql", "duckdb"]:
+        stmt = postgresql.insert(table)
+        greatest = func.greatest
+    else:
+        raise NotImplementedError("accumulating inserts are not implemented for {}".format(bind.dialect.name))
+    updates = {col: table.c[col] + stmt.excluded[col] for col in sums}
+    updates.update({col: greatest(table.c[col], stmt.excluded[col]) for col in maxes})
+    return stmt.on_conflict_do_update(index_elements=keys, set_=updates)
+
+
+def create_table(table, engine, deferred=None):
+    """
+    create a table and its indexes if they do not exist. Projects created before the natural key indexes were added
+    or an interrupted bulk load may be missing some of them
+    :param table: sqlalchemy table
+    :param engine: sqlalchemy engine
+    :param deferred: a list, if provided the non unique indexes of the table are not created but appended to this
+    list, create them with finish_bulk_load after the data is loaded
+    :return: nothing
+    """
+    if deferred is None:
+        table.create(engine, checkfirst=True)
+        indexes = table.indexes
+    else:
+        # table.create would make all the indexes, they are not removed from the table because the tables of
+        # clinpy.database are shared by the whole process
+        if not inspect(engine).has_table(table.name):
+            with engine.begin() as conn:
+                conn.execute(CreateTable(table))
+        indexes = [index for index in table.indexes if index.unique]  # needed for insert or ignore
+        deferred.extend(index for index in table.indexes if not index.unique and index not in deferred)
+    for index in indexes:
+        create_index(index, engine)
+
+
+def create_index(index, bind):
+    """
+    create an index if it does not exist. duckdb_engine cannot reflect indexes so checkfirst would always try to
+    create them, the duckdb catalog is checked instead
+    :param index: sqlalchemy index
+    :param bind: engine or connection
+    :return: nothing
+    """
+    if bind.dialect.name != "duckdb":
+        index.create(bind, checkfirst=True)
+    elif bind.execute(text("SELECT count(*) FROM duckdb_indexes() WHERE index_name = :name"),
+                      {"name": index.name}).scalar() == 0:
+        index.create(bind)
+
+
+def set_bulk_pragmas(engine):
+    """
+    relax the durability of the sqlite database for loading, every new connection will use WAL journaling with
+    synchronous off and a large page cache. If the machine crashes during the load the database may be corrupt, but
+    it would have to be re-created anyway. These are per connection settings except WAL which stays on
+    :param engine: sqlalchemy engine, needs to be called before any connections are made
+    :return: nothing
+    """
+    @event.listens_for(engine, "connect")
+    def bulk_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-1000000")  # negative is in KiB so this is about 1GB
+        cursor.close()
+
+
+def bulk_insert(df, tablename, engine):
+    """
+    insert a dataframe with the raw DBAPI executemany in a single transaction, this skips all the per row work
+    pandas and sqlalchemy do and is several times faster than to_sql. If the table does not exist (temp tables) it is
+    created from the dataframe the same way to_sql would
+    :param df: dataframe, column names need to match the table
+    :param tablename: name of the table
+    :param engine: sqlalchemy engine, sqlite only
+    :return: nothing
+    """
+    if not inspect(engine).has_table(tablename):
+        df.head(0).to_sql(tablename, engine, index=False)
+    columns = ", ".join(['"{}"'.format(col) for col in df.columns])
+    placeholders = ", ".join(["?"] * df.shape[1])
+    # sqlite3 cannot bind numpy types or NaN
+    rows = df.astype(object).where(pd.notna(df), None).itertuples(index=False, name=None)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO "{}" ({}) VALUES ({})'.format(tablename, columns, placeholders), rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def finish_bulk_load(engine, deferred):
+    """
+    create the indexes that were deferred by create_table, update the query planner statistics and fold the WAL
+    back into the database file
+    :param engine: sqlalchemy engine
+    :param deferred: list of indexes from create_table
+    :return: nothing
+    """
+    for index in deferred:
+        create_index(index, engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def project_table(name, meta=None):
+    """
+    filter for MetaData.reflect(only=...) that leaves out the internal tables of sqlite, the ANALYZE of
+    finish_bulk_load creates sqlite_stat1 and its columns do not have types so it cannot be re-created elsewhere
+    :param name: name of the table
+    :param meta: the MetaData being reflected, not used
+    :return: bool
+    """
+    return not name.startswith("sqlite_")
+
+
+def set_wal(engine):
+    """
+    switch the sqlite database to WAL journaling, this is stored in the database file so it only needs to happen once.
+    In WAL mode readers (see read_engine) keep reading while the database is written to and do not block the writer
+    :param engine: sqlalchemy engine, needs to be called before any connections are made
+    :return: nothing
+    """
+    @event.listens_for(engine, "connect")
+    def wal_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
+
+def is_read_only(engine):
+    """
+    :param engine: sqlalchemy engine
+    :return: True if the engine was made with read_engine or duck_engine(..., read_only=True)
+    """
+    query = engine.url.query
+    return query.get("mode") == "ro" or query.get("immutable") == "1" or query.get("access_mode") == "read_only"
+
+
+def duck_engine(path, read_only=False, threads=None, memory_limit=None):
+    """
+    engine for a duckdb project (pip install clinpy[duckdb]). duckdb stores tables by column and runs queries
+    vectorized on all the cores so scans of whole columns (wide expression tables, impact filters over all the
+    variants, cohort aggregates) are much faster than in sqlite. The assays work the same way on both. Only one
+    process can open a duckdb database for writing, any number of processes can open it read only while nobody is
+    writing to it
+    :param path: path of the duckdb database
+    :param read_only: open the database read only
+    :param threads: number of threads a query can use, by default all the cores
+    :param memory_limit: like "16GB", by default 80% of the memory
+    :return: a sqlalchemy engine
+    """
+    options = {}
+    if read_only:
+        options["access_mode"] = "read_only"
+    if threads is not None:
+        options["threads"] = threads
+    if memory_limit is not None:
+        options["memory_limit"] = memory_limit
+    dbstring = "duckdb:///{}".format(path)
+    if len(options) > 0:  # duckdb_engine passes these to duckdb as settings
+        dbstring += "?" + "&".join("{}={}".format(key, value) for key, value in options.items())
+    return create_engine(dbstring)
+
+
+# engines made by read_engine, connections inherited from the parent would be used by both processes at the same time
+# so their pools are emptied in forked children. One handler for all of them, fork handlers cannot be unregistered
+_READ_ENGINES = weakref.WeakSet()
+
+
+def _reset_read_engines():
+    for engine in list(_READ_ENGINES):
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_read_engines)
+
+
+def read_engine(path, immutable=False, pool_size=5, max_overflow=10, busy_timeout=30):
+    """
+    a read only engine for querying a project from many threads. Connections are opened with mode=ro so nothing can
+    be written by accident (temp tables still work) and are kept in a pool that is shared by the threads, each thread
+    checks one out for as long as its session needs it. If the database is in WAL mode (see set_wal) queries and a
+    load that is appending to the project do not block each other, otherwise queries wait up to busy_timeout seconds
+    for a write to finish. A database that is not going to change anymore can be opened with immutable=1, sqlite then
+    skips locking altogether but if the file does change the results are undefined.
+    Connections cannot be shared between processes, the pool is emptied in forked children so they open their own
+    :param path: path of the sqlite database
+    :param immutable: open with immutable=1 instead of mode=ro
+    :param pool_size: number of connections kept open
+    :param max_overflow: number of connections that can be opened on top of pool_size when all of them are in use
+    :param busy_timeout: seconds to wait for a lock
+    :return: a sqlalchemy engine
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError("could not find {}".format(path))
+    options = "immutable=1" if immutable else "mode=ro"
+    dbstring = "sqlite:///file:{}?{}&uri=true".format(pathname2url(os.path.abspath(path)), options)
+    engine = create_engine(dbstring, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                           connect_args={"check_same_thread": False, "timeout": busy_timeout})
+
+    @event.listens_for(engine, "connect")
+    def read_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA temp_store=MEMORY")  # search temp tables, the directory might not be writable
+        cursor.close()
+
+    _READ_ENGINES.add(engine)
+    return engine
+
+
+def dict_to_engine(params, read_only=False, **kwargs):
     #TODO support postgres, mariadb and mysql
     # means adding an .env file to the create_project.py
     """
     create a database connection based on the yaml description
     :param dict: the output section of the config yaml
+    :param read_only: open the database for queries only (see read_engine), immutable, pool_size, max_overflow and
+    busy_timeout are taken from the output section if they are there. For duckdb threads and memory_limit are used
+    instead (see duck_engine)
     :param kwargs: if type is not sqlite in this order username, password, host, port
     :return: a sqlalchemy engine
     """
     if params["type"] == "sqlite":
+        if read_only:
+            options = {key: params[key] for key in ["immutable", "pool_size", "max_overflow", "busy_timeout"]
+                       if key in params}
+            return read_engine(params["name"], **options)
         dbstring = "sqlite:///{}".format(params["name"])
+    elif params["type"] == "duckdb":
+        return duck_engine(params["name"], read_only=read_only, threads=params.get("threads"),
+                           memory_limit=params.get("memory_limit"))
     else:
-        raise NotImplementedError("currently only sqlite is supported")
+        raise NotImplementedError("currently only sqlite and duckdb are supported")
         # dbstring = "{}://{}:{}@{}:{}/{}".format(kwargs, params["name"])
-    engine = create_engine(dbstring)
+    connect_args = {"timeout": params["busy_timeout"]} if "busy_timeout" in params else {}
+    engine = create_engine(dbstring, connect_args=connect_args)
+    if params.get("wal", False):
+        set_wal(engine)
     return engine
 
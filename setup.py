@@ -11,11 +11,15 @@ setup(
                       "pyranges",
                       "sqlalchemy",
                       "numpy",
+                      "scipy",
                       "pysam",
                       "pytxdb @ git+https://github.com/celalp/pytxdb@master",
                       "pyyaml",
                       "sqlalchemy-filters"],
+    extras_require={"async": ["aiosqlite"],
+                    "duckdb": ["duckdb", "duckdb-engine"]},
     zip_safe=False,
-    scripts=["clinpy/scripts/create_project.py"],
+    scripts=["clinpy/scripts/create_project.py", "clinpy/scripts/convert_to_duckdb.py",
+             "clinpy/scripts/shard_project.py"],
     include_package_data=True
 )
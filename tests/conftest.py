@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+
+import yaml
+
+SCRIPTS = os.path.join(os.path.dirname(__file__), "..", "clinpy", "scripts")
+
+
+def run_script(script, *args, cwd):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(os.path.join(SCRIPTS, "..", "..")))
+    subprocess.run([sys.executable, os.path.join(SCRIPTS, script), *args], cwd=cwd, env=env, check=True,
+                   capture_output=True)
+
+
+def write_rna_project(path, samples, create=True, expression_store=False, name="project.db"):
+    """
+    the files of a create_project.py load of gene and transcript expression, samples is a dict of sample id: cohort
+    and the values depend on the sample so the samples can be told apart
+    """
+    with open(os.path.join(path, "sample_meta.tsv"), "w") as out:
+        out.write("sample_id\tcohort\n")
+        out.writelines("{}\t{}\n".format(sample, cohort) for sample, cohort in samples.items())
+    with open(os.path.join(path, "rna.csv"), "w") as out:
+        out.write("samplename\tgene_expression\tisoform_expression\n")
+        out.writelines("{0}\tg{0}.tsv\tt{0}.tsv\n".format(sample) for sample in samples)
+    for sample in samples:
+        with open(os.path.join(path, "g{}.tsv".format(sample)), "w") as out:
+            out.write("gene_id\ttranscript_id(s)\tlength\teffective_length\texpected_count\tTPM\tFPKM\n")
+            for gene in range(20):
+                out.write("G{}\tx\t1000\t900.0\t{}\t{}\t{}\n".format(gene, gene * sample, gene + sample / 10,
+                                                                   gene / 4))
+        with open(os.path.join(path, "t{}.tsv".format(sample)), "w") as out:
+            out.write("transcript_id\tgene_id\tlength\teffective_length\texpected_count\tTPM\tFPKM\tIsoPct\n")
+            for transcript in range(30):
+                out.write("T{}\tx\t1000\t900.0\t{}\t{}\t{}\t{}\n".format(transcript, transcript * sample,
+                                                                       transcript + sample / 10, transcript / 4,
+                                                                       50.0))
+    config = {"data": {"modalities": {"rna": {"file": "rna.csv", "min_junction_reads": 10,
+                                              "expression_store": expression_store,
+                                              "columns": ["samplename", "gene_expression", "isoform_expression"]}}},
+              "output": {"type": "sqlite", "name": name, "create": create},
+              "sample_meta": {"file": "sample_meta.tsv",
+                              "columns": {"sample_id": {"type": "int", "pk": True, "index": True},
+                                          "cohort": {"type": "str", "index": True}}}}
+    with open(os.path.join(path, "config.yaml"), "w") as out:
+        yaml.safe_dump(config, out)
@@ -0,0 +1,28 @@
+import pytest
+from sqlalchemy import create_engine
+
+pytest.importorskip("duckdb_engine")
+
+from clinpy.utils.utils import duck_engine
+from conftest import run_script, write_rna_project
+
+
+def test_convert_after_bulk_load(tmp_path):
+    # the ANALYZE at the end of a bulk load creates sqlite_stat1, it is not part of the project
+    write_rna_project(tmp_path, {1: "A", 2: "B"})
+    run_script("create_project.py", "-y", "config.yaml", "--bulk", cwd=tmp_path)
+    source = create_engine("sqlite:///{}".format(tmp_path / "project.db"))
+    with source.connect() as conn:
+        assert conn.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'").scalar() == 1
+        counts = {table: conn.exec_driver_sql("SELECT count(*) FROM {}".format(table)).scalar()
+                  for table in ["samples", "genes", "gene_expression", "transcripts", "transcript_expression"]}
+    source.dispose()
+
+    run_script("convert_to_duckdb.py", "-i", "project.db", "-o", "project.duckdb", cwd=tmp_path)
+    target = duck_engine(str(tmp_path / "project.duckdb"), read_only=True)
+    with target.connect() as conn:
+        assert {table: conn.exec_driver_sql("SELECT count(*) FROM {}".format(table)).scalar()
+                for table in counts} == counts
+        assert conn.exec_driver_sql("SELECT count(*) FROM information_schema.tables "
+                                    "WHERE table_name = 'sqlite_stat1'").scalar() == 0
+    target.dispose()
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, create_engine, inspect
+
+from clinpy.utils.utils import create_table, finish_bulk_load
+
+
+def test_deferred_indexes_stay_on_the_table(tmp_path):
+    table = Table("things", MetaData(), Column("id", Integer, primary_key=True), Column("name", String),
+                  Column("value", Integer, index=True), Index("ix_things_name", "name", unique=True))
+    indexes = set(table.indexes)
+    bulk = create_engine("sqlite:///{}".format(tmp_path / "bulk.db"))
+    deferred = []
+    create_table(table, bulk, deferred)
+    create_table(table, bulk, deferred)
+    assert [index.name for index in deferred] == ["ix_things_value"]
+    assert [index["name"] for index in inspect(bulk).get_indexes("things")] == ["ix_things_name"]
+    finish_bulk_load(bulk, deferred)
+    assert sorted(index["name"] for index in inspect(bulk).get_indexes("things")) == ["ix_things_name",
+                                                                                     "ix_things_value"]
+
+    # the table is not changed so it is created with all its indexes again
+    assert set(table.indexes) == indexes
+    other = create_engine("sqlite:///{}".format(tmp_path / "other.db"))
+    create_table(table, other)
+    assert sorted(index["name"] for index in inspect(other).get_indexes("things")) == ["ix_things_name",
+                                                                                      "ix_things_value"]
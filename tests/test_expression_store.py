@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from clinpy.assays.expression import Expression
+from clinpy.utils.expression_store import store_path
+from conftest import run_script, write_rna_project
+
+
+def load(path, samples, **kwargs):
+    write_rna_project(path, samples, **kwargs)
+    run_script("create_project.py", "-y", "config.yaml", cwd=path)
+
+
+def wide(expression, **kwargs):
+    results = expression.get_expression(long=False, what="tpm", **kwargs)
+    return results.astype(np.float32).sort_index(axis=0).sort_index(axis=1)
+
+
+def test_duplicate_names_and_samples(tmp_path):
+    load(tmp_path, {1: "A", 2: "B", 3: "B"}, expression_store=True)
+    db = create_engine("sqlite:///{}".format(tmp_path / "project.db"))
+    store, database = Expression(db, None, store=store_path(str(tmp_path / "project.db"))), Expression(db, None)
+    assert store.get_store() is not None
+    for kwargs in [{"names": ["G1", "G1", "G3"]}, {"names": ["G2", "G2", "G3"], "samples": [2, 2, 3]},
+                   {"names": ["G5", "G4", "G5", "G6"]}, {"samples": [3, 1, 1]}]:
+        from_store, from_database = wide(store, **kwargs), wide(database, **kwargs)
+        from_database.columns = from_database.columns.astype(from_store.columns.dtype)
+        pd.testing.assert_frame_equal(from_store, from_database, check_names=False)
+
+
+def test_store_is_not_used_after_a_load_without_it(tmp_path):
+    load(tmp_path, {1: "A", 2: "B"}, expression_store=True)
+    db = create_engine("sqlite:///{}".format(tmp_path / "project.db"))
+    expression = Expression(db, None, store=store_path(str(tmp_path / "project.db")))
+    assert expression.get_store() is not None and expression.get_store(gene=False) is not None
+    assert wide(expression).shape == (20, 2)
+
+    # the same object notices the load and goes back to the database until the store is re-built
+    load(tmp_path, {3: "B"}, create=False)
+    assert expression.get_store() is None and expression.get_store(gene=False) is None
+    assert wide(expression).shape == (20, 3)
+
+    load(tmp_path, {4: "A"}, create=False, expression_store=True)
+    assert expression.get_store() is not None
+    assert list(expression.get_store().samples) == [1, 2, 3, 4]
+    assert wide(expression).shape == (20, 4)
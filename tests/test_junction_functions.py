@@ -0,0 +1,32 @@
+import pandas as pd
+
+from clinpy.utils.junction_functions import match_junctions
+
+
+def junctions(*coords):
+    return pd.DataFrame([{"id": num, "start": start, "end": end} for num, (start, end) in enumerate(coords)])
+
+
+def matched(queries, targets, **kwargs):
+    results = match_junctions(pd.DataFrame(queries, columns=["start", "end"]), targets, **kwargs)
+    return sorted(results["junction"].tolist())
+
+
+def test_overlap_zero_needs_an_intersection():
+    # (100, 900) ends before the query, (2500, 3500) is in the same length class and puts it in the window
+    targets = junctions((100, 900), (1500, 1600), (2500, 3500))
+    assert matched([(1000, 2000)], targets, overlap=0) == [1]
+    assert matched([(1000, 2000)], junctions((100, 900), (1500, 1600)), overlap=0) == [1]
+
+
+def test_overlap_window_edges():
+    targets = junctions((500, 999), (2001, 2500), (500, 1000), (2000, 2500), (1990, 2600))
+    assert matched([(1000, 2000)], targets, overlap=0) == [2, 3, 4]
+    assert matched([(1000, 2000)], targets, overlap=0.01) == [4]
+    assert matched([(1000, 2000)], targets, overlap=0.02) == []
+
+
+def test_exact_and_tolerance():
+    targets = junctions((1000, 2000), (1002, 1998), (1000, 2001))
+    assert matched([(1000, 2000)], targets) == [0]
+    assert matched([(1000, 2000)], targets, tolerance=(2, 2)) == [0, 1, 2]
@@ -0,0 +1,93 @@
+import os
+import subprocess
+
+import pandas as pd
+import pytest
+import yaml
+from sqlalchemy import create_engine
+
+from clinpy.utils.snp_functions import ALL_COHORTS
+from conftest import SCRIPTS, run_script
+
+HEADER = """##fileformat=VCFv4.2
+##FILTER=<ID=PASS,Description="All filters passed">
+##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: Allele|Consequence|IMPACT|SYMBOL">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="DP">
+##contig=<ID=1,length=100000>
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}
+"""
+
+# two batches of samples: sample id: (cohort, {position: genotype})
+BATCHES = [{1: ("A", {100: "0/1", 200: "1/1", 300: "0/1"}),
+            2: ("B", {100: "1/1", 400: "0/1"})},
+           {3: ("A", {100: "0/1", 400: "1/1", 500: "0/0"}),
+            4: ("B", {200: "0/1", 300: "0/1", 500: "0/1"}),
+            5: (None, {100: "0/1"})}]
+
+
+def load_batch(path, samples, create):
+    with open(os.path.join(path, "sample_meta.tsv"), "w") as out:
+        out.write("sample_id\tcohort\n")
+        out.writelines("{}\t{}\n".format(sample, cohort or "") for sample, (cohort, _) in samples.items())
+    with open(os.path.join(path, "snps.tsv"), "w") as out:
+        out.write("samplename\tvariants\n")
+        for sample, (_, genotypes) in samples.items():
+            vcf = os.path.join(path, "S{}.vcf".format(sample))
+            with open(vcf, "w") as vcf_out:
+                vcf_out.write(HEADER.format(sample))
+                for pos, gt in sorted(genotypes.items()):
+                    vcf_out.write("1\t{}\t.\tA\tG\t50\tPASS\tCSQ=G|missense_variant|MODERATE|GENE\tGT:DP\t{}:20\n".
+                                  format(pos, gt))
+            out.write("{}\t{}\n".format(sample, vcf))
+    config = {"data": {"modalities": {"snps": {"file": "snps.tsv", "columns": ["samplename", "variants"],
+                                               "vcf_config": os.path.join(SCRIPTS, "..", "vcf.yaml")}}},
+              "output": {"type": "sqlite", "name": "project.db", "create": create},
+              "sample_meta": {"file": "sample_meta.tsv",
+                              "columns": {"sample_id": {"type": "int", "pk": True, "index": True},
+                                          "cohort": {"type": "str", "index": True}}}}
+    with open(os.path.join(path, "config.yaml"), "w") as out:
+        yaml.safe_dump(config, out)
+    run_script("create_project.py", "-y", "config.yaml", cwd=path)
+
+
+def expected_counts(batches):
+    samples = {sample: values for batch in batches for sample, values in batch.items()}
+    sizes = pd.Series([cohort or "unassigned" for cohort, _ in samples.values()]).value_counts().to_dict()
+    sizes[ALL_COHORTS] = len(samples)
+    rows = {}
+    for cohort, genotypes in samples.values():
+        for name in [cohort or "unassigned", ALL_COHORTS]:
+            for pos, gt in genotypes.items():
+                dosage = gt.count("1")
+                row = rows.setdefault((pos, name), {"ac": 0, "num_het": 0, "num_hom": 0})
+                row["ac"] += dosage
+                row["num_het"] += dosage == 1
+                row["num_hom"] += dosage == 2
+    expected = pd.DataFrame([{"pos": pos, "cohort": cohort, **row, "an": 2 * sizes[cohort],
+                              "af": row["ac"] / (2 * sizes[cohort])} for (pos, cohort), row in rows.items()])
+    return expected.sort_values(["pos", "cohort"], ignore_index=True)
+
+
+def variant_counts(path):
+    db = create_engine("sqlite:///{}".format(os.path.join(path, "project.db")))
+    counts = pd.read_sql("SELECT pos, cohort, ac, num_het, num_hom, an, af FROM variant_counts "
+                         "JOIN variants ON variants.variant_id = variant_counts.variant_id", db)
+    db.dispose()
+    return counts.sort_values(["pos", "cohort"], ignore_index=True)
+
+
+def test_counts_are_accumulated_across_batches(tmp_path):
+    columns = ["pos", "cohort", "ac", "num_het", "num_hom", "an", "af"]
+    load_batch(tmp_path, BATCHES[0], create=True)
+    pd.testing.assert_frame_equal(variant_counts(tmp_path), expected_counts(BATCHES[:1])[columns],
+                                  check_dtype=False)
+    # the second batch adds to the counts of the variants it shares with the first and changes an of all of them
+    load_batch(tmp_path, BATCHES[1], create=False)
+    pd.testing.assert_frame_equal(variant_counts(tmp_path), expected_counts(BATCHES)[columns], check_dtype=False)
+
+
+def test_cohort_cannot_be_all(tmp_path):
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        load_batch(tmp_path, {1: ("A", {100: "0/1"}), 2: (ALL_COHORTS, {100: "1/1"})}, create=True)
+    assert "cannot be the name of a cohort" in error.value.stderr.decode()